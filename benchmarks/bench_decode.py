@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares the fast JPEG decode path (draft mode and stepped reduction)
+with a full decode and a single antialias resample.
+
+Usage: python benchmarks/bench_decode.py
+"""
+
+import common
+
+from PIL import ImageChops, ImageStat
+from webmedia import app_settings
+from webmedia.processors.image import Thumbnail
+
+SIZES = [(6000, 4000), (3000, 2000), (1024, 768)]
+TARGETS = [150, 400]
+
+def resize(src, target, method, fast):
+    app_settings.IMAGE_FAST_DECODE = fast
+    thumb = Thumbnail(src, width=target, height=target, method=method)
+    thumb.resize()
+    thumb.image.load()
+    return thumb.image
+
+def rms(a, b):
+    stat = ImageStat.Stat(ImageChops.difference(a.convert('RGB'), b.convert('RGB')))
+    return sum(v ** 2 for v in stat.rms) ** 0.5 / len(stat.rms) ** 0.5
+
+def main():
+    fast_bkp = app_settings.IMAGE_FAST_DECODE
+    print('%-12s %-6s %-5s %10s %10s %8s %6s' % (
+        'original', 'target', 'mode', 'exact ms', 'fast ms', 'speedup', 'rms'))
+    try:
+        for width, height in SIZES:
+            src = common.create_image('decode_%dx%d.jpg' % (width, height), width, height)
+            for target in TARGETS:
+                for method in (Thumbnail.FIT, Thumbnail.CROP):
+                    exact, _ = common.measure(lambda: resize(src, target, method, False), 3)
+                    fast, _ = common.measure(lambda: resize(src, target, method, True), 3)
+                    diff = rms(resize(src, target, method, False),
+                               resize(src, target, method, True))
+                    print('%-12s %-6d %-5s %10.1f %10.1f %7.1fx %6.2f' % (
+                        '%dx%d' % (width, height), target, method,
+                        exact * 1000, fast * 1000, exact / fast, diff))
+    finally:
+        app_settings.IMAGE_FAST_DECODE = fast_bkp
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares the per-tag cost of rendering the embed templates through
+loader.render_to_string with the precompiled renderer.
+
+Usage: python benchmarks/bench_render.py [iterations]
+"""
+
+import sys
+
+import common
+
+from django.template import loader
+from django.utils.safestring import mark_safe
+from webmedia.renderers import renderer, template_name
+
+FILETYPES = ['image', 'stylesheet', 'javascript', 'flash']
+
+def make_context():
+    attrs = {'width': '100', 'height': '50', 'alt': 'Logo'}
+    return {
+        'src': '/media/images/logo.png?123-456789',
+        'attrs': attrs,
+        'flat_attrs': mark_safe(' '.join(['%s="%s"' % i for i in attrs.items()])),
+    }
+
+def main():
+    iterations = int(sys.argv[1:] and sys.argv[1] or 2000)
+    context = make_context()
+    print('%-12s %12s %12s %8s' % ('filetype', 'loader us', 'compiled us', 'speedup'))
+    for filetype in FILETYPES:
+        name = template_name(filetype)
+        # Both paths must render the same HTML
+        assert loader.render_to_string(name, context) == renderer.render(filetype, context)
+
+        before, _ = common.measure(lambda: [
+            loader.render_to_string(name, context) for i in xrange(iterations)], 3)
+        after, _ = common.measure(lambda: [
+            renderer.render(filetype, context) for i in xrange(iterations)], 3)
+        print('%-12s %12.2f %12.2f %7.1fx' % (
+            filetype, before * 1e6 / iterations, after * 1e6 / iterations, before / after))
+
+if __name__ == '__main__':
+    main()
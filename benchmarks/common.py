@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Shared setup for the benchmark scripts: makes the repository and the
+test project importable and provides fixtures and timing helpers.
+"""
+
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_project.settings')
+
+from PIL import Image
+from django.conf import settings
+
+BENCH_DIR = 'bench_fixtures'
+
+def fixture_path(name):
+    path = os.path.join(settings.MEDIA_ROOT, BENCH_DIR, name)
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    return path
+
+def create_image(name, width, height, seed=0):
+    """
+    Creates a photo-like image (smooth noise) under MEDIA_ROOT and
+    returns its path relative to MEDIA_ROOT.
+    """
+    rand = random.Random(seed)
+    data = ''.join(chr(rand.randint(0, 255)) for i in range(32 * 32 * 3))
+    img = Image.frombuffer('RGB', (32, 32), data, 'raw', 'RGB', 0, 1)
+    img = img.resize((width, height), Image.BILINEAR)
+    img.save(fixture_path(name), quality=90)
+    return '%s/%s' % (BENCH_DIR, name)
+
+def measure(func, repeat=5):
+    """
+    Runs `func` `repeat` times, returns the best and mean time in seconds.
+    """
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times), sum(times) / len(times)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for the embed/process/thumbnail hot paths.
+
+Runs every benchmark against synthetic fixtures generated under
+MEDIA_ROOT and writes the results as JSON, so runs from different
+commits can be compared.
+
+Usage:
+    python benchmarks/run.py [--output results.json] [--compare old.json]
+                             [--only name] [--repeat 5] [--scale 1.0]
+"""
+
+import optparse
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import common
+
+from django import template
+from django.conf import settings
+from django.utils import simplejson
+from webmedia import app_settings
+from webmedia.processors.image import Thumbnail
+from webmedia.templatetags.webmedia_tags import nocache, process_file
+
+IMAGE_SIZES = [(640, 480), (2048, 1536), (6000, 4000)]
+THUMB_SIZE = 150
+
+BENCHMARKS = []
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+def clear_thumbnails():
+    path = os.path.join(app_settings.THUMBNAIL_ROOT, common.BENCH_DIR)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+
+@benchmark
+def bench_process_file(options):
+    src = common.create_image('process.jpg', 640, 480)
+    n = int(1000 * options.scale)
+    process_file(src, width=THUMB_SIZE, height=THUMB_SIZE)
+    best, mean = common.measure(lambda: [
+        process_file(src, width=THUMB_SIZE, height=THUMB_SIZE) for i in xrange(n)], options.repeat)
+    return {'process_file': {'calls': n, 'best_us': best * 1e6 / n, 'mean_us': mean * 1e6 / n}}
+
+@benchmark
+def bench_embed_page(options):
+    results = {}
+    srcs = [common.create_image('page_%d.jpg' % i, 320, 240, seed=i) for i in range(20)]
+    t = template.Template('{% load webmedia_tags %}{% for src in srcs %}'
+                          '{% embed src,width=100,height=100 %}{% endfor %}')
+    for embeds in (10, 100, 500):
+        context = template.Context({'srcs': (srcs * (embeds // len(srcs) + 1))[:embeds]})
+        t.render(context)
+        best, mean = common.measure(lambda: t.render(context), options.repeat)
+        results['embed_page_%d' % embeds] = {
+            'embeds': embeds, 'best_ms': best * 1000, 'mean_ms': mean * 1000,
+            'per_embed_us': best * 1e6 / embeds}
+    return results
+
+@benchmark
+def bench_nocache(options):
+    src = common.create_image('nocache.jpg', 16, 16)
+    url = settings.MEDIA_URL + src
+    n = int(10000 * options.scale)
+    best, mean = common.measure(lambda: [nocache(url) for i in xrange(n)], options.repeat)
+    return {'nocache': {'calls': n, 'best_us': best * 1e6 / n, 'mean_us': mean * 1e6 / n}}
+
+@benchmark
+def bench_generate(options):
+    results = {}
+    for width, height in IMAGE_SIZES:
+        src = common.create_image('generate_%dx%d.jpg' % (width, height), width, height)
+        for method in (Thumbnail.FIT, Thumbnail.CROP):
+            def cold():
+                clear_thumbnails()
+                Thumbnail(src, width=THUMB_SIZE, height=THUMB_SIZE, method=method).generate()
+            def warm():
+                Thumbnail(src, width=THUMB_SIZE, height=THUMB_SIZE, method=method).generate()
+            name = 'generate_%dx%d_%s' % (width, height, method)
+            best, mean = common.measure(cold, options.repeat)
+            results[name + '_cold'] = {'best_ms': best * 1000, 'mean_ms': mean * 1000}
+            best, mean = common.measure(warm, options.repeat)
+            results[name + '_warm'] = {'best_ms': best * 1000, 'mean_ms': mean * 1000}
+    clear_thumbnails()
+    return results
+
+@benchmark
+def bench_concurrent(options):
+    results = {}
+    threads = 8
+    distinct = [common.create_image('concurrent_%d.jpg' % i, 2048, 1536, seed=i) for i in range(threads)]
+
+    def run(srcs):
+        clear_thumbnails()
+        workers = [threading.Thread(target=lambda s=s: Thumbnail(
+            s, width=THUMB_SIZE, height=THUMB_SIZE).generate()) for s in srcs]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    # Same image from every thread (single-flight) and one image per thread
+    for name, srcs in [('same', [distinct[0]] * threads), ('distinct', distinct)]:
+        best, mean = common.measure(lambda: run(srcs), options.repeat)
+        results['concurrent_%s_%d' % (name, threads)] = {
+            'threads': threads, 'best_ms': best * 1000, 'mean_ms': mean * 1000}
+    clear_thumbnails()
+    return results
+
+
+def metadata():
+    try:
+        commit = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=common.ROOT,
+                                  stdout=subprocess.PIPE).communicate()[0].strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+    }
+
+def compare(results, baseline):
+    """
+    Prints the change of each timing against a previous run.
+    """
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        for key in ('best_us', 'best_ms'):
+            if key in results[name] and key in baseline[name]:
+                old, new = baseline[name][key], results[name][key]
+                change = old and (new - old) * 100.0 / old or 0.0
+                print('%-40s %12.2f %12.2f %+8.1f%%' % (name, old, new, change))
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--output', help='Write the results to a JSON file.')
+    parser.add_option('--compare', help='Compare with the results in a JSON file.')
+    parser.add_option('--only', action='append', help='Run only the given benchmark.')
+    parser.add_option('--repeat', type='int', default=5)
+    parser.add_option('--scale', type='float', default=1.0,
+                      help='Multiplier for the number of calls per measure.')
+    options, args = parser.parse_args()
+
+    results = {}
+    try:
+        for func in BENCHMARKS:
+            name = func.__name__[len('bench_'):]
+            if options.only and name not in options.only:
+                continue
+            sys.stderr.write('Running %s...\n' % name)
+            results.update(func(options))
+    finally:
+        shutil.rmtree(os.path.join(settings.MEDIA_ROOT, common.BENCH_DIR), True)
+        clear_thumbnails()
+
+    output = {'metadata': metadata(), 'results': results}
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            simplejson.dump(output, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    else:
+        print(simplejson.dumps(output, indent=2, sort_keys=True))
+
+    if options.compare:
+        f = open(options.compare)
+        try:
+            baseline = simplejson.load(f)['results']
+        finally:
+            f.close()
+        print('%-40s %12s %12s %9s' % ('benchmark', 'baseline', 'current', 'change'))
+        compare(results, baseline)
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,8 @@ from django.conf.urls.defaults import *
 # admin.autodiscover()
 
 urlpatterns = patterns('',
+    (r'^webmedia/', include('webmedia.urls')),
+
     # Example:
     # (r'^test_project/', include('test_project.foo.urls')),
 
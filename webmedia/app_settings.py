@@ -26,5 +26,155 @@ PROCESSORS = getattr(settings, 'WEBMEDIA_PROCESSORS', {
 })
 
 IMAGE_RESIZE_METHOD = getattr(settings, 'WEBMEDIA_IMAGE_RESIZE_METHOD', 'crop')
+# Quality for all formats or a dict by format, e.g. {'JPG': 80, 'WEBP': 75, 'default': 80}
 IMAGE_QUALITY = getattr(settings, 'WEBMEDIA_IMAGE_QUALITY', 80)
 AUTO_CONVERT_BMPS = getattr(settings, 'WEBMEDIA_AUTO_CONVERT_BMPS', 'GIF')
+
+# Seconds to cache os.stat results, 0 disables the cache
+STAT_CACHE_TIMEOUT = getattr(settings, 'WEBMEDIA_STAT_CACHE_TIMEOUT', 0)
+STAT_CACHE_SIZE = getattr(settings, 'WEBMEDIA_STAT_CACHE_SIZE', 1000)
+
+# Path of the SQLite thumbnail manifest, None disables it
+THUMBNAIL_MANIFEST = getattr(settings, 'WEBMEDIA_THUMBNAIL_MANIFEST', None)
+
+# Generate thumbnails in background threads, rendering a fallback meanwhile
+THUMBNAIL_ASYNC = getattr(settings, 'WEBMEDIA_THUMBNAIL_ASYNC', False)
+THUMBNAIL_ASYNC_WORKERS = getattr(settings, 'WEBMEDIA_THUMBNAIL_ASYNC_WORKERS', 2)
+THUMBNAIL_ASYNC_QUEUE_SIZE = getattr(settings, 'WEBMEDIA_THUMBNAIL_ASYNC_QUEUE_SIZE', 100)
+# Seconds to wait for a free queue slot before giving up on queueing a job
+THUMBNAIL_ASYNC_TIMEOUT = getattr(settings, 'WEBMEDIA_THUMBNAIL_ASYNC_TIMEOUT', 0)
+# Placeholder URL rendered while generating, None renders the original
+THUMBNAIL_ASYNC_FALLBACK = getattr(settings, 'WEBMEDIA_THUMBNAIL_ASYNC_FALLBACK', None)
+
+# Decode JPEGs at a reduced scale and downscale in cheap steps before resampling
+IMAGE_FAST_DECODE = getattr(settings, 'WEBMEDIA_IMAGE_FAST_DECODE', True)
+# Thumbnails up to this size (in pixels) use a bilinear filter instead of antialias
+IMAGE_FAST_RESAMPLE_SIZE = getattr(settings, 'WEBMEDIA_IMAGE_FAST_RESAMPLE_SIZE', 0)
+
+# Named thumbnail attributes generated by the webmedia_pregenerate command,
+# e.g. {'small': {'width': 100, 'height': 100, 'method': 'crop'}}
+THUMBNAIL_PRESETS = getattr(settings, 'WEBMEDIA_THUMBNAIL_PRESETS', {})
+
+# How embedded files are versioned: 'mtime' adds an anti-cache stamp from the
+# modification time, 'hash' uses the asset manifest built by webmedia_hashassets
+VERSIONING = getattr(settings, 'WEBMEDIA_VERSIONING', 'mtime')
+ASSET_MANIFEST = getattr(settings, 'WEBMEDIA_ASSET_MANIFEST', os.path.join(settings.MEDIA_ROOT, 'webmedia-assets.json'))
+# Filetypes hashed by webmedia_hashassets
+VERSIONED_FILETYPES = getattr(settings, 'WEBMEDIA_VERSIONED_FILETYPES', ('image', 'stylesheet', 'javascript'))
+# Use hashed filenames (e.g. style.1a2b3c4d5e6f.css) instead of ?v=<hash>
+HASHED_FILENAMES = getattr(settings, 'WEBMEDIA_HASHED_FILENAMES', False)
+
+# Cache the HTML rendered by the embed tag
+EMBED_CACHE = getattr(settings, 'WEBMEDIA_EMBED_CACHE', False)
+EMBED_CACHE_TIMEOUT = getattr(settings, 'WEBMEDIA_EMBED_CACHE_TIMEOUT', 300)
+# Number of fragments kept in process in front of Django's cache
+EMBED_CACHE_SIZE = getattr(settings, 'WEBMEDIA_EMBED_CACHE_SIZE', 1000)
+
+# Extra formats written next to each thumbnail and offered in a <picture>
+# element, e.g. ('WEBP',). Variants bigger than the thumbnail are discarded.
+IMAGE_VARIANTS = getattr(settings, 'WEBMEDIA_IMAGE_VARIANTS', ())
+# Write PNG thumbnails' WEBP variants losslessly
+IMAGE_LOSSLESS_VARIANTS = getattr(settings, 'WEBMEDIA_IMAGE_LOSSLESS_VARIANTS', False)
+
+# Named encoding profiles for thumbnails. Options: progressive and subsampling
+# ('4:4:4', '4:2:2' or '4:2:0') for JPEGs, strip (drops EXIF/ICC data after
+# applying the EXIF orientation), srgb (converts ICC profiles to sRGB, needs
+# ImageCms) and colors (adaptive palette size for PNGs and GIFs).
+IMAGE_PROFILES = getattr(settings, 'WEBMEDIA_IMAGE_PROFILES', {
+    'default': {},
+    'web': {'progressive': True, 'subsampling': '4:2:0', 'strip': True, 'srgb': True},
+    'palette': {'strip': True, 'srgb': True, 'colors': 256},
+})
+# Profile name used for all formats or a dict by format, e.g. {'JPG': 'web'}
+IMAGE_PROFILE = getattr(settings, 'WEBMEDIA_IMAGE_PROFILE', 'default')
+
+# Where the bundle tag writes the concatenated stylesheets and javascripts
+BUNDLE_ROOT = getattr(settings, 'WEBMEDIA_BUNDLE_ROOT', os.path.join(settings.MEDIA_ROOT, 'bundles'))
+BUNDLE_URL = getattr(settings, 'WEBMEDIA_BUNDLE_URL', settings.MEDIA_URL + 'bundles/')
+# Strip comments and whitespace from bundles by default
+BUNDLE_MINIFY = getattr(settings, 'WEBMEDIA_BUNDLE_MINIFY', False)
+
+# Write .gz (and .br, with the brotli module) files next to embedded files
+PRECOMPRESS = getattr(settings, 'WEBMEDIA_PRECOMPRESS', False)
+PRECOMPRESS_FILETYPES = getattr(settings, 'WEBMEDIA_PRECOMPRESS_FILETYPES', ('stylesheet', 'javascript'))
+# Files smaller than this (in bytes) aren't compressed
+PRECOMPRESS_MIN_SIZE = getattr(settings, 'WEBMEDIA_PRECOMPRESS_MIN_SIZE', 1024)
+
+# Record timings and counters of the processing hot paths
+INSTRUMENTATION = getattr(settings, 'WEBMEDIA_INSTRUMENTATION', False)
+
+# Originals decoding to more pixels than this (after JPEG draft scaling) aren't
+# resized and are rendered as they are. 0 disables the limit.
+IMAGE_MAX_PIXELS = getattr(settings, 'WEBMEDIA_IMAGE_MAX_PIXELS', 0)
+# Pixels being decoded at once by each process, resizes over the budget wait
+# for their turn. 0 disables the limit.
+IMAGE_MEMORY_BUDGET = getattr(settings, 'WEBMEDIA_IMAGE_MEMORY_BUDGET', 0)
+# Seconds to wait for the memory budget before rendering the original, None
+# waits indefinitely
+IMAGE_MEMORY_TIMEOUT = getattr(settings, 'WEBMEDIA_IMAGE_MEMORY_TIMEOUT', None)
+
+# Maximum size in bytes of the thumbnails, the least recently used ones are
+# evicted over it by webmedia_gc and background sweeps. 0 disables eviction.
+THUMBNAIL_MAX_SIZE = getattr(settings, 'WEBMEDIA_THUMBNAIL_MAX_SIZE', 0)
+# Seconds between writes of the batched thumbnail access times, None disables
+# tracking (eviction then relies on the filesystem's access times)
+THUMBNAIL_ACCESS_INTERVAL = getattr(settings, 'WEBMEDIA_THUMBNAIL_ACCESS_INTERVAL', 60)
+# Seconds between background sweeps removing orphan thumbnails and evicting
+# over THUMBNAIL_MAX_SIZE, 0 disables them
+THUMBNAIL_GC_INTERVAL = getattr(settings, 'WEBMEDIA_THUMBNAIL_GC_INTERVAL', 0)
+# Thumbnails examined by each background sweep
+THUMBNAIL_GC_BATCH = getattr(settings, 'WEBMEDIA_THUMBNAIL_GC_BATCH', 1000)
+
+# How thumbnails are named: 'mirror' mirrors the originals' directories and
+# encodes the dimensions, method and profile in the filename, 'hashed' hashes
+# every parameter into the filename and shards thumbnails in a directory tree
+# of THUMBNAIL_SHARD_DEPTH levels of THUMBNAIL_SHARD_WIDTH hex digits.
+# webmedia_migratethumbs moves mirrored thumbnails to the hashed layout.
+THUMBNAIL_NAMING = getattr(settings, 'WEBMEDIA_THUMBNAIL_NAMING', 'mirror')
+THUMBNAIL_SHARD_DEPTH = getattr(settings, 'WEBMEDIA_THUMBNAIL_SHARD_DEPTH', 2)
+THUMBNAIL_SHARD_WIDTH = getattr(settings, 'WEBMEDIA_THUMBNAIL_SHARD_WIDTH', 2)
+
+# Add the width and height, read from the header, to images that aren't resized
+IMAGE_DIMENSIONS = getattr(settings, 'WEBMEDIA_IMAGE_DIMENSIONS', True)
+IMAGE_DIMENSIONS_CACHE_SIZE = getattr(settings, 'WEBMEDIA_IMAGE_DIMENSIONS_CACHE_SIZE', 1000)
+# Images embedded in a request after this many get loading="lazy" and
+# decoding="async", None disables it
+IMAGE_LAZY_AFTER = getattr(settings, 'WEBMEDIA_IMAGE_LAZY_AFTER', 3)
+# Inline a tiny blurred copy of thumbnails as their background while loading
+IMAGE_PLACEHOLDER = getattr(settings, 'WEBMEDIA_IMAGE_PLACEHOLDER', False)
+# Maximum width and height of the placeholders in pixels
+IMAGE_PLACEHOLDER_SIZE = getattr(settings, 'WEBMEDIA_IMAGE_PLACEHOLDER_SIZE', 16)
+
+# Threads processing the files of the webmedia_prefetch tag
+PREFETCH_WORKERS = getattr(settings, 'WEBMEDIA_PREFETCH_WORKERS', 4)
+# Attributes used by processors: embeds must give the same values as
+# webmedia_prefetch to use its results, other attributes are just added
+PROCESSED_ATTRIBUTES = getattr(settings, 'WEBMEDIA_PROCESSED_ATTRIBUTES',
+                               ('width', 'height', 'method', 'format', 'quality', 'profile', 'srcset'))
+
+# Render links to the thumbnail view of webmedia.urls, which generates the
+# thumbnails when requested, instead of generating them while rendering.
+# The links are signed with the SECRET_KEY.
+THUMBNAIL_SERVE = getattr(settings, 'WEBMEDIA_THUMBNAIL_SERVE', False)
+# Seconds browsers and proxies may cache the served thumbnails
+THUMBNAIL_SERVE_MAX_AGE = getattr(settings, 'WEBMEDIA_THUMBNAIL_SERVE_MAX_AGE', 3600)
+# Let the web server send the thumbnails: None, 'x-sendfile' (Apache, lighttpd)
+# or 'x-accel-redirect' (nginx, with an internal location for THUMBNAIL_ACCEL_URL)
+THUMBNAIL_SENDFILE = getattr(settings, 'WEBMEDIA_THUMBNAIL_SENDFILE', None)
+THUMBNAIL_ACCEL_URL = getattr(settings, 'WEBMEDIA_THUMBNAIL_ACCEL_URL', THUMBNAIL_URL)
+
+# Make thumbnails of http:// and https:// images, downloaded to
+# THUMBNAIL_ROOT/remote. Otherwise remote images are embedded as they are.
+REMOTE_IMAGES = getattr(settings, 'WEBMEDIA_REMOTE_IMAGES', False)
+# Hosts remote images may come from, None allows any
+REMOTE_HOSTS = getattr(settings, 'WEBMEDIA_REMOTE_HOSTS', None)
+# Largest remote image in bytes
+REMOTE_MAX_SIZE = getattr(settings, 'WEBMEDIA_REMOTE_MAX_SIZE', 10 * 1024 * 1024)
+# Seconds a download may take
+REMOTE_TIMEOUT = getattr(settings, 'WEBMEDIA_REMOTE_TIMEOUT', 10)
+# Seconds downloaded images are used before checking if they changed
+REMOTE_MAX_AGE = getattr(settings, 'WEBMEDIA_REMOTE_MAX_AGE', 3600)
+# Idle keep-alive connections kept per host
+REMOTE_POOL_SIZE = getattr(settings, 'WEBMEDIA_REMOTE_POOL_SIZE', 4)
+# Up to date downloads remembered in memory, skipping their metadata
+REMOTE_CACHE_SIZE = getattr(settings, 'WEBMEDIA_REMOTE_CACHE_SIZE', 1000)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import tempfile
+import threading
+
+from django.conf import settings
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
+from webmedia import app_settings
+from webmedia.cache import stat_cache
+from webmedia.compression import compressor
+from webmedia.versioning import HASH_LENGTH
+
+CSS_STRING = r'"(?:[^"\\]|\\.)*"' + r"|'(?:[^'\\]|\\.)*'"
+CSS_STRING_RE = re.compile('(%s)' % CSS_STRING, re.S)
+# Matches strings too, so comment delimiters inside them are kept
+CSS_COMMENT_RE = re.compile(r'(%s)|/\*.*?\*/' % CSS_STRING, re.S)
+CSS_SPACES_RE = re.compile(r'\s+')
+CSS_PUNCTUATION_RE = re.compile(r'\s*([{};,>])\s*')
+
+CSS_URL_RE = re.compile(r'url\(\s*([\'"]?)(.*?)\1\s*\)')
+# Absolute, protocol relative, data and fragment references
+ABSOLUTE_URL_RE = re.compile(r'^(?:[a-zA-Z][a-zA-Z0-9+.-]*:|/|#)')
+
+def absolute_css_url(ref, path):
+    """
+    Returns the URL a reference relative to the stylesheet at `path`
+    has from anywhere: under MEDIA_URL for files in MEDIA_ROOT, or
+    relative to BUNDLE_ROOT otherwise.
+    """
+    target = os.path.normpath(os.path.join(os.path.dirname(path), ref))
+    media_root = os.path.join(os.path.normpath(settings.MEDIA_ROOT), '')
+    if target.startswith(media_root):
+        return settings.MEDIA_URL + target[len(media_root):].replace(os.sep, '/')
+    return os.path.relpath(target, app_settings.BUNDLE_ROOT).replace(os.sep, '/')
+
+def rewrite_css_urls(content, path):
+    """
+    Rewrites the relative url() references of the stylesheet at `path`,
+    so they keep pointing to the same files from the bundle.
+    """
+    def rewrite(match):
+        quote, ref = match.groups()
+        ref = ref.strip()
+        if not ref or ABSOLUTE_URL_RE.match(ref):
+            return match.group(0)
+        return 'url(%s%s%s)' % (quote, absolute_css_url(ref, path), quote)
+    return CSS_URL_RE.sub(rewrite, content)
+
+def minify_css(content):
+    """
+    Removes comments and unneeded whitespace from a stylesheet, leaving
+    quoted strings untouched.
+    """
+    # Comments may contain quotes and strings comment delimiters
+    content = CSS_COMMENT_RE.sub(lambda match: match.group(1) or '', content)
+    parts = CSS_STRING_RE.split(content)
+    # Odd parts are the strings
+    for i in range(0, len(parts), 2):
+        part = CSS_SPACES_RE.sub(' ', parts[i])
+        parts[i] = CSS_PUNCTUATION_RE.sub(r'\1', part).replace(';}', '}')
+    return ''.join(parts).strip()
+
+def minify_js(content):
+    """
+    Removes indentation and blank lines from a javascript. Comments are
+    kept, since removing them safely requires parsing the script.
+    """
+    lines = [line.strip() for line in content.splitlines()]
+    return '\n'.join([line for line in lines if line])
+
+MINIFIERS = {
+    'css': minify_css,
+    'js': minify_js,
+}
+
+# Separators keeping each file's statements apart
+SEPARATORS = {
+    'css': '\n',
+    'js': ';\n',
+}
+
+
+class Bundler(object):
+    """
+    Concatenates files into content-hashed bundles under BUNDLE_ROOT.
+
+    Bundles are rebuilt only when the modification time or size of one
+    of their files changes. Missing files are left out. Relative url()
+    references of stylesheets are rewritten to work from the bundle.
+    """
+
+    def __init__(self):
+        self._bundles = {}
+        self._lock = threading.Lock()
+
+    def signature(self, paths):
+        signature = []
+        for path in paths:
+            stat = stat_cache.stat(path)
+            if stat is not None:
+                signature.append((path, stat.st_mtime, stat.st_size))
+        return tuple(signature)
+
+    def build(self, paths, name=None, minify=False):
+        """
+        Returns the URL of the bundle for a list of absolute paths with
+        the same extension, building it if needed.
+        """
+        ext = os.path.splitext(paths[0])[1][1:]
+        key = (tuple(paths), bool(minify))
+        signature = self.signature(paths)
+        bundle = self._bundles.get(key)
+        if bundle is not None and bundle[0] == signature:
+            return bundle[1]
+
+        contents = []
+        for path, mtime, size in signature:
+            f = open(path, 'rb')
+            try:
+                content = f.read()
+            finally:
+                f.close()
+            if ext == 'css':
+                content = rewrite_css_urls(content, path)
+            if minify and ext in MINIFIERS:
+                content = MINIFIERS[ext](content)
+            contents.append(content)
+        content = SEPARATORS.get(ext, '\n').join(contents)
+
+        # Name the bundle after its contents
+        if not name:
+            name = md5_constructor(smart_str(repr(key[0]))).hexdigest()[:8]
+        digest = md5_constructor(content).hexdigest()[:HASH_LENGTH]
+        filename = '%s.%s.%s' % (name, digest, ext)
+        path = os.path.join(app_settings.BUNDLE_ROOT, filename)
+        self.write(path, content)
+        if app_settings.PRECOMPRESS:
+            compressor.compress(path)
+
+        url = app_settings.BUNDLE_URL + filename
+        self._lock.acquire()
+        try:
+            self._bundles[key] = (signature, url)
+        finally:
+            self._lock.release()
+        return url
+
+    def write(self, path, content):
+        """
+        Writes a bundle atomically, unless it already exists.
+        """
+        if stat_cache.isfile(path):
+            return
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+        fd, tmp_path = tempfile.mkstemp(prefix='.', dir=dirname)
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+        stat_cache.invalidate(path)
+
+
+bundler = Bundler()
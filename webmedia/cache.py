@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import os
+import stat
+import threading
+import time
+
+from collections import OrderedDict
+from webmedia import app_settings
+
+MISSING = object()
+
+class LRUCache(object):
+    """
+    Bounded, thread-safe in-process cache with LRU eviction and
+    optional per-entry expiration.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            entry = self._data.pop(key, None)
+            if entry is not None and (entry[0] is None or entry[0] > time.time()):
+                # Reinsert as the most recently used
+                self._data[key] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return default
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, timeout=None):
+        expires = timeout and time.time() + timeout or None
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+            self.hits = self.misses = 0
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'ratio': total and float(self.hits) / total or 0.0,
+        }
+
+
+class StatCache(object):
+    """
+    Caches os.stat results (including missing files) for
+    WEBMEDIA_STAT_CACHE_TIMEOUT seconds.
+    """
+
+    def __init__(self, size=None):
+        self.cache = LRUCache(size or app_settings.STAT_CACHE_SIZE)
+
+    def _stat(self, path):
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
+
+    def stat(self, path):
+        """
+        Returns the stat result for a path or None if it doesn't exist.
+        """
+        timeout = app_settings.STAT_CACHE_TIMEOUT
+        if not timeout:
+            return self._stat(path)
+        result = self.cache.get(path, MISSING)
+        if result is MISSING:
+            result = self._stat(path)
+            self.cache.set(path, result, timeout)
+        return result
+
+    def isfile(self, path):
+        result = self.stat(path)
+        return result is not None and stat.S_ISREG(result.st_mode)
+
+    def getmtime(self, path):
+        result = self.stat(path)
+        if result is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return result.st_mtime
+
+    def invalidate(self, path=None):
+        """
+        Drops a path from the cache, or every path if none is given.
+        Call it after writing files outside of webmedia.
+        """
+        if path is None:
+            self.cache.clear()
+        else:
+            self.cache.delete(path)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+stat_cache = StatCache()
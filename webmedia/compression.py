@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import os
+import tempfile
+import threading
+
+from webmedia import app_settings
+from webmedia.cache import stat_cache
+
+try:
+    import brotli
+except ImportError:
+    # Only gzip files are written
+    brotli = None
+
+def write_gzip(f, content):
+    # Fixed mtime in the header, so unchanged files compress identically
+    gz = gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=f, mtime=0)
+    try:
+        gz.write(content)
+    finally:
+        gz.close()
+
+def write_brotli(f, content):
+    f.write(brotli.compress(content))
+
+def get_compressors():
+    compressors = [('.gz', write_gzip)]
+    if brotli is not None:
+        compressors.append(('.br', write_brotli))
+    return compressors
+
+
+class Compressor(object):
+    """
+    Writes precompressed copies of files (e.g. style.css.gz) for servers
+    like nginx's gzip_static. Compressed files get the modification time
+    of their source and are only written again when it changes.
+    """
+
+    def __init__(self):
+        # Modification times of the files already compressed
+        self._done = {}
+        self._lock = threading.Lock()
+
+    def compress(self, path, force=False):
+        """
+        Compresses a file if needed, returns the paths written.
+        """
+        stat = stat_cache.stat(path)
+        if stat is None or stat.st_size < app_settings.PRECOMPRESS_MIN_SIZE:
+            return []
+        if not force and self._done.get(path) == stat.st_mtime:
+            return []
+
+        written = []
+        content = None
+        for ext, write in get_compressors():
+            target = path + ext
+            target_stat = stat_cache.stat(target)
+            if not force and target_stat is not None and target_stat.st_mtime == stat.st_mtime:
+                continue
+            if content is None:
+                f = open(path, 'rb')
+                try:
+                    content = f.read()
+                finally:
+                    f.close()
+            self.write(target, content, write, stat.st_mtime)
+            written.append(target)
+
+        self._lock.acquire()
+        try:
+            self._done[path] = stat.st_mtime
+        finally:
+            self._lock.release()
+        return written
+
+    def write(self, path, content, write, mtime):
+        fd, tmp_path = tempfile.mkstemp(prefix='.', dir=os.path.dirname(path))
+        f = os.fdopen(fd, 'wb')
+        try:
+            write(f, content)
+        finally:
+            f.close()
+        os.chmod(tmp_path, 0o644)
+        os.utime(tmp_path, (mtime, mtime))
+        os.rename(tmp_path, path)
+        stat_cache.invalidate(path)
+
+
+compressor = Compressor()
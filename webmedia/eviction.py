@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.utils import simplejson
+from webmedia import app_settings
+from webmedia.cache import stat_cache
+from webmedia.locks import FileLock
+from webmedia.manifest import get_manifest
+from webmedia.naming import parse_src
+from webmedia.registry import registry
+from webmedia.remote import REMOTE_DIR, fetcher, is_cached_original
+from webmedia.workers import get_pool
+
+# Granularity in seconds of the access times histogram kept by sweeps
+HISTOGRAM_BUCKET = 3600
+
+class AccessTracker(object):
+    """
+    Records when thumbnails are used, in batches: accesses are kept in
+    memory and the access times written every THUMBNAIL_ACCESS_INTERVAL
+    seconds, keeping the modification times (used to detect changed
+    originals) untouched.
+
+    The paths touched by a thread between record() and recorded() are
+    also collected, so renders reused later (cached fragments,
+    prefetched results) can touch them again.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.flushed = time.time()
+        self._lock = threading.Lock()
+        self._recording = threading.local()
+
+    def record(self):
+        self._recording.paths = []
+
+    def recorded(self):
+        """
+        Returns the paths touched since record() and stops recording.
+        """
+        paths = getattr(self._recording, 'paths', None) or []
+        self._recording.paths = None
+        return tuple(paths)
+
+    def touch(self, path):
+        paths = getattr(self._recording, 'paths', None)
+        if paths is not None:
+            paths.append(path)
+        interval = app_settings.THUMBNAIL_ACCESS_INTERVAL
+        if interval is None:
+            return
+        now = time.time()
+        self._lock.acquire()
+        try:
+            self.pending[path] = now
+            if now - self.flushed < interval:
+                return
+            accesses, self.pending = self.pending, {}
+            self.flushed = now
+        finally:
+            self._lock.release()
+        self.write(accesses)
+        if app_settings.THUMBNAIL_GC_INTERVAL:
+            sweeper.schedule()
+
+    def write(self, accesses):
+        for path, atime in accesses.items():
+            try:
+                os.utime(path, (atime, os.stat(path).st_mtime))
+            except OSError:
+                # Removed meanwhile
+                pass
+
+
+class Collector(object):
+    """
+    Removes thumbnails whose original is gone and evicts the least
+    recently used ones while THUMBNAIL_ROOT is over `max_size` bytes.
+
+    Originals are looked up in the thumbnail manifest or guessed from
+    the filenames of mirrored thumbnails (hashed ones can only be
+    checked with the manifest). A thumbnail, its format variants and its
+    placeholder (files sharing its name but the extension) are evicted
+    together, as used when the last of them was. Downloaded remote
+    images are evicted like
+    thumbnails, taking the thumbnails made from them along on the next
+    pass. Hidden files (locks, temporary files) and files that don't look
+    like thumbnails are never removed.
+    """
+
+    def __init__(self, max_size=None, dry_run=False):
+        if max_size is None:
+            max_size = app_settings.THUMBNAIL_MAX_SIZE
+        self.root = app_settings.THUMBNAIL_ROOT
+        self.max_size = max_size
+        self.dry_run = dry_run
+        self.manifest = get_manifest()
+        self._recorded = (None, None)
+        registry.check()
+        self.extensions = [ext.lower() for ext, filetype in registry.extensions.items()
+                           if filetype == 'image']
+        self._listings = {}
+        self.results = {'files': 0, 'bytes': 0, 'orphans': 0, 'evicted': 0, 'freed': 0}
+
+    def walk(self, after=None):
+        """
+        Yields (relative dirname, filenames) in sorted order, starting
+        after the directory `after`.
+        """
+        cursor = None
+        if after is not None:
+            cursor = after and after.split('/') or []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirname = os.path.relpath(dirpath, self.root).replace(os.sep, '/')
+            if dirname == '.':
+                dirname = ''
+            key = dirname and dirname.split('/') or []
+            dirnames[:] = sorted([d for d in dirnames if not d.startswith('.') and (
+                cursor is None or key + [d] > cursor or cursor[:len(key) + 1] == key + [d])])
+            if cursor is not None and key <= cursor:
+                continue
+            yield dirname, sorted([f for f in filenames if not f.startswith('.')])
+
+    def recorded_original(self, src):
+        """
+        Returns the original of a thumbnail in the manifest, or None.
+        The last lookup is kept, since each file is checked a few times.
+        """
+        if self.manifest is None:
+            return None
+        if self._recorded[0] != src:
+            self._recorded = (src, self.manifest.original(src))
+        return self._recorded[1]
+
+    def original_root(self, src):
+        """
+        Returns the directory originals are relative to: THUMBNAIL_ROOT
+        for downloaded remote images, MEDIA_ROOT otherwise.
+        """
+        if src.startswith(REMOTE_DIR + '/'):
+            return self.root
+        return settings.MEDIA_ROOT
+
+    def listing(self, dirname, root=None):
+        """
+        Maps the lowercased names in a directory of `root` (MEDIA_ROOT
+        by default) to the actual names.
+        """
+        root = root or settings.MEDIA_ROOT
+        if (root, dirname) not in self._listings:
+            try:
+                names = os.listdir(os.path.join(root, dirname))
+            except OSError:
+                names = []
+            self._listings[root, dirname] = dict([(name.lower(), name) for name in names])
+        return self._listings[root, dirname]
+
+    def find_original(self, src):
+        """
+        Returns the original (relative to MEDIA_ROOT, or THUMBNAIL_ROOT
+        for remote images) of a thumbnail, or None if it's gone or
+        unknown.
+        """
+        original = self.recorded_original(src)
+        if original is not None:
+            if os.path.exists(os.path.join(self.original_root(original), original)):
+                return original
+            return None
+        naming, params = parse_src(src)
+        if naming != 'mirror':
+            return None
+        dirname = os.path.dirname(src)
+        listing = self.listing(dirname, self.original_root(src))
+        base = params['base'].lower()
+        # Prefer the original in the thumbnail's format
+        names = ['%s.%s' % (base, ext) for ext in [params['format']] + self.extensions]
+        if is_cached_original('%s/%s' % (dirname, base)):
+            # Downloaded from a URL without extension
+            names.append(base)
+        for name in names:
+            name = listing.get(name)
+            if name is not None:
+                return dirname and '%s/%s' % (dirname, name) or name
+        return None
+
+    def original_exists(self, src):
+        """
+        Returns False if `src` is a thumbnail whose original is gone.
+        """
+        if is_cached_original(src):
+            return True
+        if self.recorded_original(src) is None and parse_src(src)[0] != 'mirror':
+            # Can't be checked without the manifest
+            return True
+        return self.find_original(src) is not None
+
+    def is_thumbnail(self, src):
+        return (parse_src(src)[0] is not None or is_cached_original(src) or
+                self.recorded_original(src) is not None)
+
+    def files(self, dirname, filenames):
+        """
+        Yields the (src, path, stat) of the thumbnails in a directory.
+        """
+        for filename in filenames:
+            src = dirname and '%s/%s' % (dirname, filename) or filename
+            path = os.path.join(self.root, src)
+            if path == app_settings.THUMBNAIL_MANIFEST or not self.is_thumbnail(src):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            self.results['files'] += 1
+            self.results['bytes'] += stat.st_size
+            yield src, path, stat
+
+    def groups(self, dirname, filenames):
+        """
+        Removes the orphan thumbnails of a directory and yields the
+        (atime, size, files) of the others, grouped with their variants.
+        """
+        groups = {}
+        for src, path, stat in self.files(dirname, filenames):
+            if not self.original_exists(src):
+                self.remove(src, path, stat.st_size, 'orphans')
+            else:
+                groups.setdefault(os.path.splitext(src)[0], []).append((src, path, stat))
+        for base in sorted(groups):
+            files = groups[base]
+            yield (max([stat.st_atime for src, path, stat in files]),
+                   sum([stat.st_size for src, path, stat in files]),
+                   [(src, path, stat.st_size) for src, path, stat in files])
+
+    def evict(self, files):
+        for src, path, size in files:
+            self.remove(src, path, size, 'evicted')
+
+    def remove(self, src, path, size, reason):
+        self.results[reason] += 1
+        self.results['freed'] += size
+        if self.dry_run:
+            return
+        try:
+            os.remove(path)
+        except OSError:
+            return
+        stat_cache.invalidate(path)
+        if is_cached_original(src):
+            try:
+                os.remove(fetcher.meta_path(path))
+            except OSError:
+                pass
+        if self.manifest is not None:
+            self.manifest.delete(src)
+            self._recorded = (None, None)
+
+    def collect(self):
+        """
+        Sweeps the whole THUMBNAIL_ROOT, returns the results.
+        """
+        used = []
+        total = 0
+        for dirname, filenames in self.walk():
+            for atime, size, files in self.groups(dirname, filenames):
+                used.append((atime, size, files))
+                total += size
+
+        if self.max_size and total > self.max_size:
+            used.sort()
+            for atime, size, files in used:
+                if total <= self.max_size:
+                    break
+                self.evict(files)
+                total -= size
+        return self.results
+
+    def sweep(self, state, batch):
+        """
+        Sweeps the directories after state['cursor'] until `batch` files
+        have been examined, updating `state`.
+
+        Files used before state['cutoff'] are evicted. When the whole
+        tree has been swept, the cutoff is computed again from the
+        histogram of access times, so evicting everything older brings
+        the total size within the budget.
+        """
+        cutoff = state.get('cutoff')
+        histogram = state.setdefault('histogram', {})
+        examined = 0
+        for dirname, filenames in self.walk(after=state.get('cursor')):
+            for atime, size, files in self.groups(dirname, filenames):
+                examined += len(files)
+                if cutoff and atime < cutoff:
+                    self.evict(files)
+                else:
+                    bucket = str(int(atime // HISTOGRAM_BUCKET))
+                    histogram[bucket] = histogram.get(bucket, 0) + size
+            state['cursor'] = dirname
+            if examined >= batch:
+                return state
+
+        state['cutoff'] = self.cutoff(histogram)
+        state['cursor'] = None
+        state['histogram'] = {}
+        return state
+
+    def cutoff(self, histogram):
+        """
+        Returns the access time before which thumbnails must be evicted
+        to fit the budget, or None.
+        """
+        total = sum(histogram.values())
+        if not self.max_size or total <= self.max_size:
+            return None
+        for bucket in sorted(histogram, key=int):
+            total -= histogram[bucket]
+            if total <= self.max_size:
+                return (int(bucket) + 1) * HISTOGRAM_BUCKET
+        return None
+
+
+class Sweeper(object):
+    """
+    Runs incremental Collector sweeps in a worker thread at most every
+    THUMBNAIL_GC_INTERVAL seconds, in one process at a time. The sweep
+    state is kept in THUMBNAIL_ROOT/.gc.json.
+    """
+
+    def __init__(self):
+        self.scheduled = 0
+
+    @property
+    def state_path(self):
+        return os.path.join(app_settings.THUMBNAIL_ROOT, '.gc.json')
+
+    def schedule(self):
+        now = time.time()
+        if now - self.scheduled < app_settings.THUMBNAIL_GC_INTERVAL:
+            return False
+        self.scheduled = now
+        return get_pool().submit('webmedia-gc', self.run)
+
+    def load(self):
+        try:
+            f = open(self.state_path)
+        except IOError:
+            return {}
+        try:
+            try:
+                return simplejson.load(f)
+            except ValueError:
+                return {}
+        finally:
+            f.close()
+
+    def save(self, state):
+        fd, tmp_path = tempfile.mkstemp(dir=app_settings.THUMBNAIL_ROOT, prefix='.gc.')
+        f = os.fdopen(fd, 'w')
+        try:
+            simplejson.dump(state, f)
+        finally:
+            f.close()
+        os.rename(tmp_path, self.state_path)
+
+    def run(self, force=False):
+        """
+        Runs a sweep step, returns False if another process is sweeping
+        or the last step is too recent.
+        """
+        lock = FileLock(os.path.join(app_settings.THUMBNAIL_ROOT, '.locks', 'gc.lock'))
+        if not lock.acquire(blocking=False):
+            return False
+        try:
+            state = self.load()
+            if not force and time.time() - state.get('time', 0) < app_settings.THUMBNAIL_GC_INTERVAL:
+                return False
+            Collector().sweep(state, app_settings.THUMBNAIL_GC_BATCH)
+            state['time'] = time.time()
+            self.save(state)
+            return True
+        finally:
+            lock.release()
+
+
+tracker = AccessTracker()
+sweeper = Sweeper()
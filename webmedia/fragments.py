@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
+from webmedia import app_settings
+from webmedia.cache import LRUCache
+from webmedia.registry import registry
+
+def stable_repr(value):
+    """
+    Returns a representation of a setting that is the same in every
+    process: dicts and sets are sorted, callables named by their path.
+    """
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join(['%s: %s' % (stable_repr(k), stable_repr(v))
+                                   for k, v in sorted(value.items())])
+    if isinstance(value, (set, frozenset)):
+        return 'set([%s])' % ', '.join(sorted([stable_repr(v) for v in value]))
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join([stable_repr(v) for v in value])
+    if callable(value):
+        return '%s.%s' % (getattr(value, '__module__', None), getattr(value, '__name__', None))
+    return repr(value)
+
+_settings_key = (None, None)
+_settings_version = 0
+
+def settings_changed():
+    """
+    Makes settings_key() hash the settings again. Must be called after
+    replacing webmedia settings at runtime, except the ones read by the
+    registry, whose rebuilds are detected.
+    """
+    global _settings_version
+    _settings_version += 1
+
+def settings_key():
+    """
+    Returns a hash of the values of the webmedia settings and of the
+    registered filetypes and processors, the same in every process.
+    It's only computed again when the registry is rebuilt or
+    settings_changed() is called.
+    """
+    global _settings_key
+    registry.check()
+    version = (registry.generation, _settings_version)
+    if _settings_key[0] != version:
+        items = sorted([(name, value) for name, value in vars(app_settings).items()
+                        if name.isupper()])
+        raw = stable_repr((items, registry.registrations()))
+        _settings_key = (version, md5_constructor(raw).hexdigest())
+    return _settings_key[1]
+
+
+class FragmentCache(object):
+    """
+    Two level cache for rendered embed tags: an in-process LRU in front
+    of Django's cache framework.
+    """
+
+    def __init__(self, size=None):
+        self.local = LRUCache(size or app_settings.EMBED_CACHE_SIZE)
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, src, attrs, version):
+        """
+        Builds a cache key from the tag arguments, the source file
+        version and the current settings.
+        """
+        attrs = sorted((smart_str(k), smart_str(v)) for k, v in attrs.items())
+        raw = repr((smart_str(src), attrs, version, settings_key()))
+        return 'webmedia:embed:%s' % md5_constructor(raw).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the (html, paths) of a cached fragment, `paths` being the
+        files it was rendered from, or None.
+        """
+        entry = self.local.get(key)
+        if entry is not None:
+            return entry
+        entry = cache.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.local.set(key, entry, app_settings.EMBED_CACHE_TIMEOUT)
+        return entry
+
+    def set(self, key, html, paths=()):
+        entry = (html, tuple(paths))
+        self.local.set(key, entry, app_settings.EMBED_CACHE_TIMEOUT)
+        cache.set(key, entry, app_settings.EMBED_CACHE_TIMEOUT)
+
+    def clear(self):
+        """
+        Clears the in-process cache, entries in Django's cache expire.
+        """
+        self.local.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        local = self.local.stats()
+        shared_total = self.hits + self.misses
+        total = local['hits'] + local['misses']
+        return {
+            'local': local,
+            'shared': {
+                'hits': self.hits,
+                'misses': self.misses,
+                'ratio': shared_total and float(self.hits) / shared_total or 0.0,
+            },
+            'ratio': total and float(local['hits'] + self.hits) / total or 0.0,
+        }
+
+
+fragment_cache = FragmentCache()
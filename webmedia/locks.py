@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
+from webmedia import app_settings
+
+try:
+    import fcntl
+except ImportError:
+    # Only in-process locking is available
+    fcntl = None
+
+# Number of lock files shared by all keys
+LOCK_STRIPES = 256
+
+class FileLock(object):
+    """
+    Exclusive advisory lock on a file, shared between processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def acquire(self, blocking=True):
+        if fcntl is None:
+            return True
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Created by another process
+                pass
+        self.file = open(self.path, 'a')
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self.file.fileno(), flags)
+        except IOError:
+            self.file.close()
+            self.file = None
+            return False
+        return True
+
+    def release(self):
+        if self.file is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+class SingleFlight(object):
+    """
+    Serializes work on a key (e.g. a thumbnail path) between the threads
+    of a process with a per-key lock, and between processes with a lock
+    file under THUMBNAIL_ROOT/.locks.
+
+    Callers should check again whether the work is still needed after
+    acquiring the lock, and must not hold two of them at once since
+    keys share lock files.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        stripe = int(md5_constructor(smart_str(key)).hexdigest()[:8], 16) % LOCK_STRIPES
+        self.file_lock = FileLock(os.path.join(
+            app_settings.THUMBNAIL_ROOT, '.locks', '%03d.lock' % stripe))
+
+    def _thread_lock(self, delta):
+        _thread_locks_lock.acquire()
+        try:
+            entry = _thread_locks.setdefault(self.key, [threading.Lock(), 0])
+            entry[1] += delta
+            if entry[1] <= 0:
+                del _thread_locks[self.key]
+            return entry[0]
+        finally:
+            _thread_locks_lock.release()
+
+    def acquire(self, blocking=True):
+        lock = self._thread_lock(1)
+        if not lock.acquire(blocking):
+            self._thread_lock(-1)
+            return False
+        if not self.file_lock.acquire(blocking):
+            lock.release()
+            self._thread_lock(-1)
+            return False
+        return True
+
+    def release(self):
+        self.file_lock.release()
+        self._thread_lock(-1).release()
+
+
+class PixelBudget(object):
+    """
+    Counting semaphore over a number of pixels instead of slots, so
+    decoding big images waits until enough smaller ones are done.
+    Requests over the whole budget are reduced to it, running alone.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self.condition = threading.Condition(threading.Lock())
+
+    def acquire(self, pixels, timeout=None):
+        """
+        Reserves `pixels`, returns False if they couldn't be reserved
+        within `timeout` seconds.
+        """
+        pixels = min(pixels, self.size)
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self.condition.acquire()
+        try:
+            while self.used + pixels > self.size:
+                if timeout is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+            self.used += pixels
+            return True
+        finally:
+            self.condition.release()
+
+    def release(self, pixels):
+        self.condition.acquire()
+        try:
+            self.used -= min(pixels, self.size)
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+
+_budget = None
+_budget_lock = threading.Lock()
+
+def get_budget():
+    """
+    Returns the process' budget of IMAGE_MEMORY_BUDGET pixels, None when
+    decoding isn't limited.
+    """
+    global _budget
+    size = app_settings.IMAGE_MEMORY_BUDGET
+    if not size:
+        return None
+    if _budget is None or _budget.size != size:
+        _budget_lock.acquire()
+        try:
+            if _budget is None or _budget.size != size:
+                _budget = PixelBudget(size)
+        finally:
+            _budget_lock.release()
+    return _budget
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from webmedia import app_settings
+from webmedia.compression import compressor
+from webmedia.registry import registry
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--force', action='store_true', dest='force', default=False,
+            help='Compress files even if their compressed copies are up to date.'),
+    )
+    help = ('Writes .gz (and .br) copies of the WEBMEDIA_PRECOMPRESS_FILETYPES '
+            'files under MEDIA_ROOT whose copies are missing or outdated.')
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        files = written = 0
+        for dirpath, dirnames, filenames in os.walk(settings.MEDIA_ROOT):
+            for filename in filenames:
+                ext = os.path.splitext(filename)[1][1:]
+                if registry.get_filetype(ext) not in app_settings.PRECOMPRESS_FILETYPES:
+                    continue
+                files += 1
+                paths = compressor.compress(os.path.join(dirpath, filename), force=options.get('force'))
+                written += len(paths)
+                if verbosity > 1:
+                    for path in paths:
+                        sys.stdout.write('%s\n' % path)
+        if verbosity:
+            sys.stdout.write('Checked %d files, wrote %d compressed files.\n' % (files, written))
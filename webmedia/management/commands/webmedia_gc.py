@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from webmedia.eviction import Collector
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--max-size', type='int', dest='max_size', default=None,
+            help='Maximum size in bytes of the thumbnails, defaults to WEBMEDIA_THUMBNAIL_MAX_SIZE.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only report what would be removed.'),
+    )
+    help = ('Removes the thumbnails whose original is gone and evicts the least '
+            'recently used ones while the thumbnails take more than the maximum size.')
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        results = Collector(max_size=options.get('max_size'),
+                            dry_run=options.get('dry_run')).collect()
+        if verbosity:
+            sys.stdout.write('Examined %(files)d thumbnails (%(bytes)d bytes), removed '
+                             '%(orphans)d orphans and evicted %(evicted)d thumbnails, '
+                             'freeing %(freed)d bytes.\n' % results)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from webmedia import app_settings
+from webmedia.registry import registry
+from webmedia.versioning import file_hash, get_asset_manifest, hashed_name, is_hashed_name
+
+def find_assets():
+    """
+    Yields the absolute paths of the versioned files under MEDIA_ROOT,
+    outside THUMBNAIL_ROOT and skipping hashed copies.
+    """
+    thumb_root = os.path.join(app_settings.THUMBNAIL_ROOT, '')
+    for dirpath, dirnames, filenames in os.walk(settings.MEDIA_ROOT):
+        if os.path.join(dirpath, '').startswith(thumb_root):
+            dirnames[:] = []
+            continue
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            ext = os.path.splitext(filename)[1][1:]
+            if (registry.get_filetype(ext) in app_settings.VERSIONED_FILETYPES
+                    and not is_hashed_name(path)):
+                yield path
+
+
+class Command(NoArgsCommand):
+    help = ('Hashes the contents of the files under MEDIA_ROOT into the asset '
+            'manifest used by WEBMEDIA_VERSIONING = "hash".')
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        root = os.path.join(settings.MEDIA_ROOT, '')
+        manifest = get_asset_manifest()
+
+        assets = {}
+        for path in find_assets():
+            digest = file_hash(path)
+            assets[path[len(root):].replace(os.sep, '/')] = digest
+            if app_settings.HASHED_FILENAMES:
+                hashed_path = hashed_name(path, digest)
+                if not os.path.isfile(hashed_path):
+                    shutil.copy2(path, hashed_path)
+
+        changed = len(set(assets.items()) - set(manifest.assets.items()))
+        manifest.save(assets)
+        if verbosity:
+            sys.stdout.write('Hashed %d files (%d changed) into %s.\n' % (
+                len(assets), changed, manifest.path))
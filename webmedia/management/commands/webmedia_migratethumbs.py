@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from webmedia import app_settings
+from webmedia.cache import stat_cache
+from webmedia.eviction import Collector
+from webmedia.naming import METHODS, get_naming, parse_src
+from webmedia.processors.image import Thumbnail
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only list the thumbnails that would be moved.'),
+    )
+    help = ('Moves the thumbnails named after their originals (the mirror naming) to '
+            'the hashed, sharded layout. Mirrored names don\'t record the quality, so '
+            'thumbnails are assumed to match the current WEBMEDIA_IMAGE_QUALITY.')
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        dry_run = options.get('dry_run')
+        collector = Collector()
+        naming = get_naming('hashed')
+        moved = skipped = 0
+        for dirname, filenames in collector.walk():
+            for filename in filenames:
+                src = dirname and '%s/%s' % (dirname, filename) or filename
+                target = self.hashed_src(collector, naming, src)
+                if target is None:
+                    if parse_src(src)[0] == 'mirror':
+                        skipped += 1
+                        if verbosity > 1:
+                            sys.stdout.write('Skipped %s, its original is gone\n' % src)
+                    continue
+                moved += 1
+                if verbosity > 1:
+                    sys.stdout.write('%s -> %s\n' % (src, target))
+                if not dry_run:
+                    self.move(collector, src, target)
+        if verbosity:
+            sys.stdout.write('Moved %d thumbnails, skipped %d without original.\n' % (moved, skipped))
+
+    def hashed_src(self, collector, naming, src):
+        """
+        Returns the hashed src of a mirrored thumbnail (or format
+        variant), None if it isn't one or its original is gone.
+        """
+        kind, params = parse_src(src)
+        if kind != 'mirror' or params['method'] not in METHODS:
+            return None
+        # Variants are named after their thumbnail
+        main_src = '%s.%s' % (os.path.splitext(src)[0], params['format'])
+        original = collector.find_original(main_src)
+        if original is None:
+            return None
+        attrs = dict([(att, params[att]) for att in ('width', 'height') if params[att]])
+        thumb = Thumbnail(original, method=METHODS[params['method']], format=params['format'],
+                          profile=params['profile'] or 'default', **attrs)
+        return '%s.%s' % (os.path.splitext(naming(thumb))[0], params['ext'])
+
+    def move(self, collector, src, target):
+        path = os.path.join(app_settings.THUMBNAIL_ROOT, src)
+        target_path = os.path.join(app_settings.THUMBNAIL_ROOT, target)
+        dirname = os.path.dirname(target_path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        os.rename(path, target_path)
+        stat_cache.invalidate(path)
+        stat_cache.invalidate(target_path)
+        # The entry under the new src is recorded on the next render
+        if collector.manifest is not None:
+            collector.manifest.delete(src)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import glob
+import os
+import sys
+import time
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from webmedia import app_settings
+from webmedia.processors.image import Thumbnail
+from webmedia.registry import registry
+
+def find_images(patterns):
+    """
+    Yields image paths relative to MEDIA_ROOT, matching the given glob
+    patterns or walking MEDIA_ROOT outside THUMBNAIL_ROOT.
+    """
+    root = os.path.join(settings.MEDIA_ROOT, '')
+    thumb_root = os.path.join(app_settings.THUMBNAIL_ROOT, '')
+    if patterns:
+        paths = []
+        for pattern in patterns:
+            paths.extend(glob.glob(os.path.join(root, pattern)))
+    else:
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            if os.path.join(dirpath, '').startswith(thumb_root):
+                dirnames[:] = []
+                continue
+            dirnames.sort()
+            paths.extend(os.path.join(dirpath, f) for f in sorted(filenames))
+
+    for path in paths:
+        ext = os.path.splitext(path)[1][1:]
+        if path.startswith(root) and registry.get_filetype(ext) == 'image':
+            yield path[len(root):]
+
+def generate(job):
+    """
+    Generates a single thumbnail, returns (job, bytes written, error).
+    """
+    src, preset, attrs = job
+    try:
+        thumb = Thumbnail(src, **attrs)
+        if thumb.generate():
+            return job, os.path.getsize(thumb.path), None
+        return job, 0, None
+    except Exception as e:
+        return job, 0, '%s: %s' % (e.__class__.__name__, e)
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', dest='processes', default=None,
+            help='Number of worker processes, defaults to the number of CPUs.'),
+        make_option('--preset', action='append', dest='presets', default=None,
+            help='Only generate the given preset, can be repeated.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only list the thumbnails that would be generated.'),
+    )
+    help = ('Generates the thumbnails declared in WEBMEDIA_THUMBNAIL_PRESETS for the '
+            'images under MEDIA_ROOT, skipping the ones that are up to date.')
+    args = '[glob ...]'
+
+    def handle(self, *patterns, **options):
+        verbosity = int(options.get('verbosity', 1))
+        presets = app_settings.THUMBNAIL_PRESETS
+        if options.get('presets'):
+            unknown = set(options['presets']) - set(presets)
+            if unknown:
+                raise CommandError('Unknown presets: %s' % ', '.join(sorted(unknown)))
+            presets = dict((name, presets[name]) for name in options['presets'])
+        if not presets:
+            raise CommandError('No thumbnail presets, set WEBMEDIA_THUMBNAIL_PRESETS.')
+
+        # Up to date thumbnails (e.g. from an interrupted run) are skipped
+        # here; thumbnails are renamed into place so they're never partial
+        jobs = []
+        skipped = 0
+        for src in find_images(patterns):
+            for name in sorted(presets):
+                attrs = dict((str(k), v) for k, v in presets[name].items())
+                if Thumbnail(src, **dict(attrs)).needs_generate():
+                    jobs.append((src, name, attrs))
+                else:
+                    skipped += 1
+
+        if verbosity:
+            sys.stdout.write('%d thumbnails to generate, %d up to date.\n' % (len(jobs), skipped))
+        if options.get('dry_run'):
+            if verbosity:
+                for src, name, attrs in jobs:
+                    sys.stdout.write('%s [%s]\n' % (src, name))
+            return
+
+        processes = options.get('processes')
+        if processes == 1:
+            pool = None
+            results = (generate(job) for job in jobs)
+        else:
+            pool = Pool(processes)
+            results = pool.imap_unordered(generate, jobs)
+
+        start = time.time()
+        written = errors = 0
+        try:
+            for done, (job, size, error) in enumerate(results):
+                written += size
+                if error:
+                    errors += 1
+                    sys.stderr.write('%s [%s]: %s\n' % (job[0], job[1], error))
+                if verbosity:
+                    elapsed = time.time() - start
+                    sys.stdout.write('\r%d/%d thumbnails, %.1f/s' % (
+                        done + 1, len(jobs), (done + 1) / max(elapsed, 0.001)))
+                    sys.stdout.flush()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if verbosity:
+            elapsed = max(time.time() - start, 0.001)
+            sys.stdout.write('\nGenerated %d thumbnails (%d errors) in %.1fs, '
+                             '%.1f thumbnails/s, %.1f KB written.\n' % (
+                len(jobs) - errors, errors, elapsed, len(jobs) / elapsed, written / 1024.0))
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import threading
+
+from webmedia import app_settings
+
+class ThumbnailManifest(object):
+    """
+    Persistent map of generated thumbnails, stored in a SQLite database.
+
+    Each thumbnail src (which encodes the resize parameters) is mapped
+    to the mtime and size of its original and to the final dimensions,
+    so existing thumbnails can be used without touching the thumbnail
+    file or decoding it. Entries are only valid while the original's
+    mtime and size match. The manifest is a cache: database errors are
+    treated as misses.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS thumbnails ('
+                'src TEXT PRIMARY KEY, original TEXT, mtime REAL, size INTEGER, '
+                'width INTEGER, height INTEGER)')
+            connection.commit()
+            self._local.connection = connection
+        return connection
+
+    def get(self, src, mtime, size):
+        """
+        Returns the (width, height) of a thumbnail if its entry matches
+        the original's mtime and size, or None.
+        """
+        try:
+            row = self.connection.execute(
+                'SELECT width, height FROM thumbnails '
+                'WHERE src = ? AND mtime = ? AND size = ?',
+                (src, mtime, size)).fetchone()
+        except sqlite3.Error:
+            return None
+        return row and tuple(row) or None
+
+    def set(self, src, original, mtime, size, width, height):
+        try:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?, ?, ?, ?)',
+                (src, original, mtime, size, width, height))
+            self.connection.commit()
+        except sqlite3.Error:
+            pass
+
+    def delete(self, src):
+        try:
+            self.connection.execute('DELETE FROM thumbnails WHERE src = ?', (src,))
+            self.connection.commit()
+        except sqlite3.Error:
+            pass
+
+    def original(self, src):
+        """
+        Returns the original recorded for a thumbnail src, or None.
+        """
+        try:
+            row = self.connection.execute(
+                'SELECT original FROM thumbnails WHERE src = ?', (src,)).fetchone()
+        except sqlite3.Error:
+            return None
+        return row and row[0] or None
+
+    def items(self):
+        """
+        Returns (src, original) pairs for every entry.
+        """
+        try:
+            return self.connection.execute(
+                'SELECT src, original FROM thumbnails').fetchall()
+        except sqlite3.Error:
+            return []
+
+
+_manifests = {}
+
+def get_manifest():
+    """
+    Returns the manifest for WEBMEDIA_THUMBNAIL_MANIFEST or None if
+    it's disabled.
+    """
+    path = app_settings.THUMBNAIL_MANIFEST
+    if not path:
+        return None
+    if path not in _manifests:
+        _manifests[path] = ThumbnailManifest(path)
+    return _manifests[path]
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
+from webmedia import app_settings
+
+# <path>/<base>_<format>__w<width>_h<height>_m<method>[_p<profile>].<ext>,
+# variants only change the extension
+MIRROR_NAME = re.compile(r'^(?P<base>.+)_(?P<format>[a-z0-9]+)_(?:_w(?P<width>\d+))?(?:_h(?P<height>\d+))?'
+                         r'_m(?P<method>[a-z])(?:_p(?P<profile>\w+))?\.(?P<ext>[a-z0-9]+)$')
+# <shards>/<base>_<digest>.<ext>
+HASHED_NAME = re.compile(r'^(?P<base>.+)_(?P<digest>[0-9a-f]{16})\.(?P<ext>[a-z0-9]+)$')
+
+METHODS = {'c': 'crop', 'f': 'fit'}
+
+def mirror_src(thumb):
+    """
+    Mirrors the original's directory, encoding the dimensions, resize
+    method and profile in the filename.
+    """
+    # Get path, filename and extension
+    path, filename = os.path.split(thumb.original_src)
+    base, ext = os.path.splitext(filename)
+    ext = ext[1:]
+
+    # Fix paths to end with '/'
+    if path:
+        path += '/'
+
+    flat_attrs = ''
+    if thumb.attrs:
+        # Flatten attributes to use in the filename
+        flat_attrs = '_'
+        # Flatten dimensions
+        for att in ['width', 'height']:
+            if thumb.attrs.has_key(att):
+                flat_attrs += '_%s%s' % (att[0], thumb.attrs[att])
+        # Flatten resize method
+        flat_attrs += '_%s%s' % ('m', thumb.method[0])
+        # Flatten encoding profile
+        if thumb.profile != 'default':
+            flat_attrs += '_%s%s' % ('p', thumb.profile)
+
+    return '%(path)s%(base)s_%(ext)s%(flat_attrs)s.%(ext)s' % {
+        'path': path,
+        'base': base,
+        'flat_attrs': flat_attrs,
+        'ext': thumb.format.lower(),
+    }
+
+def thumbnail_digest(thumb):
+    """
+    Returns a hash of everything affecting a thumbnail's output.
+    """
+    params = [
+        ('original', thumb.original_src),
+        ('width', thumb.attrs.get('width')),
+        ('height', thumb.attrs.get('height')),
+        ('method', thumb.method),
+        ('format', thumb.format),
+        ('quality', thumb.quality),
+        ('options', sorted(thumb.options.items())),
+        ('fast_decode', app_settings.IMAGE_FAST_DECODE),
+        ('fast_resample_size', app_settings.IMAGE_FAST_RESAMPLE_SIZE),
+    ]
+    key = '\n'.join(['%s=%s' % (name, smart_str(value)) for name, value in params])
+    return md5_constructor(key).hexdigest()
+
+def hashed_src(thumb):
+    """
+    Names thumbnails after a hash of their parameters, in a directory
+    tree of THUMBNAIL_SHARD_DEPTH levels of THUMBNAIL_SHARD_WIDTH hex
+    digits taken from the hash, e.g. 3f/a2/logo_3fa2b4c5d6e7f809.png.
+    """
+    digest = thumbnail_digest(thumb)
+    width = app_settings.THUMBNAIL_SHARD_WIDTH
+    shards = [digest[i * width:(i + 1) * width] for i in range(app_settings.THUMBNAIL_SHARD_DEPTH)]
+    base = os.path.splitext(os.path.basename(thumb.original_src))[0]
+    shards.append('%s_%s.%s' % (base, digest[:16], thumb.format.lower()))
+    return '/'.join(shards)
+
+NAMINGS = {
+    'mirror': mirror_src,
+    'hashed': hashed_src,
+}
+
+def get_naming(name=None):
+    """
+    Returns the function naming thumbnails for a THUMBNAIL_NAMING value.
+    """
+    return NAMINGS[name or app_settings.THUMBNAIL_NAMING]
+
+def parse_src(src):
+    """
+    Returns the naming and the parameters (a dict of the regular
+    expression groups) of a thumbnail src, or (None, None).
+    """
+    dirname, filename = os.path.split(src)
+    match = MIRROR_NAME.match(filename)
+    if match is not None:
+        return 'mirror', match.groupdict()
+    match = HASHED_NAME.match(filename)
+    depth = dirname and len(dirname.split('/')) or 0
+    if match is not None and depth == app_settings.THUMBNAIL_SHARD_DEPTH:
+        return 'hashed', match.groupdict()
+    return None, None
@@ -1,14 +1,124 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from PIL import Image, ImageFile
+from PIL import Image, ImageFile, ImageFilter
+from cStringIO import StringIO
 from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.utils.encoding import smart_str
+from django.utils.http import urlencode, urlquote
 from webmedia import app_settings
+from webmedia.cache import LRUCache, stat_cache
+from webmedia.eviction import tracker
+from webmedia.locks import SingleFlight, get_budget
+from webmedia.manifest import get_manifest
+from webmedia.naming import get_naming
+from webmedia.remote import RemoteError, fetcher
+from webmedia.signing import signature, verify
+from webmedia.stats import instrumented, stats
+from webmedia.workers import get_pool
+import base64
+import logging
+import math
 import os
+import re
+import tempfile
+
+try:
+    from PIL import ImageCms
+except ImportError:
+    # ICC profiles can't be converted to sRGB
+    ImageCms = None
+
+logger = logging.getLogger('webmedia')
 
 # JPEG Fix
 ImageFile.MAXBLOCK = 1000000
 
+# EXIF orientation tag and the transpositions that undo each orientation
+EXIF_ORIENTATION = 0x0112
+ORIENTATIONS = {
+    2: (Image.FLIP_LEFT_RIGHT,),
+    3: (Image.ROTATE_180,),
+    4: (Image.FLIP_TOP_BOTTOM,),
+    5: (Image.ROTATE_90, Image.FLIP_TOP_BOTTOM),
+    6: (Image.ROTATE_270,),
+    7: (Image.ROTATE_270, Image.FLIP_TOP_BOTTOM),
+    8: (Image.ROTATE_90,),
+}
+
+MIMETYPES = {
+    'JPG': 'image/jpeg',
+    'GIF': 'image/gif',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+}
+
+class ImageTooLarge(Exception):
+    """
+    Raised when decoding an original would exceed the memory limits.
+    `temporary` is set when the memory budget was busy.
+    """
+
+    def __init__(self, message, temporary=False):
+        Exception.__init__(self, message)
+        self.temporary = temporary
+
+def get_orientation(image):
+    """
+    Returns the EXIF orientation of an opened image, 1 if unknown.
+    """
+    try:
+        exif = image._getexif()
+    except Exception:
+        # Not a JPEG or broken EXIF data
+        return 1
+    return exif and exif.get(EXIF_ORIENTATION) or 1
+
+# Dimensions of the originals and placeholder data URIs, by path and mtime
+_sizes = LRUCache(app_settings.IMAGE_DIMENSIONS_CACHE_SIZE)
+_placeholders = LRUCache(app_settings.IMAGE_DIMENSIONS_CACHE_SIZE)
+
+def image_size(path):
+    """
+    Returns the displayed dimensions of an image, read from its header
+    and cached while the file doesn't change, or None.
+    """
+    stat = stat_cache.stat(path)
+    if stat is None:
+        return None
+    key = (path, stat.st_mtime, stat.st_size)
+    size = _sizes.get(key)
+    if size is None:
+        try:
+            image = Image.open(path)
+        except IOError:
+            return None
+        size = image.size
+        # Browsers apply the EXIF orientation
+        if get_orientation(image) >= 5:
+            size = size[::-1]
+        _sizes.set(key, size)
+    return size
+
+def get_quality(format):
+    """
+    Returns the IMAGE_QUALITY setting for a format.
+    """
+    quality = app_settings.IMAGE_QUALITY
+    if isinstance(quality, dict):
+        return quality.get(format, quality.get('default', 80))
+    return quality
+
+def get_profile(format):
+    """
+    Returns the IMAGE_PROFILE setting for a format.
+    """
+    profile = app_settings.IMAGE_PROFILE
+    if isinstance(profile, dict):
+        return profile.get(format, profile.get('default', 'default'))
+    return profile
+
 class Thumbnail(object):
 
     CROP = 'crop'
@@ -23,11 +133,18 @@ class Thumbnail(object):
         self.original_src = original_src
 
         self.method = attrs.pop('method', app_settings.IMAGE_RESIZE_METHOD)
-        self.quality = attrs.pop('quality', app_settings.IMAGE_QUALITY)
         self.format = self.fix_format(attrs.pop('format', None))
+        self.quality = attrs.pop('quality', None) or get_quality(self.format)
+        self.profile = attrs.pop('profile', None) or get_profile(self.format)
+        self.options = app_settings.IMAGE_PROFILES.get(self.profile, {})
 
         self.attrs = attrs
 
+        # An already decoded image to use instead of opening the original,
+        # and the EXIF orientation still to be applied to it
+        self.source = None
+        self.source_orientation = 1
+
         self.src = self.make_src()
 
     def fix_format(self, format):
@@ -45,33 +162,11 @@ class Thumbnail(object):
         return format
 
     def make_src(self):
-        # Get path, filename and extension
-        path, filename = os.path.split(self.original_src)
-        base, ext = os.path.splitext(filename)
-        ext = ext[1:]
-
-        # Fix paths to end with '/'
-        if path:
-            path += '/'
-
-        flat_attrs = ''
-        if self.attrs:
-            filename = filename.replace('.', '_')
-            # Flatten attributes to use in the filename
-            flat_attrs = '_'
-            # Flatten dimensions
-            for att in ['width', 'height']:
-                if self.attrs.has_key(att):
-                    flat_attrs += '_%s%s' % (att[0], self.attrs[att])
-            # Flatten resize method
-            flat_attrs += '_%s%s' % ('m', self.method[0])
-
-        return '%(path)s%(base)s_%(ext)s%(flat_attrs)s.%(ext)s' % {
-            'path': path,
-            'base': base,
-            'flat_attrs': flat_attrs,
-            'ext': self.format.lower(),
-        }
+        """
+        Returns the thumbnail path relative to THUMBNAIL_ROOT, named by
+        the THUMBNAIL_NAMING strategy.
+        """
+        return get_naming()(self)
 
     @property
     def path(self):
@@ -87,8 +182,19 @@ class Thumbnail(object):
 
     def _get_image(self):
         if not hasattr(self, '_image'):
-            self._image = Image.open(self.original_path)
-            size = self._image.size
+            if self.source is not None:
+                self._image = self.source
+            else:
+                self._image = Image.open(self.original_path)
+            self._original_size = size = self._image.size
+            # Orientation is applied when stripping EXIF data
+            self._orientation = 1
+            if self.source is not None:
+                self._orientation = self.source_orientation
+            elif self.options.get('strip'):
+                self._orientation = self.exif_orientation(self._image)
+            if self._orientation >= 5:
+                self._original_size = size = size[::-1]
             # Update empty dimensions
             for i, att in enumerate(['width', 'height']):
                 self.attrs.setdefault(att, size[i])
@@ -99,10 +205,16 @@ class Thumbnail(object):
 
     image = property(_get_image, _set_image)
 
+    @property
+    def original_size(self):
+        # Recorded when opening, before any draft or resize
+        self._get_image()
+        return self._original_size
+
     def original_changed(self):
-        if not os.path.isfile(self.path):
+        if not stat_cache.isfile(self.path):
             return True
-        return os.path.getmtime(self.original_path) > os.path.getmtime(self.path)
+        return stat_cache.getmtime(self.original_path) > stat_cache.getmtime(self.path)
 
     def needs_resize(self):
         return 'width' in self.attrs or 'height' in self.attrs
@@ -114,42 +226,410 @@ class Thumbnail(object):
         """
         return self.original_changed()
 
+    @instrumented('thumbnail.generate')
     def generate(self):
+        """
+        Generates the thumbnail if needed, returns True if it was
+        generated by this call.
+        """
+
+        # Use the dimensions recorded for an up-to-date thumbnail
+        if self.load_manifest():
+            stats.incr('thumbnail.manifest_hits')
+            return False
 
         # Check if the thumbnail must be generated
         if not self.needs_generate():
             self.update_size()
-            return
-
-        # Make sure directories exist
-        dirname = os.path.dirname(self.path)
-        if not os.path.isdir(dirname):
-            os.makedirs(dirname)
+            stats.incr('thumbnail.skipped')
+            return False
+
+        # Only one thread/process generates each thumbnail
+        lock = SingleFlight(self.path)
+        lock.acquire()
+        try:
+            # Check again, it may have been generated while waiting
+            stat_cache.invalidate(self.path)
+            if not self.needs_generate():
+                self.update_size()
+                stats.incr('thumbnail.skipped')
+                return False
+
+            # Make sure directories exist
+            dirname = os.path.dirname(self.path)
+            if not os.path.isdir(dirname):
+                try:
+                    os.makedirs(dirname)
+                except OSError:
+                    # Created concurrently for another thumbnail
+                    if not os.path.isdir(dirname):
+                        raise
+
+            # Reserve the decoding memory, may wait for other resizes
+            budget, pixels = self.reserve()
+            try:
+                # Resize image
+                self.resize()
+
+                # Save thumbnail
+                self.save()
+
+                # Update dimension attributes
+                self.update_size(image=self.image)
+            finally:
+                if budget is not None:
+                    budget.release(pixels)
+        finally:
+            lock.release()
+        stats.incr('thumbnail.generated')
+        return True
+
+    def decode_pixels(self):
+        """
+        Returns the number of pixels decoding the original takes, read
+        from its header. JPEGs are drafted first with IMAGE_FAST_DECODE or
+        when over IMAGE_MAX_PIXELS, so only their reduced size counts.
+        """
+        img = self.image
+        if img.im is not None:
+            # Already decoded
+            return 0
+        w, h = img.size
+        max_pixels = app_settings.IMAGE_MAX_PIXELS
+        if app_settings.IMAGE_FAST_DECODE or (max_pixels and w * h > max_pixels):
+            self.draft()
+            w, h = img.size
+        return w * h
 
-        # Resize image
+    def reserve(self):
+        """
+        Checks the decoding cost against IMAGE_MAX_PIXELS and reserves it
+        from the process' memory budget. Returns the budget (if any) and
+        the pixels to release from it, raises ImageTooLarge on refusal.
+        """
+        pixels = self.decode_pixels()
+        max_pixels = app_settings.IMAGE_MAX_PIXELS
+        if max_pixels and pixels > max_pixels:
+            stats.incr('thumbnail.refused')
+            raise ImageTooLarge('%s decodes to %d pixels, over the limit of %d' % (
+                self.original_src, pixels, max_pixels))
+        budget = get_budget()
+        if budget is None:
+            return None, 0
+        if not budget.acquire(pixels, app_settings.IMAGE_MEMORY_TIMEOUT):
+            stats.incr('thumbnail.refused')
+            raise ImageTooLarge('Timed out waiting for the memory to decode %s' % (
+                self.original_src,), temporary=True)
+        return budget, pixels
+
+    def resize(self):
+        if app_settings.IMAGE_FAST_DECODE:
+            self.draft()
+        if app_settings.INSTRUMENTATION:
+            stats.incr('thumbnail.decoded_pixels', self.image.size[0] * self.image.size[1])
+        self.orient()
         if self.method == Thumbnail.FIT:
             self.fit()
         elif self.method == Thumbnail.CROP:
             self.crop()
 
-        # Save thumbnail
-        self.image.save(self.path, quality=self.quality, optimize=(self.format != 'GIF'))
-        
-        # Update dimension attributes
-        self.update_size(image=self.image)
+    @instrumented('thumbnail.save')
+    def save(self):
+        """
+        Writes the thumbnail, its format variants and placeholder.
+        """
+        image = self.encode()
+        self.write(image, self.path, **self.encoding_options())
+        self.save_variants(image)
+        if app_settings.IMAGE_PLACEHOLDER:
+            self.save_placeholder(image)
+
+    def encoding_options(self):
+        """
+        Returns the options for PIL's save() from the encoding profile.
+        """
+        options = {'quality': self.quality, 'optimize': self.format != 'GIF'}
+        if self.format == 'JPG':
+            if self.options.get('progressive'):
+                options['progressive'] = True
+            if self.options.get('subsampling'):
+                options['subsampling'] = self.options['subsampling']
+        return options
+
+    def encode(self):
+        """
+        Returns the resized image prepared for the encoding profile:
+        converted to sRGB, stripped of metadata and reduced to a palette.
+        """
+        image = self.image
+        icc_profile = image.info.get('icc_profile')
+        if icc_profile and self.options.get('srgb') and ImageCms is not None:
+            try:
+                image = ImageCms.profileToProfile(image,
+                    ImageCms.ImageCmsProfile(StringIO(icc_profile)),
+                    ImageCms.createProfile('sRGB'),
+                    outputMode=image.mode in ('RGB', 'RGBA') and image.mode or 'RGB')
+            except ImageCms.PyCMSError:
+                pass
+        if self.options.get('strip'):
+            image.info.pop('icc_profile', None)
+            image.info.pop('exif', None)
+        colors = self.options.get('colors')
+        if colors and self.format in ('PNG', 'GIF') and image.mode in ('RGB', 'L'):
+            image = image.convert('P', palette=Image.ADAPTIVE, colors=colors)
+        return image
+
+    def write(self, image, path, **options):
+        """
+        Writes an image to a temporary file and renames it over `path`,
+        so readers never see a partially written file.
+        """
+        dirname, filename = os.path.split(path)
+        fd, tmp_path = tempfile.mkstemp(prefix='.%s.' % filename,
+                                        suffix=os.path.splitext(filename)[1], dir=dirname)
+        os.close(fd)
+        try:
+            image.save(tmp_path, **options)
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+        stat_cache.invalidate(path)
+        if app_settings.INSTRUMENTATION:
+            stats.incr('thumbnail.bytes_written', os.path.getsize(path))
+
+    def variant_src(self, format):
+        return '%s.%s' % (os.path.splitext(self.src)[0], format.lower())
+
+    def variant_path(self, format):
+        return os.path.join(app_settings.THUMBNAIL_ROOT, self.variant_src(format))
+
+    def save_variants(self, image):
+        """
+        Writes the IMAGE_VARIANTS formats of the thumbnail, removing the
+        ones that aren't smaller than the thumbnail itself.
+        """
+        size = os.path.getsize(self.path)
+        for format in app_settings.IMAGE_VARIANTS:
+            format = format.upper()
+            if format == self.format:
+                continue
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA')
+            options = {'quality': get_quality(format)}
+            if format == 'WEBP' and self.format == 'PNG' and app_settings.IMAGE_LOSSLESS_VARIANTS:
+                options['lossless'] = True
+
+            path = self.variant_path(format)
+            self.write(image, path, **options)
+            if os.path.getsize(path) >= size:
+                os.remove(path)
+                stat_cache.invalidate(path)
+
+    def variant_sources(self):
+        """
+        Returns (mimetype, url) pairs of the existing format variants.
+        """
+        sources = []
+        for format in app_settings.IMAGE_VARIANTS:
+            format = format.upper()
+            if format != self.format and stat_cache.isfile(self.variant_path(format)):
+                sources.append((MIMETYPES.get(format, 'image/%s' % format.lower()),
+                                app_settings.THUMBNAIL_URL + self.variant_src(format)))
+        return sources
+
+    def serve_params(self):
+        """
+        Returns the query parameters of the thumbnail view recreating
+        this thumbnail, sorted.
+        """
+        params = [('f', self.format.lower()), ('m', self.method),
+                  ('p', self.profile), ('q', self.quality)]
+        for att in ['width', 'height']:
+            if att in self.attrs:
+                params.append((att[0], self.attrs[att]))
+        return sorted(params)
+
+    def serve_url(self):
+        """
+        Returns the signed URL of the thumbnail view for this thumbnail.
+        """
+        query = urlencode(self.serve_params())
+        sig = signature('%s?%s' % (self.original_src, query))
+        return '%s?%s&s=%s' % (reverse('webmedia-thumbnail', kwargs={'path': urlquote(self.original_src)}), query, sig)
+
+    @property
+    def placeholder_path(self):
+        return self.variant_path('lqip')
+
+    def save_placeholder(self, image):
+        """
+        Writes a tiny blurred copy of the thumbnail as a data URI.
+        """
+        size = app_settings.IMAGE_PLACEHOLDER_SIZE
+        image = image.convert('RGB')
+        image.thumbnail((size, size), Image.ANTIALIAS)
+        data = StringIO()
+        image.filter(ImageFilter.BLUR).save(data, 'JPEG', quality=40)
+
+        path = self.placeholder_path
+        dirname, filename = os.path.split(path)
+        fd, tmp_path = tempfile.mkstemp(prefix='.%s.' % filename, dir=dirname)
+        f = os.fdopen(fd, 'w')
+        try:
+            f.write('data:image/jpeg;base64,' + base64.b64encode(data.getvalue()))
+        finally:
+            f.close()
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+        stat_cache.invalidate(path)
+
+    def placeholder(self):
+        """
+        Returns the placeholder data URI, writing it from the thumbnail
+        if it's missing, or None.
+        """
+        path = self.placeholder_path
+        stat = stat_cache.stat(path)
+        if stat is None:
+            try:
+                self.save_placeholder(Image.open(self.path))
+            except IOError:
+                return None
+            stat = stat_cache.stat(path)
+        key = (path, stat.st_mtime)
+        uri = _placeholders.get(key)
+        if uri is None:
+            f = open(path)
+            try:
+                uri = f.read()
+            finally:
+                f.close()
+            _placeholders.set(key, uri)
+        return uri
 
     def update_size(self, image=None):
         if image is None:
             image = Image.open(self.path)
         self.attrs['width'], self.attrs['height'] = image.size
+        self.save_manifest()
 
+    def load_manifest(self):
+        """
+        Updates dimensions from the manifest, returns False if the
+        thumbnail isn't recorded for the current original or is missing.
+        """
+        manifest = get_manifest()
+        if manifest is None:
+            return False
+        original = stat_cache.stat(self.original_path)
+        if original is None:
+            return False
+        size = manifest.get(self.src, original.st_mtime, original.st_size)
+        if size is None:
+            return False
+        # Removed by something else than the collector
+        if not stat_cache.isfile(self.path):
+            manifest.delete(self.src)
+            return False
+        self.attrs['width'], self.attrs['height'] = size
+        return True
+
+    def save_manifest(self):
+        manifest = get_manifest()
+        if manifest is None:
+            return
+        original = stat_cache.stat(self.original_path)
+        if original is None:
+            return
+        manifest.set(self.src, self.original_src, original.st_mtime,
+                     original.st_size, self.attrs['width'], self.attrs['height'])
+
+    def scale(self):
+        """
+        Returns the original's dimensions and the scale to apply to them
+        before cropping or fitting, read from the image header.
+        """
+        w, h = map(float, self.original_size)
+        max_w, max_h = map(float, (self.attrs['width'] or w,
+                                   self.attrs['height'] or h))
+        if self.method == Thumbnail.FIT:
+            return w, h, min(max_w / w, max_h / h, 1)
+        return w, h, min(max(max_w / w, max_h / h), 1)
+
+    def target_size(self):
+        """
+        Computes the thumbnail dimensions from the original's header,
+        without decoding or resizing it.
+        """
+        w, h, scale = self.scale()
+        if self.method == Thumbnail.FIT:
+            return max(int(w * scale), 1), max(int(h * scale), 1)
+        max_w, max_h = map(float, (self.attrs['width'] or w,
+                                   self.attrs['height'] or h))
+        return int(min(max_w, w * scale)), int(min(max_h, h * scale))
+
+    def exif_orientation(self, image):
+        return get_orientation(image)
+
+    def orient(self):
+        """
+        Rotates/flips the image according to its EXIF orientation.
+        """
+        img = self.image
+        for method in ORIENTATIONS.get(self._orientation, ()):
+            img = img.transpose(method)
+        self.image = img
+
+    def draft(self):
+        """
+        Configures the JPEG decoder to scale the image down by a power of
+        two while decoding, keeping it at least as big as the resize needs.
+        Must be called before the image data is loaded.
+        """
+        img = self.image
+        # The decoder can only be configured once
+        if img.format != 'JPEG' or getattr(self, '_drafted', False):
+            return
+        self._drafted = True
+        w, h, scale = self.scale()
+        if scale < 1:
+            size = (int(math.ceil(w * scale)), int(math.ceil(h * scale)))
+            # The decoder works with the stored, not rotated, dimensions
+            if self._orientation >= 5:
+                size = size[::-1]
+            img.draft(img.mode, size)
+
+    def downscale(self, img, size):
+        """
+        Resizes an image to fit in `size`, returning the resized image.
+
+        With IMAGE_FAST_DECODE, big reductions are first done by halving
+        the image with a cheap filter while it stays over twice the final
+        size, leaving the high quality filter a small image to resample.
+        """
+        if app_settings.IMAGE_FAST_DECODE:
+            w, h = img.size
+            while w >= size[0] * 4 and h >= size[1] * 4:
+                w, h = w // 2, h // 2
+                img = img.resize((w, h), Image.BILINEAR)
+
+        resample = Image.ANTIALIAS
+        if max(size) <= app_settings.IMAGE_FAST_RESAMPLE_SIZE:
+            resample = Image.BILINEAR
+        img.thumbnail(size, resample)
+        return img
+
+    @instrumented('thumbnail.fit')
     def fit(self):
         img = self.image
         w, h = map(float, img.size)
         max_w, max_h = map(float, (self.attrs['width'] or w,
                                    self.attrs['height'] or h))
-        img.thumbnail(map(int, (max_w, max_h)), Image.ANTIALIAS)
+        self.image = self.downscale(img, map(int, (max_w, max_h)))
 
+    @instrumented('thumbnail.crop')
     def crop(self):
 
         img = self.image
@@ -165,7 +645,7 @@ class Thumbnail(object):
         # Image bigger than maximum size?
         if scale < 1:
             # Calculate proportions and resize
-            img.thumbnail(map(int, (w * scale, h * scale)), Image.ANTIALIAS)
+            img = self.downscale(img, map(int, (w * scale, h * scale)))
             # Update resized dimensions
             w, h = img.size
             
@@ -183,24 +663,251 @@ class Thumbnail(object):
         self.image = img.crop(map(int, (left, top, right, bottom)))
 
 
+class RemoteThumbnail(Thumbnail):
+    """
+    Thumbnail of a remote image downloaded to THUMBNAIL_ROOT.
+    """
+
+    @property
+    def original_path(self):
+        return os.path.join(app_settings.THUMBNAIL_ROOT, self.original_src)
+
+    def fix_format(self, format):
+        """
+        Reads the format of downloads without an extension from their
+        header.
+        """
+        if not format and not os.path.splitext(self.original_src)[1]:
+            try:
+                format = Image.open(self.original_path).format
+            except IOError:
+                pass
+        return Thumbnail.fix_format(self, format)
+
+
 def thumbnail(src, attrs):
-    # Skip external URLs
-    if src.startswith('http://'):
-        return src, attrs
+    # Download external URLs if enabled
+    if src.startswith('http://') or src.startswith('https://'):
+        if not app_settings.REMOTE_IMAGES:
+            return src, attrs
+        return remote_thumbnail(src, attrs)
 
     # Skip absolute files outside the MEDIA_URL
     if not src.startswith(settings.MEDIA_URL):
         return src, attrs
 
+    # Add the responsive widths to the (possibly) resized image, format
+    # variants are only offered for single thumbnails
+    srcset = attrs.pop('srcset', None)
+    if srcset:
+        new_src, new_attrs = thumbnail(src, attrs)
+        new_attrs.pop('_sources', None)
+        new_attrs.pop('_template', None)
+        srcset = make_srcset(src, parse_widths(srcset), attrs)
+        if srcset:
+            new_attrs['srcset'] = srcset
+        return new_src, new_attrs
+
     # Create thumbnail instance
     path = src.replace(settings.MEDIA_URL, settings.MEDIA_ROOT)
     thumb = Thumbnail(path, **attrs)
 
     # Return original if doesn't need a thumbnail
     if not thumb.needs_resize():
+        if app_settings.IMAGE_DIMENSIONS:
+            size = image_size(thumb.original_path)
+            if size is not None:
+                thumb.attrs['width'], thumb.attrs['height'] = size
         return src, thumb.attrs
 
+    # Link to the view generating the thumbnail when requested
+    if app_settings.THUMBNAIL_SERVE:
+        return thumbnail_serve(thumb)
+
+    # Queue missing thumbs and return a fallback with the final dimensions
+    if app_settings.THUMBNAIL_ASYNC:
+        if thumb.load_manifest():
+            return thumbnail_result(thumb)
+        if thumb.needs_generate():
+            return thumbnail_async(src, path, attrs, thumb)
+
     # Generate thumb and return URL + attrs
-    thumb.generate()
+    try:
+        thumb.generate()
+    except ImageTooLarge as e:
+        # Render the original with the thumbnail's dimensions
+        thumb.attrs['width'], thumb.attrs['height'] = thumb.target_size()
+        if e.temporary:
+            thumb.attrs['_volatile'] = True
+        return src, thumb.attrs
+    return thumbnail_result(thumb)
+
+
+def thumbnail_result(thumb):
+    """
+    Returns the URL and attributes of a generated thumbnail, rendered
+    as a <picture> element when it has format variants and with its
+    placeholder as background.
+    """
+    tracker.touch(thumb.path)
+    if app_settings.IMAGE_PLACEHOLDER:
+        placeholder = thumb.placeholder()
+        if placeholder:
+            style = thumb.attrs.get('style', '').strip()
+            if style and not style.endswith(';'):
+                style += ';'
+            thumb.attrs['style'] = '%sbackground-size:cover;background-image:url(%s)' % (
+                style, placeholder)
+    if app_settings.IMAGE_VARIANTS:
+        sources = thumb.variant_sources()
+        if sources:
+            thumb.attrs['_sources'] = sources
+            thumb.attrs['_template'] = 'picture'
     return thumb.url, thumb.attrs
 
+
+def remote_thumbnail(src, attrs):
+    """
+    Returns the thumbnail of a remote image, or the image's URL if it
+    can't be downloaded or doesn't need resizing.
+    """
+    attrs.pop('srcset', None)
+    try:
+        original_src = fetcher.fetch(src)
+    except RemoteError:
+        return src, attrs
+    thumb = RemoteThumbnail(original_src, **attrs)
+    # Downloads are evicted like thumbnails
+    tracker.touch(thumb.original_path)
+
+    if not thumb.needs_resize():
+        if app_settings.IMAGE_DIMENSIONS:
+            size = image_size(thumb.original_path)
+            if size is not None:
+                thumb.attrs['width'], thumb.attrs['height'] = size
+        return src, thumb.attrs
+
+    try:
+        thumb.generate()
+    except ImageTooLarge:
+        return src, attrs
+    except (IOError, KeyError, ValueError):
+        # Not an image or a format that can't be written
+        logger.exception('webmedia: making a thumbnail of %s failed', src)
+        return src, attrs
+    return thumbnail_result(thumb)
+
+
+def parse_widths(value):
+    """
+    Parses a list or tuple of widths or a string of widths separated by
+    commas or spaces, optionally followed by "w". Invalid widths are
+    skipped.
+    """
+    if not isinstance(value, (list, tuple)):
+        # Also accepts the str() of a list
+        value = re.split(r'[\s,\[\]()\'"]+', smart_str(value).strip())
+    widths = []
+    for width in value:
+        width = smart_str(width).strip().rstrip('wW')
+        if width.isdigit() and int(width) > 0:
+            widths.append(int(width))
+    return widths
+
+def generate_many(thumbs, source=None, orientation=1):
+    """
+    Generates thumbnails of the same original from a single decode,
+    resizing each one from the previous (bigger) generated thumbnail.
+    An already opened original can be given as `source`, with the EXIF
+    orientation its thumbnails must apply.
+    """
+    for thumb in sorted(thumbs, key=lambda t: -int(t.attrs['width'])):
+        thumb.source = source
+        thumb.source_orientation = orientation
+        if thumb.generate():
+            # Generated thumbnails are already oriented
+            source, orientation = thumb.image, 1
+
+def make_srcset(src, widths, attrs):
+    """
+    Generates a fitted thumbnail for each width and returns the value of
+    the srcset attribute. Widths bigger than the original use it instead.
+    """
+    path = src.replace(settings.MEDIA_URL, settings.MEDIA_ROOT, 1)
+    options = dict((k, attrs[k]) for k in ('quality', 'format', 'profile') if k in attrs)
+    thumbs = [Thumbnail(path, width=width, method=Thumbnail.FIT, **options)
+              for width in sorted(set(widths))]
+    if not thumbs:
+        return ''
+    if app_settings.THUMBNAIL_SERVE:
+        return ', '.join(['%s %sw' % (thumb.serve_url(), thumb.attrs['width']) for thumb in thumbs])
+    # Read the original's header, its decoder is reused for the thumbnails
+    probe = thumbs[-1]
+    try:
+        original_width = probe.original_size[0]
+    except IOError:
+        return ''
+
+    candidates = []
+    resized = [t for t in thumbs if int(t.attrs['width']) < original_width]
+    try:
+        generate_many(resized, probe.image, probe._orientation)
+    except ImageTooLarge:
+        return ''
+    for thumb in resized:
+        tracker.touch(thumb.path)
+        candidates.append((thumb.url, thumb.attrs['width']))
+    if len(resized) < len(thumbs):
+        candidates.append((src, original_width))
+    return ', '.join(['%s %sw' % candidate for candidate in candidates])
+
+def thumbnail_serve(thumb):
+    """
+    Returns the signed URL of the thumbnail view, without touching the
+    original or the thumbnail. Fitted thumbnails' dimensions can't be
+    known, cropped ones keep the requested dimensions.
+    """
+    url = thumb.serve_url()
+    if thumb.method == Thumbnail.FIT:
+        thumb.attrs.pop('width', None)
+        thumb.attrs.pop('height', None)
+    return url, thumb.attrs
+
+def thumbnail_from_query(original_src, query):
+    """
+    Returns the Thumbnail for the signed query parameters of the
+    thumbnail view, raises ValueError if they aren't valid.
+    """
+    params = sorted([(k, v) for k, v in query.items() if k != 's'])
+    if not verify('%s?%s' % (original_src, urlencode(params)), query.get('s', '')):
+        raise ValueError('Invalid signature')
+    if os.path.isabs(original_src) or os.path.normpath(original_src).startswith('..'):
+        raise ValueError('Invalid path')
+    params = dict(params)
+    attrs = {}
+    for key, att in [('w', 'width'), ('h', 'height')]:
+        if key in params:
+            attrs[att] = int(params[key])
+    return Thumbnail(original_src, method=params.get('m'), format=params.get('f'),
+                     quality=int(params.get('q') or 0), profile=params.get('p'), **attrs)
+
+def generate_thumbnail(path, attrs):
+    thumb = Thumbnail(path, **attrs)
+    thumb.generate()
+    return thumb
+
+def thumbnail_async(src, path, attrs, thumb):
+    """
+    Queues the generation of a thumbnail and returns the fallback src
+    with the dimensions the thumbnail will have.
+    """
+    try:
+        width, height = thumb.target_size()
+    except IOError:
+        return src, attrs
+    get_pool().submit(thumb.path, generate_thumbnail, path, attrs)
+    thumb.attrs['width'], thumb.attrs['height'] = width, height
+    # Don't cache the rendered fallback
+    thumb.attrs['_volatile'] = True
+    return app_settings.THUMBNAIL_ASYNC_FALLBACK or src, thumb.attrs
+
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from django.utils.importlib import import_module
+from webmedia import app_settings
+from webmedia.stats import instrument_processor
+
+def import_processor(processor):
+    """
+    Returns a callable processor from a dotted path or the callable itself.
+    """
+    if not isinstance(processor, basestring):
+        return processor
+    module_path, processor_name = processor.rsplit('.', 1)
+    module = import_module(module_path)
+    return getattr(module, processor_name)
+
+
+class Registry(object):
+    """
+    Compiled lookup tables for filetypes, default attributes and processors.
+
+    The tables are built once from `app_settings` and rebuilt whenever
+    one of the WEBMEDIA_FILETYPES, WEBMEDIA_FILETYPES_ATTRIBUTES,
+    WEBMEDIA_PROCESSORS or WEBMEDIA_INSTRUMENTATION settings is replaced.
+    Processors and extensions registered programmatically survive rebuilds.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._settings = None
+        self._filetypes = []
+        self._processors = []
+        # Incremented on every rebuild, useful as a cache key component
+        self.generation = 0
+        self.extensions = {}
+        self.attributes = {}
+        self.chains = {}
+
+    def current_settings(self):
+        return (app_settings.FILETYPES, app_settings.FILETYPES_ATTRIBUTES,
+                app_settings.PROCESSORS, app_settings.INSTRUMENTATION)
+
+    def check(self):
+        """
+        Rebuilds the tables if the settings objects have been replaced.
+        """
+        built = self._settings
+        if (built is None or built[0] is not app_settings.FILETYPES or
+                built[1] is not app_settings.FILETYPES_ATTRIBUTES or
+                built[2] is not app_settings.PROCESSORS or
+                built[3] is not app_settings.INSTRUMENTATION):
+            self.build()
+
+    def build(self):
+        self._lock.acquire()
+        try:
+            current_settings = self.current_settings()
+            filetypes, attributes, processors, instrumentation = current_settings
+
+            # Map every extension to its filetype, registered ones first
+            extensions = {}
+            for filetype, types in self._filetypes:
+                for ext in types:
+                    extensions.setdefault(ext, filetype)
+            for filetype, types in filetypes.items():
+                for ext in types:
+                    extensions.setdefault(ext, filetype)
+
+            # Resolve the processor chain for each filetype
+            chains = {}
+            for filetype, paths in processors.items():
+                chains[filetype] = [import_processor(path) for path in paths]
+            for filetype, processor, index in self._processors:
+                chain = chains.setdefault(filetype, [])
+                if index is None:
+                    chain.append(processor)
+                else:
+                    chain.insert(index, processor)
+
+            # Time each processor
+            if instrumentation:
+                for filetype, chain in chains.items():
+                    chains[filetype] = [instrument_processor(p) for p in chain]
+
+            self.extensions = extensions
+            self.attributes = dict(attributes)
+            self.chains = chains
+            self.generation += 1
+            self._settings = current_settings
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        """
+        Forces a rebuild on the next lookup, e.g. after changing
+        settings in-place.
+        """
+        self._settings = None
+
+    def registrations(self):
+        """
+        Returns the programmatically registered filetypes and processors.
+        """
+        return list(self._filetypes), list(self._processors)
+
+    def get_filetype(self, ext):
+        self.check()
+        return self.extensions.get(ext)
+
+    def get_attributes(self, filetype):
+        self.check()
+        return self.attributes.get(filetype, {})
+
+    def get_processors(self, filetype):
+        self.check()
+        return self.chains.get(filetype, [])
+
+    def register_filetype(self, filetype, extensions):
+        """
+        Maps extensions to a filetype, taking precedence over settings.
+        """
+        self._lock.acquire()
+        try:
+            self._filetypes.append((filetype, tuple(extensions)))
+            self.reset()
+        finally:
+            self._lock.release()
+
+    def register_processor(self, filetype, processor, index=None):
+        """
+        Adds a processor (callable or dotted path) to the chain of a
+        filetype, appending it or inserting it at `index`.
+        """
+        self._lock.acquire()
+        try:
+            self._processors.append((filetype, import_processor(processor), index))
+            self.reset()
+        finally:
+            self._lock.release()
+
+    def unregister_processor(self, filetype, processor):
+        self._lock.acquire()
+        try:
+            processor = import_processor(processor)
+            self._processors = [p for p in self._processors
+                                if p[:2] != (filetype, processor)]
+            self.reset()
+        finally:
+            self._lock.release()
+
+
+registry = Registry()
+
+register_filetype = registry.register_filetype
+register_processor = registry.register_processor
+unregister_processor = registry.unregister_processor
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+
+import httplib
+import logging
+import os
+import re
+import socket
+import struct
+import tempfile
+import threading
+import time
+import urlparse
+
+from django.utils import simplejson
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
+from webmedia import app_settings
+from webmedia.cache import LRUCache, stat_cache
+from webmedia.locks import SingleFlight
+
+logger = logging.getLogger('webmedia')
+
+# Directory of THUMBNAIL_ROOT where remote images are cached
+REMOTE_DIR = 'remote'
+# remote/<digest[:2]>/<digest of the URL>[.<ext>]
+CACHE_NAME = re.compile(r'^%s/[0-9a-f]{2}/[0-9a-f]{32}(?:\.[a-z0-9]+)?$' % REMOTE_DIR)
+
+# Bytes read at a time from responses
+CHUNK_SIZE = 65536
+
+# IPv4 networks that aren't reachable from the internet: "this" network,
+# private, shared, loopback, link-local, IETF, benchmarking, multicast
+# and reserved ranges
+PRIVATE_NETWORKS = [
+    ('0.0.0.0', 8), ('10.0.0.0', 8), ('100.64.0.0', 10), ('127.0.0.0', 8),
+    ('169.254.0.0', 16), ('172.16.0.0', 12), ('192.0.0.0', 24), ('192.168.0.0', 16),
+    ('198.18.0.0', 15), ('224.0.0.0', 4), ('240.0.0.0', 4),
+]
+PRIVATE_NETWORKS = [(struct.unpack('!I', socket.inet_aton(network))[0], 0xffffffff << (32 - bits) & 0xffffffff)
+                    for network, bits in PRIVATE_NETWORKS]
+
+def is_cached_original(src):
+    """
+    Returns True if `src` (relative to THUMBNAIL_ROOT) is a downloaded
+    remote image.
+    """
+    return CACHE_NAME.match(src) is not None
+
+
+def is_public_address(address):
+    """
+    Returns True if an IPv4 or IPv6 address is reachable from the
+    internet, not a loopback, link-local, private or reserved one.
+    """
+    address = address.split('%', 1)[0]
+    try:
+        packed = socket.inet_pton(socket.AF_INET6, address)
+    except (socket.error, ValueError):
+        try:
+            packed = socket.inet_aton(address)
+        except socket.error:
+            return False
+    else:
+        if packed[:12] == '\0' * 10 + '\xff' * 2:
+            # IPv4 mapped
+            packed = packed[12:]
+        else:
+            first, second = ord(packed[0]), ord(packed[1])
+            return not (packed[:15] == '\0' * 15 or         # :: and ::1
+                        first == 0xff or                    # multicast
+                        first & 0xfe == 0xfc or             # unique local
+                        (first == 0xfe and second & 0xc0 == 0x80))  # link-local
+    value = struct.unpack('!I', packed)[0]
+    for network, mask in PRIVATE_NETWORKS:
+        if value & mask == network:
+            return False
+    return True
+
+def create_public_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    """
+    Like socket.create_connection(), refusing to connect to addresses
+    that aren't public.
+    """
+    host, port = address
+    addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    for family, socktype, proto, canonname, sockaddr in addresses:
+        if not is_public_address(sockaddr[0]):
+            raise RemoteError('%s resolves to the non public address %s' % (host, sockaddr[0]))
+    error = socket.error('getaddrinfo returned no addresses for %s' % host)
+    for family, socktype, proto, canonname, sockaddr in addresses:
+        sock = socket.socket(family, socktype, proto)
+        try:
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except socket.error as e:
+            error = e
+            sock.close()
+    raise error
+
+
+class RemoteError(IOError):
+    """
+    Raised when a remote image can't be fetched.
+    """
+
+
+class ConnectionPool(object):
+    """
+    Keeps up to `size` idle keep-alive connections per host.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, scheme, netloc):
+        """
+        Returns an idle connection to a host (and whether it was reused)
+        or a new one.
+        """
+        self._lock.acquire()
+        try:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+        finally:
+            self._lock.release()
+        if scheme == 'https':
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        connection = connection_class(netloc, timeout=app_settings.REMOTE_TIMEOUT)
+        if app_settings.REMOTE_HOSTS is None:
+            # Checks the address actually connected to
+            connection._create_connection = create_public_connection
+        return connection, False
+
+    def put(self, scheme, netloc, connection):
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.size:
+                idle.append(connection)
+                return
+        finally:
+            self._lock.release()
+        connection.close()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+class RemoteFetcher(object):
+    """
+    Downloads remote images into THUMBNAIL_ROOT/remote, so thumbnails
+    can be made from them.
+
+    Cached copies are used for REMOTE_MAX_AGE seconds and then
+    revalidated with If-None-Match/If-Modified-Since. Responses over
+    REMOTE_MAX_SIZE bytes or taking more than REMOTE_TIMEOUT seconds
+    are rejected. When revalidation fails, the stale copy is used.
+
+    Unless REMOTE_HOSTS lists the hosts allowed, hosts resolving to
+    loopback, link-local, private or reserved addresses are refused, so
+    URLs from users can't reach internal services.
+    """
+
+    def __init__(self):
+        self.pool = ConnectionPool(app_settings.REMOTE_POOL_SIZE)
+        # URLs checked by this process, until REMOTE_MAX_AGE
+        self._checked = LRUCache(app_settings.REMOTE_CACHE_SIZE)
+
+    def cache_src(self, url):
+        """
+        Returns the path of the cached copy, relative to THUMBNAIL_ROOT.
+        """
+        digest = md5_constructor(smart_str(url)).hexdigest()
+        ext = os.path.splitext(urlparse.urlsplit(url)[2])[1].lower()
+        return '%s/%s/%s%s' % (REMOTE_DIR, digest[:2], digest, ext)
+
+    def meta_path(self, path):
+        dirname, filename = os.path.split(path)
+        return os.path.join(dirname, '.%s.json' % os.path.splitext(filename)[0])
+
+    def fetch(self, url):
+        """
+        Returns the path of an up to date copy of a remote image,
+        relative to THUMBNAIL_ROOT. Raises RemoteError if there's none.
+        """
+        hosts = app_settings.REMOTE_HOSTS
+        if hosts is not None and urlparse.urlsplit(url)[1] not in hosts:
+            raise RemoteError('%s is not in WEBMEDIA_REMOTE_HOSTS' % url)
+
+        src = self.cache_src(url)
+        path = os.path.join(app_settings.THUMBNAIL_ROOT, src)
+        # The copy may have been evicted meanwhile
+        if self._checked.get(url) and stat_cache.isfile(path):
+            return src
+
+        lock = SingleFlight(path)
+        lock.acquire()
+        try:
+            meta = self.load_meta(path)
+            if time.time() - meta.get('checked', 0) >= app_settings.REMOTE_MAX_AGE:
+                try:
+                    meta = self.download(url, path, meta)
+                except RemoteError:
+                    if not os.path.isfile(path):
+                        raise
+                    logger.exception('webmedia: revalidating %s failed, using the cached copy', url)
+        finally:
+            lock.release()
+        fresh_for = app_settings.REMOTE_MAX_AGE - (time.time() - meta.get('checked', 0))
+        if fresh_for > 0:
+            self._checked.set(url, True, fresh_for)
+        return src
+
+    def load_meta(self, path):
+        if not os.path.isfile(path):
+            return {}
+        try:
+            f = open(self.meta_path(path))
+        except IOError:
+            return {}
+        try:
+            try:
+                return simplejson.load(f)
+            except ValueError:
+                return {}
+        finally:
+            f.close()
+
+    def download(self, url, path, meta):
+        """
+        Downloads a URL to `path` unless the cached copy described by
+        `meta` is still valid, returns the new metadata.
+        """
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        status, response_headers, content = self.request(url, headers)
+
+        if status == 304:
+            meta['checked'] = time.time()
+        elif status == 200:
+            content_type = response_headers.get('content-type', '')
+            if content_type and not content_type.startswith('image/'):
+                raise RemoteError('%s is not an image: %s' % (url, content_type))
+            self.write(path, content)
+            meta = {
+                'url': url,
+                'etag': response_headers.get('etag'),
+                'last_modified': response_headers.get('last-modified'),
+                'checked': time.time(),
+            }
+        else:
+            raise RemoteError('%s returned %d' % (url, status))
+        self.write(self.meta_path(path), simplejson.dumps(meta))
+        return meta
+
+    def request(self, url, headers):
+        """
+        GETs a URL, returns the status, headers and content. A reused
+        connection that fails is retried once with a new one.
+        """
+        scheme, netloc, path, query = urlparse.urlsplit(url)[:4]
+        if scheme not in ('http', 'https'):
+            raise RemoteError('Unsupported URL: %s' % url)
+        if query:
+            path += '?' + query
+        if app_settings.REMOTE_HOSTS is None:
+            self.check_host(url)
+        while True:
+            connection, reused = self.pool.get(scheme, netloc)
+            try:
+                connection.request('GET', path or '/', headers=headers)
+                response = connection.getresponse()
+                content = self.read(url, response)
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+                if reused:
+                    continue
+                raise RemoteError('Fetching %s failed: %s' % (url, e))
+            except RemoteError:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self.pool.put(scheme, netloc, connection)
+            return response.status, dict(response.getheaders()), content
+
+    def check_host(self, url):
+        """
+        Raises RemoteError if the host of a URL resolves to an address
+        that isn't public. Connections check their address again, in
+        case it changes meanwhile.
+        """
+        host = urlparse.urlsplit(url).hostname
+        try:
+            addresses = socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM)
+        except socket.error as e:
+            raise RemoteError('Resolving %s failed: %s' % (host, e))
+        for address in addresses:
+            if not is_public_address(address[4][0]):
+                raise RemoteError('%s resolves to the non public address %s' % (host, address[4][0]))
+
+    def read(self, url, response):
+        """
+        Reads a response within REMOTE_MAX_SIZE and REMOTE_TIMEOUT.
+        """
+        max_size = app_settings.REMOTE_MAX_SIZE
+        length = response.getheader('content-length')
+        if length and length.isdigit() and int(length) > max_size:
+            raise RemoteError('%s is bigger than %d bytes' % (url, max_size))
+        deadline = time.time() + app_settings.REMOTE_TIMEOUT
+        chunks = []
+        size = 0
+        while True:
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > max_size:
+                raise RemoteError('%s is bigger than %d bytes' % (url, max_size))
+            if time.time() > deadline:
+                raise RemoteError('Fetching %s took over %s seconds' % (url, app_settings.REMOTE_TIMEOUT))
+        return ''.join(chunks)
+
+    def write(self, path, content):
+        dirname, filename = os.path.split(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Created concurrently
+                if not os.path.isdir(dirname):
+                    raise
+        fd, tmp_path = tempfile.mkstemp(prefix='.%s.' % filename, dir=dirname)
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+        stat_cache.invalidate(path)
+
+
+fetcher = RemoteFetcher()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import re
+import threading
+
+from django.template import Context, loader
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+from webmedia.registry import registry
+
+# Templates using only these variables are rendered by string formatting
+SIMPLE_VARIABLES = ('src', 'flat_attrs')
+VARIABLE_RE = re.compile(r'{{\s*(\w+)\s*}}')
+
+def template_name(name):
+    return 'webmedia/embed/%s.html' % name
+
+
+class EmbedRenderer(object):
+    """
+    Renders the embed templates, loading and compiling each of them once.
+
+    Templates that only output {{ src }} and {{ flat_attrs }}, like the
+    bundled image, stylesheet and javascript ones, are turned into a
+    format string with the same output, skipping the template engine.
+    Project templates overriding the bundled ones are loaded the same
+    way, so overrides keep working. Compiled templates are dropped when
+    the registry is rebuilt.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generation = None
+        self._renderers = {}
+
+    def compile(self, name):
+        source, origin = loader.find_template_source(template_name(name))
+        return self.compile_source(source, origin, template_name(name))
+
+    def compile_source(self, source, origin=None, name=None):
+        if '{%' not in source and '{#' not in source:
+            variables = VARIABLE_RE.findall(source)
+            # Any other variable, lookup or filter needs the template engine
+            if len(variables) == source.count('{{') and set(variables) <= set(SIMPLE_VARIABLES):
+                format_string = VARIABLE_RE.sub(r'%(\1)s', source.replace('%', '%%'))
+                return lambda context: format_string % {
+                    'src': conditional_escape(context['src']),
+                    'flat_attrs': context['flat_attrs'],
+                }
+        template = loader.get_template_from_string(source, origin, name)
+        return lambda context: template.render(Context(context))
+
+    def get_renderer(self, name):
+        if self._generation != registry.generation:
+            self._lock.acquire()
+            try:
+                self._renderers = {}
+                self._generation = registry.generation
+            finally:
+                self._lock.release()
+        renderer = self._renderers.get(name)
+        if renderer is None:
+            renderer = self._renderers[name] = self.compile(name)
+        return renderer
+
+    def render(self, name, context):
+        return mark_safe(self.get_renderer(name)(context))
+
+    def clear(self):
+        self._renderers = {}
+
+
+renderer = EmbedRenderer()
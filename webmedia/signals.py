@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+
+from django.dispatch import Signal
+
+# Sent with WEBMEDIA_INSTRUMENTATION for every timed call, in seconds
+timing = Signal(providing_args=['name', 'duration'])
+
+# Sent with WEBMEDIA_INSTRUMENTATION when a counter is incremented
+counter = Signal(providing_args=['name', 'value'])
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+import hmac
+
+from django.conf import settings
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import sha_hmac
+
+def signature(value):
+    """
+    Returns the HMAC of a value, keyed with the SECRET_KEY.
+    """
+    key = smart_str('webmedia' + settings.SECRET_KEY)
+    return hmac.new(key, smart_str(value), sha_hmac).hexdigest()
+
+def verify(value, sig):
+    """
+    Checks a signature in constant time.
+    """
+    expected = signature(value)
+    sig = smart_str(sig)
+    if len(sig) != len(expected):
+        return False
+    result = 0
+    for x, y in zip(expected, sig):
+        result |= ord(x) ^ ord(y)
+    return result == 0
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from django.core.signals import request_finished, request_started
+from django.utils.functional import wraps
+
+class RequestState(threading.local):
+    """
+    State of the request handled by the current thread, reset when a
+    request starts and finishes. Code rendering outside requests, like
+    management commands and task workers, should be decorated with
+    scoped() or call state.reset() between renders.
+    """
+
+    def __init__(self):
+        # Images embedded so far
+        self.images = 0
+        # Prefetched process_file() results by src, with their attributes
+        self.processed = {}
+
+    def reset(self):
+        self.__init__()
+
+    def next_image(self):
+        """
+        Returns the position of the next embedded image, from 0.
+        """
+        position = self.images
+        self.images += 1
+        return position
+
+
+state = RequestState()
+
+def scoped(func):
+    """
+    Decorates a function rendering outside a request, so its images are
+    counted and its prefetched results kept only during the call.
+    """
+    def wrapper(*args, **kwargs):
+        state.reset()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            state.reset()
+    return wraps(func)(wrapper)
+
+def reset_state(sender, **kwargs):
+    state.reset()
+
+request_started.connect(reset_state, dispatch_uid='webmedia.state')
+request_finished.connect(reset_state, dispatch_uid='webmedia.state.finished')
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from django.utils.functional import wraps
+from webmedia import app_settings
+from webmedia import signals
+
+class Stats(object):
+    """
+    Aggregates the timings and counters recorded in this process and
+    sends them as signals, for plugging other metrics sinks.
+
+    Nothing is recorded unless WEBMEDIA_INSTRUMENTATION is enabled.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.timings = {}
+            self.counters = {}
+        finally:
+            self._lock.release()
+
+    def timing(self, name, duration):
+        if not app_settings.INSTRUMENTATION:
+            return
+        self._lock.acquire()
+        try:
+            timing = self.timings.setdefault(name, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += duration
+            timing[2] = max(timing[2], duration)
+        finally:
+            self._lock.release()
+        signals.timing.send(sender=self, name=name, duration=duration)
+
+    def incr(self, name, value=1):
+        if not app_settings.INSTRUMENTATION:
+            return
+        self._lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + value
+        finally:
+            self._lock.release()
+        signals.counter.send(sender=self, name=name, value=value)
+
+    def snapshot(self):
+        self._lock.acquire()
+        try:
+            timings = dict((name, {
+                'count': count,
+                'total': total,
+                'mean': total / count,
+                'max': maximum,
+            }) for name, (count, total, maximum) in self.timings.items())
+            return {'timings': timings, 'counters': dict(self.counters)}
+        finally:
+            self._lock.release()
+
+
+stats = Stats()
+
+def instrumented(name):
+    """
+    Decorator recording the duration of each call when instrumentation
+    is enabled.
+    """
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            if not app_settings.INSTRUMENTATION:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.timing(name, time.time() - start)
+        return wraps(func)(wrapper)
+    return decorator
+
+def instrument_processor(processor):
+    name = getattr(processor, '__name__', processor.__class__.__name__)
+    timed = instrumented('processor.%s.%s' % (processor.__module__, name))
+    if hasattr(processor, '__name__'):
+        return timed(processor)
+    return timed(lambda src, attrs: processor(src, attrs))
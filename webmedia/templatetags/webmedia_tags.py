@@ -1,17 +1,31 @@
 # -*- coding: utf-8 -*-
 
+import logging
 import os
 import re
 import time
+import urlparse
 
 from django import template
-from django.template import loader
 from django.conf import settings
+from django.utils.encoding import smart_str
 from django.utils.safestring import mark_safe, SafeUnicode
 
 from quicktag.template.quicktag import quicktag
 from webmedia import app_settings
-from webmedia.processors import get_filetype_processors
+from webmedia.bundles import bundler
+from webmedia.cache import LRUCache, stat_cache
+from webmedia.compression import compressor
+from webmedia.eviction import tracker
+from webmedia.fragments import fragment_cache
+from webmedia.registry import registry
+from webmedia.renderers import renderer
+from webmedia.state import state
+from webmedia.stats import instrumented
+from webmedia.versioning import get_asset_manifest
+from webmedia.workers import get_thread_pool
+
+logger = logging.getLogger('webmedia')
 
 register = template.Library()
 
@@ -49,20 +63,46 @@ def nocache(path):
     full_path = url_to_root(path)
 
     # Verifica se o arquivo existe
-    if os.path.isfile(full_path):
+    if stat_cache.isfile(full_path):
         # Lê a data de modificação do arquivo
-        m_time = time.localtime(os.path.getmtime(full_path))
+        m_time = time.localtime(stat_cache.getmtime(full_path))
         # Retorna a data no formato "[dia_ano][hora][minuto][segundo]"
         return time.strftime('%j-%H%M%S', m_time)
 
     return ''
 
 
+def versioned_src(src):
+    """
+    Adds a version to a file URL, from the asset manifest when
+    WEBMEDIA_VERSIONING is "hash" or from the file's modification time.
+    """
+    if app_settings.VERSIONING == 'hash':
+        versioned = get_asset_manifest().version(src)
+        if versioned:
+            return versioned
+
+    # Add anti-cache query string
+    anti_cache = nocache(src)
+    if anti_cache:
+        src += '?' + anti_cache
+    return src
+
+def versioned_srcset(srcset):
+    """
+    Adds versions to the URLs of the candidates of a srcset attribute.
+    """
+    candidates = []
+    for candidate in srcset.split(','):
+        parts = candidate.split()
+        if parts:
+            parts[0] = versioned_src(parts[0])
+            candidates.append(' '.join(parts))
+    return ', '.join(candidates)
+
+
 def get_filetype(ext):
-    for filetype, types in app_settings.FILETYPES.items():
-        if ext in types:
-            return filetype
-    return None
+    return registry.get_filetype(ext)
 
 def apply_processors(src, attrs):
     return src, attrs
@@ -75,49 +115,233 @@ def get_relative_url(src):
     if src.startswith(settings.MEDIA_URL):
         src = src[len(settings.MEDIA_URL):]
     # Skip external and absolute URLs
-    if not src.startswith('http://') and not src.startswith('/'):
+    if not src.startswith(('http://', 'https://', '/')):
         return settings.MEDIA_URL + src
     return src
 
-def process_file(src, **attrs):
-    # Fail silently if there's no path or extension
-    src_no_ext, ext = os.path.splitext(src)
-    if not src or not ext:
-        return None, None, None
+def prepare_file(src):
+    """
+    Returns the URL, filetype and default attributes of a file, the
+    parts of processing that only depend on its src, or None.
+    """
+    if not src:
+        return None
+
+    # The extension of remote URLs is in their path, those without one
+    # can only be downloaded images
+    if src.startswith(('http://', 'https://')):
+        ext = os.path.splitext(urlparse.urlsplit(src)[2])[1]
+        if not ext and app_settings.REMOTE_IMAGES:
+            return src, 'image', registry.get_attributes('image')
+    else:
+        ext = os.path.splitext(src)[1]
+
+    # Fail silently if there's no extension
+    if not ext:
+        return None
 
     # Removes the "." from the extension and get the filetype
     ext = ext[1:]
     filetype = get_filetype(ext)
 
+    # Convert the src to a URL relative to the MEDIA_URL or absolute
+    return get_relative_url(src), filetype, registry.get_attributes(filetype)
+
+def process_file(src, **attrs):
+    prepared = prepare_file(src)
+    if prepared is None:
+        return None, None, None
+    return process_prepared(prepared, attrs)
+
+def stringify_attrs(attrs):
+    return dict([(k, smart_str(v)) for k, v in attrs.items()])
+
+def prefetched(prepared, attrs):
+    """
+    Returns the prefetched result of a file with the attributes given to
+    the prefetch, plus the extra attributes of `attrs` that processors
+    don't use, or None.
+    """
+    values = stringify_attrs(attrs)
+    for given, result, paths in state.processed.get(prepared[0], ()):
+        extra = dict([(k, v) for k, v in attrs.items() if k not in given])
+        if (len(attrs) - len(extra) != len(given) or
+                [k for k, v in given.items() if values.get(k) != v] or
+                [k for k in extra if k in app_settings.PROCESSED_ATTRIBUTES]):
+            continue
+        # Touched in the prefetching thread, and now in this one
+        for path in paths:
+            tracker.touch(path)
+        result_attrs = dict(result[2])
+        result_attrs.update(extra)
+        return result[0], result[1], result_attrs
+    return None
+
+@instrumented('process_file')
+def process_prepared(prepared, attrs):
+    """
+    Processes a file prepared by prepare_file(), returns the src,
+    filetype and attributes. Files prefetched in the current request
+    aren't processed again.
+    """
+    if state.processed:
+        result = prefetched(prepared, attrs)
+        if result is not None:
+            return result
+
+    src, filetype, default_attrs = prepared
+
     # Extends default attributes for the filetype
-    default_attrs = app_settings.FILETYPES_ATTRIBUTES.get(filetype, {})
     attrs = dict(default_attrs, **attrs)
 
-    # Convert the src to a URL relative to the MEDIA_URL or absolute
-    src = get_relative_url(src)
-
     # Apply processors (image resize or others)
-    processors = get_filetype_processors(filetype)
-    for proc in processors:
+    for proc in registry.get_processors(filetype):
         src, attrs = proc(src, attrs)
 
-    # Add anti-cache query string
-    anti_cache = nocache(src)
-    if anti_cache:
-        src += '?' + anti_cache
+    # Add the content hash or anti-cache query string, also to the
+    # URLs of the format variants and responsive widths
+    src = versioned_src(src)
+    if attrs.get('_sources'):
+        attrs['_sources'] = [(mimetype, versioned_src(url)) for mimetype, url in attrs['_sources']]
+    if isinstance(attrs.get('srcset'), basestring):
+        attrs['srcset'] = versioned_srcset(attrs['srcset'])
+
+    # Write compressed copies of the (versioned) file
+    if (app_settings.PRECOMPRESS and filetype in app_settings.PRECOMPRESS_FILETYPES
+            and src.startswith(settings.MEDIA_URL)):
+        compressor.compress(url_to_root(src.split('?', 1)[0]))
 
     # Return the (possibly) modified src and attributes
     return src, filetype, attrs
 
 
+def safe_process(prepared, attrs):
+    """
+    Processes a prefetched file, returns the result and the paths it
+    touched, or None.
+    """
+    tracker.record()
+    try:
+        try:
+            result = process_prepared(prepared, attrs)
+        except Exception:
+            logger.exception('webmedia: prefetching %s failed', prepared[0])
+            return None
+    finally:
+        paths = tracker.recorded()
+    return result, paths
+
+def prefetch(srcs, **attrs):
+    """
+    Processes files with the same attributes in parallel, before they
+    are embedded. Results are kept until the end of the request (see
+    webmedia.state.scoped for renders outside requests) and used by the
+    embed tags and process filters of the same src with the same
+    PROCESSED_ATTRIBUTES, other attributes being added to the results.
+    Returns the number of files processed.
+    """
+    given = stringify_attrs(attrs)
+    jobs = {}
+    for src in srcs:
+        prepared = src and prepare_file(src)
+        if not prepared:
+            continue
+        if given not in [entry[0] for entry in state.processed.get(prepared[0], ())]:
+            jobs[prepared[0]] = prepared
+    if not jobs:
+        return 0
+
+    prepared_files = jobs.values()
+    results = get_thread_pool().map(lambda prepared: safe_process(prepared, attrs), prepared_files)
+    for prepared, result in zip(prepared_files, results):
+        if result is not None:
+            state.processed.setdefault(prepared[0], []).append((given,) + result)
+    return len(prepared_files)
+
+def lazy_attrs(filetype, attrs):
+    """
+    Counts the images embedded in the current request, returns the
+    attributes making the ones after IMAGE_LAZY_AFTER load lazily
+    unless "loading" is given.
+    """
+    if filetype != 'image':
+        return {}
+    position = state.next_image()
+    lazy_after = app_settings.IMAGE_LAZY_AFTER
+    if lazy_after is None or position < lazy_after or 'loading' in attrs:
+        return {}
+    return {'loading': 'lazy', 'decoding': 'async'}
+
+def source_version(src):
+    """
+    Returns a value that changes with the contents of a local file: its
+    hash from the asset manifest or its modification time and size.
+    """
+    src = get_relative_url(src)
+    if app_settings.VERSIONING == 'hash':
+        versioned = get_asset_manifest().version(src)
+        if versioned:
+            return versioned
+    if src.startswith(settings.MEDIA_URL):
+        stat = stat_cache.stat(url_to_root(src))
+        if stat is not None:
+            return stat.st_mtime, stat.st_size
+    return None
+
+def flatten_attrs(attrs):
+    return mark_safe(' '.join(['%s="%s"' % i for i in attrs.items()]))
+
+def render_embed(src, attrs, prepared=None, extra_attrs=None):
+    """
+    Processes a file and renders the template for its filetype, adding
+    `extra_attrs` to the processed attributes. Returns the HTML and
+    whether it can be cached.
+
+    Processors may set private attributes, prefixed with "_", which are
+    passed to the template context instead of the HTML attributes. A
+    true "_volatile" attribute keeps the HTML from being cached and
+    "_template" replaces the filetype's template.
+    """
+    if prepared is None:
+        prepared = prepare_file(src)
+        if prepared is None:
+            return '', True
+    src, filetype, attrs = process_prepared(prepared, attrs)
+    if extra_attrs:
+        attrs.update(extra_attrs)
+
+    # Move private attributes to the context
+    context = {}
+    for name in attrs.keys():
+        if name.startswith('_'):
+            context[name[1:]] = attrs.pop(name)
+
+    # Return the rendered template for the filetype
+    context.update({'src': src, 'attrs': attrs,
+                    'flat_attrs': flatten_attrs(attrs)})
+    html = renderer.render(context.pop('template', filetype), context)
+    return html, not context.get('volatile')
+
+
 ## FILTERS
 
+# Parsed arguments of the process filter
+_process_args = LRUCache(1000)
+
+def parse_process_args(args):
+    """
+    Parses a "key=value,other_key=other_value" string, memoized.
+    """
+    attrs = _process_args.get(args)
+    if attrs is None:
+        attrs = dict((pair.split('=') for pair in str(args).split(',')))
+        _process_args.set(args, attrs)
+    return attrs
+
 @register.filter
 def process(src, args):
     """ Apply processors to a file and return the modified source. """
-    # Create a dict from "key=value,other_key=other_value" string
-    attrs = dict((pair.split('=') for pair in str(args).split(',')))
-    new_src, filetype, attrs = process_file(src, **attrs)
+    new_src, filetype, attrs = process_file(src, **parse_process_args(args))
     if not new_src:
         return src
     return new_src
@@ -125,18 +349,182 @@ def process(src, args):
 
 ## TAGS
 
-@register.tag
-@quicktag
-def embed(src, **attrs):
-    """ Apply processor to a file and return the appropriate HTML tag. """
-    src, filetype, attrs = process_file(src, **attrs)
+def embed_html(src, attrs, prepared=None):
+    """
+    Returns the HTML tag for a file, from the fragment cache when
+    enabled. `prepared` can be given to skip prepare_file().
+    """
     if not src:
         return ''
+    if prepared is None:
+        prepared = prepare_file(src)
+        if prepared is None:
+            return ''
+    extra_attrs = lazy_attrs(prepared[1], attrs)
+    if not app_settings.EMBED_CACHE:
+        return render_embed(src, attrs, prepared, extra_attrs)[0]
+
+    key = fragment_cache.make_key(src, dict(attrs, **extra_attrs), source_version(prepared[0]))
+    cached = fragment_cache.get(key)
+    if cached is not None:
+        # Record the use of the thumbnails in the fragment
+        html, paths = cached
+        for path in paths:
+            tracker.touch(path)
+        return html
+    tracker.record()
+    try:
+        html, cacheable = render_embed(src, attrs, prepared, extra_attrs)
+    finally:
+        paths = tracker.recorded()
+    if cacheable:
+        fragment_cache.set(key, html, paths)
+    return html
+
+# Arguments separated by commas or spaces, outside quotes
+ARGUMENT = re.compile(r'''(?:[^\s,"']|"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')+''')
+KEYWORD_ARGUMENT = re.compile(r'^(\w+)=(.+)$')
+
+def is_literal(expression):
+    """
+    Returns True if a FilterExpression is a constant without filters.
+    Translated strings depend on the active language, so they aren't.
+    """
+    if expression.filters:
+        return False
+    if not isinstance(expression.var, template.Variable):
+        return True
+    return expression.var.literal is not None and not expression.var.translate
 
-    # Flatten attributes
-    str_attrs = ' '.join(['%s="%s"' % i for i in attrs.items()])
-    # Return the rendered template for the filetype
-    context = {'src': src, 'attrs': attrs,
-               'flat_attrs': mark_safe(str_attrs)}
-    return loader.render_to_string('webmedia/embed/%s.html' % filetype, context)
+class EmbedNode(template.Node):
+    """
+    Renders the embed tag. Literal arguments are resolved once, when
+    the template is compiled, and a literal src is prepared once per
+    registry generation, so only variables are evaluated per render.
+    """
+
+    def __init__(self, src, attrs):
+        self.src = src
+        self.attrs = {}
+        self.variables = {}
+        for name, expression in attrs.items():
+            if is_literal(expression):
+                self.attrs[name] = expression.resolve(template.Context())
+            else:
+                self.variables[name] = expression
+        self.literal_src = None
+        if is_literal(src):
+            self.literal_src = src.resolve(template.Context())
+        self.prepared = None
+        self.generation = None
+
+    def prepare(self):
+        registry.check()
+        if self.generation != registry.generation:
+            self.prepared = prepare_file(self.literal_src)
+            self.generation = registry.generation
+        return self.prepared
+
+    def render(self, context):
+        attrs = dict(self.attrs)
+        for name, expression in self.variables.items():
+            attrs[name] = expression.resolve(context)
+        if self.literal_src is not None:
+            prepared = self.prepare()
+            if prepared is None:
+                return ''
+            return embed_html(self.literal_src, attrs, prepared)
+        return embed_html(self.src.resolve(context), attrs)
+
+def parse_arguments(parser, token):
+    """
+    Splits the arguments of a tag, separated by commas or spaces, into
+    positional and keyword FilterExpressions.
+    """
+    bits = ARGUMENT.findall(token.contents)
+    tag_name, bits = bits[0], bits[1:]
+    args = []
+    kwargs = {}
+    for bit in bits:
+        match = KEYWORD_ARGUMENT.match(bit)
+        if match is None:
+            args.append(parser.compile_filter(bit))
+            continue
+        name, value = match.groups()
+        if name in kwargs:
+            raise template.TemplateSyntaxError('%s got "%s" twice: %s' % (tag_name, name, token.contents))
+        kwargs[str(name)] = parser.compile_filter(value)
+    return tag_name, args, kwargs
+
+@register.tag
+def embed(parser, token):
+    """
+    Apply processor to a file and return the appropriate HTML tag.
 
+    Usage: {% embed src[,] key=value[,] ... %}
+    """
+    tag_name, args, attrs = parse_arguments(parser, token)
+    if len(args) != 1:
+        raise template.TemplateSyntaxError('%s takes a single src: %s' % (tag_name, token.contents))
+    return EmbedNode(args[0], attrs)
+
+class PrefetchNode(template.Node):
+
+    def __init__(self, items, attribute, attrs):
+        self.items = items
+        self.attribute = attribute
+        self.attrs = attrs
+
+    def render(self, context):
+        srcs = self.items.resolve(context) or []
+        if self.attribute is not None:
+            lookup = template.Variable(self.attribute.resolve(context))
+            values = []
+            for item in srcs:
+                try:
+                    values.append(lookup.resolve(item))
+                except template.VariableDoesNotExist:
+                    pass
+            srcs = values
+        attrs = dict([(name, expression.resolve(context))
+                      for name, expression in self.attrs.items()])
+        prefetch(srcs, **attrs)
+        return ''
+
+@register.tag
+def webmedia_prefetch(parser, token):
+    """
+    Processes a list of files in parallel, for the embed tags with the
+    same attributes rendered later in the request. The files can be
+    looked up in the items of the list by an attribute path.
+
+    Usage: {% webmedia_prefetch list ["attribute.path"] key=value ... %}
+    """
+    tag_name, args, attrs = parse_arguments(parser, token)
+    if len(args) not in (1, 2):
+        raise template.TemplateSyntaxError('%s takes a list and an optional attribute: %s' % (
+            tag_name, token.contents))
+    return PrefetchNode(args[0], len(args) == 2 and args[1] or None, attrs)
+
+@register.tag
+@quicktag
+def bundle(*srcs, **attrs):
+    """
+    Concatenate stylesheets or javascripts into a single file and return
+    the HTML tag for it. Accepts "name" and "minify" options.
+    """
+    if not srcs:
+        return ''
+    name = attrs.pop('name', None)
+    minify = attrs.pop('minify', app_settings.BUNDLE_MINIFY)
+    if isinstance(minify, basestring):
+        minify = minify.lower() in ('1', 'true', 'yes')
+
+    paths = [url_to_root(get_relative_url(src)) for src in srcs]
+    filetypes = set([get_filetype(os.path.splitext(path)[1][1:]) for path in paths])
+    if len(filetypes) != 1:
+        raise template.TemplateSyntaxError('bundle files must have the same filetype: %s' % ', '.join(srcs))
+
+    src = bundler.build(paths, name=name, minify=minify)
+    return renderer.render(filetypes.pop(), {
+        'src': src, 'attrs': attrs, 'flat_attrs': flatten_attrs(attrs)})
@@ -7,14 +7,23 @@ from django.conf import settings
 from django.test import TestCase
 from webmedia import app_settings
 from webmedia.processors.image import Thumbnail
+from webmedia.remote import fetcher
+import BaseHTTPServer
+import SocketServer
 import os
+import re
 import shutil
+import threading
 
 def create_image(path, width=100, height=100):
     img = Image.new('RGB', (width, height))
     img.save(path)
     return img
 
+def generate_in_process(image_filename):
+    thumb = Thumbnail(image_filename, width=50, height=40, method=Thumbnail.CROP)
+    return thumb.generate()
+
 class BaseEmbedTest(TestCase):
 
     def render_tag(self, tag, context={}):
@@ -63,6 +72,28 @@ class EmbedTagTest(BaseEmbedTest):
         content = self.render_tag('{% embed "flash.swf" wmode="transparent" %}')
         self.assertTrue('<param name="wmode" value="transparent" />' in content)
 
+class RendererTest(TestCase):
+
+    def test_same_output(self):
+        from django.template import loader
+        from django.utils.safestring import mark_safe
+        from webmedia.renderers import renderer, template_name
+        context = {'src': '/media/a&b.gif', 'attrs': {'width': '10'},
+                   'flat_attrs': mark_safe('width="10"')}
+        for filetype in ['image', 'stylesheet', 'javascript', 'flash', 'sound']:
+            self.assertEquals(renderer.render(filetype, context),
+                              loader.render_to_string(template_name(filetype), context))
+
+    def test_override(self):
+        from django.utils.safestring import mark_safe
+        from webmedia.renderers import renderer
+        context = {'src': '/media/a&b.gif', 'attrs': {'width': '10'},
+                   'flat_attrs': mark_safe('alt="b"')}
+        render = renderer.compile_source('<img src="{{ src }}" width="{{ attrs.width }}" {{ flat_attrs }} />')
+        self.assertEquals(render(context), '<img src="/media/a&amp;b.gif" width="10" alt="b" />')
+        render = renderer.compile_source('<img src="{{ src|upper }}" {{ flat_attrs }} />')
+        self.assertEquals(render(context), '<img src="/MEDIA/A&amp;B.GIF" alt="b" />')
+
 class ProcessorTest(TestCase):
 
     def test_import(self):
@@ -71,6 +102,36 @@ class ProcessorTest(TestCase):
         image_processors = get_filetype_processors('image')
         self.assertEqual(image_processors, [thumbnail])
 
+    def test_settings_change(self):
+        from webmedia.processors import get_filetype_processors
+        settings_bkp = app_settings.PROCESSORS
+        app_settings.PROCESSORS = {}
+        try:
+            self.assertEqual(get_filetype_processors('image'), [])
+        finally:
+            app_settings.PROCESSORS = settings_bkp
+
+    def test_register(self):
+        from webmedia.processors import get_filetype_processors
+        from webmedia.processors.image import thumbnail
+        from webmedia.registry import registry
+
+        def upper(src, attrs):
+            return src.upper(), attrs
+
+        registry.register_processor('image', upper, index=0)
+        try:
+            self.assertEqual(get_filetype_processors('image'), [upper, thumbnail])
+        finally:
+            registry.unregister_processor('image', upper)
+        self.assertEqual(get_filetype_processors('image'), [thumbnail])
+
+    def test_filetype_index(self):
+        from webmedia.registry import registry
+        self.assertEqual(registry.get_filetype('jpg'), 'image')
+        self.assertEqual(registry.get_filetype('swf'), 'flash')
+        self.assertEqual(registry.get_filetype('xyz'), None)
+
 
 class ThumbnailTest(TestCase):
 
@@ -138,6 +199,30 @@ class ThumbnailTest(TestCase):
         self.assertEquals(img.size, (50, 40))
 
 
+    def test_fast_decode(self):
+        create_image(self.image_path, width=1600, height=1200)
+        for method, size in [(Thumbnail.FIT, (40, 30)), (Thumbnail.CROP, (50, 30))]:
+            thumb = Thumbnail(self.image_filename, width=50, height=30, method=method)
+            self.assertEquals(thumb.target_size(), size)
+            thumb.generate()
+            self.assertEquals(Image.open(thumb.path).size, size)
+            os.remove(thumb.path)
+
+    def test_profile(self):
+        thumb = Thumbnail(self.image_filename, width=50, height=40, profile='web')
+        self.assertEquals(thumb.src, 'imagetest_jpg__w50_h40_mc_pweb.jpg')
+        thumb.generate()
+        img = Image.open(thumb.path)
+        self.assertTrue(img.info.get('progressive') or img.info.get('progression'))
+        os.remove(thumb.path)
+
+    def test_palette_profile(self):
+        thumb = Thumbnail(self.image_filename, width=50, height=40, format='png', profile='palette')
+        thumb.generate()
+        self.assertEquals(Image.open(thumb.path).mode, 'P')
+        os.remove(thumb.path)
+
+
 class EmbedResizeTest(BaseEmbedTest):
 
     def setUp(self):
@@ -168,6 +253,57 @@ class EmbedResizeTest(BaseEmbedTest):
         self.assertTrue(os.path.isfile(os.path.join(thumb_path)))
         self.assertTrue('method=' not in content)
 
+    def test_srcset(self):
+        from webmedia.processors import image
+        original_path = os.path.join(self.path, 'imagetest.jpg')
+        create_image(original_path, width=400, height=200)
+
+        # Count how many times the original is decoded
+        opened = []
+        image_open = Image.open
+        def counting_open(path, *args):
+            if path == original_path:
+                opened.append(path)
+            return image_open(path, *args)
+        image.Image.open = counting_open
+        try:
+            content = self.render_tag('{% embed "test_images/imagetest.jpg" srcset="100 200,800" sizes="50vw" %}')
+        finally:
+            image.Image.open = image_open
+
+        self.assertEquals(len(opened), 1)
+        # Versioned like the src
+        self.assertTrue(re.search(r'srcset="%(url)stest_images/imagetest_jpg__w100_mf\.jpg\?[\d-]+ 100w, '
+                                  r'%(url)stest_images/imagetest_jpg__w200_mf\.jpg\?[\d-]+ 200w, '
+                                  r'/media/test_images/imagetest\.jpg\?[\d-]+ 400w"' % {
+                                      'url': re.escape(app_settings.THUMBNAIL_URL)}, content), content)
+        self.assertTrue('sizes="50vw"' in content, content)
+        self.assertEquals(Image.open(os.path.join(self.thumb_path, 'imagetest_jpg__w100_mf.jpg')).size, (100, 50))
+
+    def test_parse_widths(self):
+        from webmedia.processors.image import parse_widths
+        self.assertEquals(parse_widths('320w, 640w 1024'), [320, 640, 1024])
+        self.assertEquals(parse_widths([320, '640w']), [320, 640])
+        self.assertEquals(parse_widths(str([320, 640])), [320, 640])
+        self.assertEquals(parse_widths('wide, 0, -10'), [])
+
+    def test_srcset_orientation(self):
+        from webmedia.processors.image import make_srcset
+        create_image(os.path.join(self.path, 'imagetest.jpg'), width=200, height=100)
+
+        # Stored sideways, rotated by the stripping profile
+        exif_orientation = Thumbnail.exif_orientation
+        Thumbnail.exif_orientation = lambda self, image: 6
+        try:
+            srcset = make_srcset('/media/test_images/imagetest.jpg', [50, 300], {'profile': 'web'})
+        finally:
+            Thumbnail.exif_orientation = exif_orientation
+
+        thumb = Thumbnail('test_images/imagetest.jpg', width=50, method=Thumbnail.FIT, profile='web')
+        self.assertTrue('%s 50w' % thumb.url in srcset, srcset)
+        self.assertTrue('/media/test_images/imagetest.jpg 100w' in srcset, srcset)
+        self.assertEquals(Image.open(thumb.path).size, (50, 100))
+
     def test_thumbnail_fit(self):
         # Set paths
         orig = 'test_images/imagetest.jpg'
@@ -180,3 +316,1131 @@ class EmbedResizeTest(BaseEmbedTest):
         self.assertTrue(os.path.isfile(os.path.join(thumb_path)))
         self.assertTrue('method=' not in content)
 
+
+
+class StatCacheTest(TestCase):
+
+    def setUp(self):
+        from webmedia.cache import StatCache
+        self.settings_bkp = app_settings.STAT_CACHE_TIMEOUT
+        app_settings.STAT_CACHE_TIMEOUT = 60
+        self.cache = StatCache(size=2)
+        self.path = os.path.join(settings.MEDIA_ROOT, 'statcache.txt')
+        open(self.path, 'w').close()
+
+    def tearDown(self):
+        app_settings.STAT_CACHE_TIMEOUT = self.settings_bkp
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def test_cached(self):
+        mtime = self.cache.getmtime(self.path)
+        os.utime(self.path, (mtime - 10, mtime - 10))
+        self.assertEquals(self.cache.getmtime(self.path), mtime)
+        self.assertEquals(self.cache.stats()['hits'], 1)
+        self.assertEquals(self.cache.stats()['misses'], 1)
+
+        self.cache.invalidate(self.path)
+        self.assertEquals(self.cache.getmtime(self.path), mtime - 10)
+
+    def test_missing(self):
+        os.remove(self.path)
+        self.assertFalse(self.cache.isfile(self.path))
+        self.assertRaises(OSError, self.cache.getmtime, self.path)
+
+    def test_eviction(self):
+        for name in ['a', 'b', 'c']:
+            self.cache.stat(os.path.join(settings.MEDIA_ROOT, name))
+        self.assertEquals(self.cache.stats()['size'], 2)
+
+    def test_disabled(self):
+        app_settings.STAT_CACHE_TIMEOUT = 0
+        mtime = self.cache.getmtime(self.path)
+        os.utime(self.path, (mtime - 10, mtime - 10))
+        self.assertEquals(self.cache.getmtime(self.path), mtime - 10)
+
+
+class ManifestTest(TestCase):
+
+    def setUp(self):
+        self.settings_bkp = app_settings.THUMBNAIL_MANIFEST
+        app_settings.THUMBNAIL_MANIFEST = os.path.join(app_settings.THUMBNAIL_ROOT, 'manifest-test.sqlite')
+        self.image_filename = 'manifesttest.jpg'
+        self.image_path = os.path.join(settings.MEDIA_ROOT, self.image_filename)
+        create_image(self.image_path, width=100, height=100)
+
+    def tearDown(self):
+        from webmedia import manifest
+        manifest._manifests.clear()
+        os.remove(app_settings.THUMBNAIL_MANIFEST)
+        app_settings.THUMBNAIL_MANIFEST = self.settings_bkp
+        os.remove(self.image_path)
+
+    def make_thumb(self):
+        thumb = Thumbnail(self.image_filename, width=50, height=40, method=Thumbnail.FIT)
+        thumb.generate()
+        return thumb
+
+    def test_warm(self):
+        thumb = self.make_thumb()
+        self.assertEquals((thumb.attrs['width'], thumb.attrs['height']), (40, 40))
+
+        # The original isn't opened while it's unchanged
+        opened = []
+        image_open = Image.open
+        def counting_open(path, *args):
+            opened.append(path)
+            return image_open(path, *args)
+        from webmedia.processors import image
+        image.Image.open = counting_open
+        try:
+            thumb = self.make_thumb()
+        finally:
+            image.Image.open = image_open
+        self.assertEquals(opened, [])
+        self.assertEquals((thumb.attrs['width'], thumb.attrs['height']), (40, 40))
+
+        # Thumbnails removed behind its back are generated again
+        from webmedia.cache import stat_cache
+        os.remove(thumb.path)
+        stat_cache.invalidate(thumb.path)
+        thumb = self.make_thumb()
+        self.assertTrue(os.path.isfile(thumb.path))
+        self.assertEquals((thumb.attrs['width'], thumb.attrs['height']), (40, 40))
+
+    def test_original_changed(self):
+        thumb = self.make_thumb()
+        os.remove(thumb.path)
+        mtime = os.path.getmtime(self.image_path) + 5
+        os.utime(self.image_path, (mtime, mtime))
+        thumb = self.make_thumb()
+        self.assertTrue(os.path.isfile(thumb.path))
+        os.remove(thumb.path)
+
+
+class AsyncThumbnailTest(BaseEmbedTest):
+
+    def setUp(self):
+        self.settings_bkp = app_settings.THUMBNAIL_ASYNC, app_settings.THUMBNAIL_ASYNC_FALLBACK
+        app_settings.THUMBNAIL_ASYNC = True
+        app_settings.THUMBNAIL_ASYNC_FALLBACK = None
+        self.path = os.path.join(settings.MEDIA_ROOT, 'test_async')
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        create_image(os.path.join(self.path, 'imagetest.jpg'), width=200, height=100)
+
+    def tearDown(self):
+        app_settings.THUMBNAIL_ASYNC, app_settings.THUMBNAIL_ASYNC_FALLBACK = self.settings_bkp
+        for path in [self.path, os.path.join(app_settings.THUMBNAIL_ROOT, 'test_async')]:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+
+    def test_fallback(self):
+        from webmedia.workers import get_pool
+        tag = '{% embed "test_async/imagetest.jpg",width="50",height="50",method="fit" %}'
+
+        content = self.render_tag(tag)
+        self.assertTrue('src="/media/test_async/imagetest.jpg' in content, content)
+        self.assertTrue(' width="50"' in content, content)
+        self.assertTrue(' height="25"' in content, content)
+
+        get_pool().join()
+        content = self.render_tag(tag)
+        self.assertTrue('test_async/imagetest_jpg__w50_h50_mf.jpg' in content, content)
+
+    def test_placeholder(self):
+        app_settings.THUMBNAIL_ASYNC_FALLBACK = '/media/loading.gif'
+        content = self.render_tag('{% embed "test_async/imagetest.jpg",width="50",height="50" %}')
+        self.assertTrue('src="/media/loading.gif"' in content, content)
+        from webmedia.workers import get_pool
+        get_pool().join()
+
+
+class SingleFlightTest(TestCase):
+
+    def setUp(self):
+        self.image_filename = 'flighttest.jpg'
+        self.image_path = os.path.join(settings.MEDIA_ROOT, self.image_filename)
+        create_image(self.image_path, width=2000, height=2000)
+        self.thumb = Thumbnail(self.image_filename, width=50, height=40, method=Thumbnail.CROP)
+
+    def tearDown(self):
+        os.remove(self.image_path)
+        if os.path.isfile(self.thumb.path):
+            os.remove(self.thumb.path)
+
+    def test_threads(self):
+        import threading
+        results = []
+        def run():
+            results.append(generate_in_process(self.image_filename))
+        threads = [threading.Thread(target=run) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(results.count(True), 1)
+
+    def test_processes(self):
+        from multiprocessing import Pool
+        pool = Pool(8)
+        try:
+            results = pool.map(generate_in_process, [self.image_filename] * 32)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEquals(results.count(True), 1)
+        self.assertEquals(Image.open(self.thumb.path).size, (50, 40))
+        # No temporary files left behind
+        dirname, filename = os.path.split(self.thumb.path)
+        self.assertFalse([f for f in os.listdir(dirname) if f.startswith('.' + filename)])
+
+
+class PregenerateTest(TestCase):
+
+    def setUp(self):
+        self.settings_bkp = app_settings.THUMBNAIL_PRESETS
+        app_settings.THUMBNAIL_PRESETS = {
+            'small': {'width': 50, 'height': 40, 'method': 'crop'},
+            'medium': {'width': 80, 'height': 80, 'method': 'fit'},
+        }
+        self.path = os.path.join(settings.MEDIA_ROOT, 'test_pregenerate')
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        create_image(os.path.join(self.path, 'imagetest.jpg'), width=200, height=100)
+
+    def tearDown(self):
+        app_settings.THUMBNAIL_PRESETS = self.settings_bkp
+        for path in [self.path, os.path.join(app_settings.THUMBNAIL_ROOT, 'test_pregenerate')]:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+
+    def test_pregenerate(self):
+        from django.core.management import call_command
+        thumb_path = os.path.join(app_settings.THUMBNAIL_ROOT, 'test_pregenerate')
+
+        call_command('webmedia_pregenerate', 'test_pregenerate/*.jpg', dry_run=True, verbosity=0)
+        self.assertFalse(os.path.isdir(thumb_path))
+
+        call_command('webmedia_pregenerate', 'test_pregenerate/*.jpg', processes=1, verbosity=0)
+        self.assertEquals(sorted(os.listdir(thumb_path)), [
+            'imagetest_jpg__w50_h40_mc.jpg', 'imagetest_jpg__w80_h80_mf.jpg'])
+
+        # Up to date thumbnails aren't generated again
+        mtime = os.path.getmtime(os.path.join(thumb_path, 'imagetest_jpg__w50_h40_mc.jpg'))
+        call_command('webmedia_pregenerate', 'test_pregenerate/*.jpg', processes=1, verbosity=0)
+        self.assertEquals(os.path.getmtime(os.path.join(thumb_path, 'imagetest_jpg__w50_h40_mc.jpg')), mtime)
+
+
+class HashVersioningTest(BaseEmbedTest):
+
+    def setUp(self):
+        from webmedia import versioning
+        self.settings_bkp = (app_settings.VERSIONING, app_settings.ASSET_MANIFEST,
+                             app_settings.HASHED_FILENAMES)
+        app_settings.VERSIONING = 'hash'
+        app_settings.ASSET_MANIFEST = os.path.join(settings.MEDIA_ROOT, 'test-assets.json')
+        versioning._manifests.clear()
+        self.path = os.path.join(settings.MEDIA_ROOT, 'test_versioning')
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        f = open(os.path.join(self.path, 'style.css'), 'w')
+        f.write('body { color: red; }')
+        f.close()
+        self.digest = versioning.file_hash(os.path.join(self.path, 'style.css'))
+
+    def tearDown(self):
+        from webmedia import versioning
+        os.remove(app_settings.ASSET_MANIFEST)
+        (app_settings.VERSIONING, app_settings.ASSET_MANIFEST,
+         app_settings.HASHED_FILENAMES) = self.settings_bkp
+        versioning._manifests.clear()
+        shutil.rmtree(self.path)
+
+    def test_query_string(self):
+        from django.core.management import call_command
+        call_command('webmedia_hashassets', verbosity=0)
+        content = self.render_tag('{% embed "test_versioning/style.css" %}')
+        self.assertTrue('href="/media/test_versioning/style.css?v=%s"' % self.digest in content, content)
+
+    def test_hashed_filename(self):
+        from django.core.management import call_command
+        app_settings.HASHED_FILENAMES = True
+        call_command('webmedia_hashassets', verbosity=0)
+        self.assertTrue(os.path.isfile(os.path.join(self.path, 'style.%s.css' % self.digest)))
+        content = self.render_tag('{% embed "test_versioning/style.css" %}')
+        self.assertTrue('href="/media/test_versioning/style.%s.css"' % self.digest in content, content)
+
+        # Hashed copies aren't hashed again
+        call_command('webmedia_hashassets', verbosity=0)
+        from webmedia.versioning import get_asset_manifest
+        assets = [k for k in get_asset_manifest().assets if k.startswith('test_versioning/')]
+        self.assertEquals(assets, ['test_versioning/style.css'])
+
+
+class FragmentCacheTest(BaseEmbedTest):
+
+    def setUp(self):
+        from webmedia.fragments import fragment_cache
+        self.settings_bkp = app_settings.EMBED_CACHE
+        app_settings.EMBED_CACHE = True
+        fragment_cache.clear()
+        self.path = os.path.join(settings.MEDIA_ROOT, 'fragmenttest.css')
+        open(self.path, 'w').close()
+
+    def tearDown(self):
+        app_settings.EMBED_CACHE = self.settings_bkp
+        os.remove(self.path)
+
+    def test_cached(self):
+        from webmedia.fragments import fragment_cache
+        first = self.render_tag('{% embed "fragmenttest.css" %}')
+        self.assertEquals(self.render_tag('{% embed "fragmenttest.css" %}'), first)
+        self.assertEquals(fragment_cache.stats()['local']['hits'], 1)
+
+        # Different attributes are cached separately
+        self.render_tag('{% embed "fragmenttest.css" media="print" %}')
+        self.assertEquals(fragment_cache.stats()['local']['hits'], 1)
+
+    def test_source_changed(self):
+        first = self.render_tag('{% embed "fragmenttest.css" %}')
+        mtime = os.path.getmtime(self.path) - 3600
+        os.utime(self.path, (mtime, mtime))
+        self.assertNotEqual(self.render_tag('{% embed "fragmenttest.css" %}'), first)
+
+    def test_settings_changed(self):
+        first = self.render_tag('{% embed "fragmenttest.css" %}')
+        settings_bkp = app_settings.FILETYPES_ATTRIBUTES
+        app_settings.FILETYPES_ATTRIBUTES = {'stylesheet': {'media': 'print'}}
+        try:
+            self.assertTrue('media="print"' in self.render_tag('{% embed "fragmenttest.css" %}'))
+        finally:
+            app_settings.FILETYPES_ATTRIBUTES = settings_bkp
+
+
+    def test_settings_key(self):
+        from webmedia.fragments import settings_key
+        key = settings_key()
+        # Keyed on the values, not the objects
+        settings_bkp = app_settings.FILETYPES_ATTRIBUTES
+        app_settings.FILETYPES_ATTRIBUTES = dict(settings_bkp)
+        try:
+            self.assertEquals(settings_key(), key)
+            app_settings.FILETYPES_ATTRIBUTES = {'stylesheet': {'media': 'print'}}
+            self.assertNotEqual(settings_key(), key)
+        finally:
+            app_settings.FILETYPES_ATTRIBUTES = settings_bkp
+        self.assertEquals(settings_key(), key)
+
+    def test_settings_changed_hook(self):
+        from webmedia.fragments import settings_changed, settings_key
+        key = settings_key()
+        settings_bkp = app_settings.IMAGE_LAZY_AFTER
+        app_settings.IMAGE_LAZY_AFTER = 100
+        try:
+            # Not hashed again until told so
+            self.assertEquals(settings_key(), key)
+            settings_changed()
+            self.assertNotEqual(settings_key(), key)
+        finally:
+            app_settings.IMAGE_LAZY_AFTER = settings_bkp
+            settings_changed()
+        self.assertEquals(settings_key(), key)
+
+
+class VariantTest(BaseEmbedTest):
+
+    def setUp(self):
+        self.settings_bkp = app_settings.IMAGE_VARIANTS
+        app_settings.IMAGE_VARIANTS = ('WEBP',)
+        self.image_filename = 'varianttest.png'
+        self.image_path = os.path.join(settings.MEDIA_ROOT, self.image_filename)
+        # Noise compresses much better as lossy WebP than as PNG
+        noise = Image.frombuffer('RGB', (400, 400), os.urandom(400 * 400 * 3), 'raw', 'RGB', 0, 1)
+        noise.save(self.image_path)
+
+    def tearDown(self):
+        app_settings.IMAGE_VARIANTS = self.settings_bkp
+        os.remove(self.image_path)
+        for name in ['varianttest_png__w50_h40_mc.png', 'varianttest_png__w50_h40_mc.webp']:
+            path = os.path.join(app_settings.THUMBNAIL_ROOT, name)
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def test_picture(self):
+        Image.init()
+        if 'WEBP' not in Image.SAVE:
+            return
+        content = self.render_tag('{% embed "varianttest.png",width=50,height=40 %}')
+        # Versioned like the src
+        self.assertTrue(re.match(r'<picture><source type="image/webp" srcset="%s%s\?[\d-]+" />' % (
+            re.escape(app_settings.THUMBNAIL_URL), r'varianttest_png__w50_h40_mc\.webp'), content), content)
+        self.assertTrue('<img src="%svarianttest_png__w50_h40_mc.png' % app_settings.THUMBNAIL_URL in content, content)
+
+    def test_quality(self):
+        from webmedia.processors.image import get_quality
+        app_settings.IMAGE_QUALITY, quality_bkp = {'WEBP': 70, 'default': 85}, app_settings.IMAGE_QUALITY
+        try:
+            self.assertEquals(get_quality('WEBP'), 70)
+            self.assertEquals(get_quality('JPG'), 85)
+            self.assertEquals(Thumbnail(self.image_filename, width=50).quality, 85)
+        finally:
+            app_settings.IMAGE_QUALITY = quality_bkp
+
+
+class BundleTest(BaseEmbedTest):
+
+    def setUp(self):
+        self.path = os.path.join(settings.MEDIA_ROOT, 'test_bundle')
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.write('a.css', '/* first */\nbody {\n    color: red;\n}\n')
+        self.write('b.css', 'p { margin: 0 }\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        shutil.rmtree(app_settings.BUNDLE_ROOT)
+
+    def write(self, name, content):
+        f = open(os.path.join(self.path, name), 'w')
+        f.write(content)
+        f.close()
+
+    def bundle_content(self, content):
+        url = re.search(r'href="([^"]+)"', content).group(1)
+        self.assertTrue(url.startswith(app_settings.BUNDLE_URL), url)
+        return open(os.path.join(app_settings.BUNDLE_ROOT, url[len(app_settings.BUNDLE_URL):])).read()
+
+    def test_bundle(self):
+        content = self.render_tag('{% bundle "test_bundle/a.css" "test_bundle/b.css" name="base" %}')
+        self.assertTrue('<link rel="stylesheet" href="%sbase.' % app_settings.BUNDLE_URL in content, content)
+        self.assertEquals(self.bundle_content(content),
+                          '/* first */\nbody {\n    color: red;\n}\n\np { margin: 0 }\n')
+
+        # Unchanged inputs render the same bundle
+        self.assertEquals(self.render_tag('{% bundle "test_bundle/a.css" "test_bundle/b.css" name="base" %}'), content)
+
+        # Changed inputs create a new bundle
+        self.write('b.css', 'p { margin: 1px }\n')
+        mtime = os.path.getmtime(os.path.join(self.path, 'b.css')) + 5
+        os.utime(os.path.join(self.path, 'b.css'), (mtime, mtime))
+        changed = self.render_tag('{% bundle "test_bundle/a.css" "test_bundle/b.css" name="base" %}')
+        self.assertNotEqual(changed, content)
+
+    def test_minify(self):
+        content = self.render_tag('{% bundle "test_bundle/a.css" "test_bundle/b.css" minify="1" %}')
+        self.assertEquals(self.bundle_content(content), 'body{color: red}\np{margin: 0}')
+
+    def test_minify_strings(self):
+        from webmedia.bundles import minify_css
+        self.assertEquals(minify_css('/* don\'t */ p { content: "a  ;  b" ; }\n'
+                                     'a:after { content: \'/* x */\' }'),
+                          'p{content: "a  ;  b"}a:after{content: \'/* x */\'}')
+
+    def test_css_urls(self):
+        os.makedirs(os.path.join(self.path, 'css'))
+        self.write('css/site.css', 'a { background: url(img/x.png) }\n'
+                                   'b { background: url("../y.png") }\n'
+                                   'i { background: url(/media/z.png) url(data:image/gif;base64,R0) }\n')
+        content = self.render_tag('{% bundle "test_bundle/css/site.css" %}')
+        self.assertEquals(self.bundle_content(content),
+                          'a { background: url(/media/test_bundle/css/img/x.png) }\n'
+                          'b { background: url("/media/test_bundle/y.png") }\n'
+                          'i { background: url(/media/z.png) url(data:image/gif;base64,R0) }\n')
+
+
+class PrecompressTest(BaseEmbedTest):
+
+    def setUp(self):
+        self.settings_bkp = app_settings.PRECOMPRESS, app_settings.PRECOMPRESS_MIN_SIZE
+        app_settings.PRECOMPRESS = True
+        app_settings.PRECOMPRESS_MIN_SIZE = 100
+        self.path = os.path.join(settings.MEDIA_ROOT, 'test_precompress')
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.content = 'body { color: red; }\n' * 20
+        for name, content in [('big.js', self.content), ('small.js', 'var a;')]:
+            f = open(os.path.join(self.path, name), 'w')
+            f.write(content)
+            f.close()
+
+    def tearDown(self):
+        app_settings.PRECOMPRESS, app_settings.PRECOMPRESS_MIN_SIZE = self.settings_bkp
+        shutil.rmtree(self.path)
+
+    def test_embed(self):
+        import gzip
+        self.render_tag('{% embed "test_precompress/big.js" %}{% embed "test_precompress/small.js" %}')
+        gz_path = os.path.join(self.path, 'big.js.gz')
+        self.assertEquals(gzip.open(gz_path).read(), self.content)
+        self.assertEquals(os.path.getmtime(gz_path), os.path.getmtime(os.path.join(self.path, 'big.js')))
+        self.assertFalse(os.path.isfile(os.path.join(self.path, 'small.js.gz')))
+
+    def test_incremental(self):
+        from webmedia.compression import Compressor
+        compressor = Compressor()
+        big = os.path.join(self.path, 'big.js')
+        self.assertEquals(compressor.compress(big)[0], big + '.gz')
+        self.assertEquals(Compressor().compress(big), [])
+
+        mtime = os.path.getmtime(big) + 5
+        os.utime(big, (mtime, mtime))
+        self.assertEquals(compressor.compress(big)[0], big + '.gz')
+
+
+class InstrumentationTest(BaseEmbedTest):
+
+    def setUp(self):
+        from webmedia.stats import stats
+        self.settings_bkp = app_settings.INSTRUMENTATION
+        app_settings.INSTRUMENTATION = True
+        stats.reset()
+        self.path = os.path.join(settings.MEDIA_ROOT, 'test_instrumentation')
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        create_image(os.path.join(self.path, 'imagetest.jpg'))
+
+    def tearDown(self):
+        app_settings.INSTRUMENTATION = self.settings_bkp
+        for path in [self.path, os.path.join(app_settings.THUMBNAIL_ROOT, 'test_instrumentation')]:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+
+    def test_stats(self):
+        from webmedia import signals
+        from webmedia.stats import stats
+        received = []
+        def receiver(sender, name, **kwargs):
+            received.append(name)
+        signals.counter.connect(receiver)
+        try:
+            tag = '{% embed "test_instrumentation/imagetest.jpg",width=50,height=40 %}'
+            self.render_tag(tag)
+            self.render_tag(tag)
+        finally:
+            signals.counter.disconnect(receiver)
+
+        snapshot = stats.snapshot()
+        self.assertEquals(snapshot['counters']['thumbnail.generated'], 1)
+        self.assertEquals(snapshot['counters']['thumbnail.skipped'], 1)
+        self.assertEquals(snapshot['counters']['thumbnail.decoded_pixels'], 100 * 100)
+        self.assertTrue(snapshot['counters']['thumbnail.bytes_written'] > 0)
+        self.assertEquals(snapshot['timings']['process_file']['count'], 2)
+        self.assertEquals(snapshot['timings']['processor.webmedia.processors.image.thumbnail']['count'], 2)
+        self.assertEquals(snapshot['timings']['thumbnail.crop']['count'], 1)
+        self.assertTrue('thumbnail.generated' in received)
+
+    def test_disabled(self):
+        from webmedia.stats import stats
+        app_settings.INSTRUMENTATION = False
+        self.render_tag('{% embed "test_instrumentation/imagetest.jpg",width=50,height=40 %}')
+        self.assertEquals(stats.snapshot(), {'timings': {}, 'counters': {}})
+
+
+class MemoryLimitTest(BaseEmbedTest):
+
+    def setUp(self):
+        self.settings_bkp = (app_settings.IMAGE_MAX_PIXELS, app_settings.IMAGE_FAST_DECODE)
+        self.path = os.path.join(settings.MEDIA_ROOT, 'test_limits')
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def tearDown(self):
+        app_settings.IMAGE_MAX_PIXELS, app_settings.IMAGE_FAST_DECODE = self.settings_bkp
+        for path in [self.path, os.path.join(app_settings.THUMBNAIL_ROOT, 'test_limits')]:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+
+    def test_refused(self):
+        create_image(os.path.join(self.path, 'imagetest.png'), width=400, height=200)
+        app_settings.IMAGE_MAX_PIXELS = 400 * 200 - 1
+        content = self.render_tag('{% embed "test_limits/imagetest.png",width=100,height=100,method="fit" %}')
+        self.assertTrue('src="/media/test_limits/imagetest.png' in content, content)
+        self.assertTrue(' width="100"' in content and ' height="50"' in content, content)
+
+    def test_draft(self):
+        from webmedia.processors.image import ImageTooLarge
+        create_image(os.path.join(self.path, 'imagetest.jpg'), width=400, height=400)
+        app_settings.IMAGE_FAST_DECODE = False
+        app_settings.IMAGE_MAX_PIXELS = 100 * 100
+        # Decoded at an eighth of its size, within the limit
+        thumb = Thumbnail('test_limits/imagetest.jpg', width=50, height=50)
+        self.assertTrue(thumb.generate())
+        self.assertEquals(Image.open(thumb.path).size, (50, 50))
+        # Too big even when drafted
+        thumb = Thumbnail('test_limits/imagetest.jpg', width=10, height=10)
+        app_settings.IMAGE_MAX_PIXELS = 10 * 10
+        self.assertRaises(ImageTooLarge, thumb.generate)
+
+    def test_budget(self):
+        import threading
+        from webmedia.locks import PixelBudget
+        budget = PixelBudget(100)
+        self.assertTrue(budget.acquire(60))
+        self.assertFalse(budget.acquire(60, timeout=0.01))
+        # Requests over the budget wait for it to be free
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(budget.acquire(1000)))
+        thread.start()
+        budget.release(60)
+        thread.join()
+        self.assertEquals(acquired, [True])
+        self.assertEquals(budget.used, 100)
+        budget.release(1000)
+        self.assertEquals(budget.used, 0)
+
+
+class EvictionTest(TestCase):
+
+    def setUp(self):
+        self.settings_bkp = (app_settings.THUMBNAIL_ROOT, app_settings.THUMBNAIL_ACCESS_INTERVAL)
+        app_settings.THUMBNAIL_ROOT = os.path.join(settings.MEDIA_ROOT, 'test_eviction_thumbs')
+        self.path = os.path.join(settings.MEDIA_ROOT, 'test_eviction')
+        self.thumb_path = os.path.join(app_settings.THUMBNAIL_ROOT, 'test_eviction')
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        for name in ['first.jpg', 'second.jpg']:
+            create_image(os.path.join(self.path, name))
+        self.thumbs = []
+        for name in ['first.jpg', 'second.jpg']:
+            for width in [10, 20, 30]:
+                thumb = Thumbnail('test_eviction/' + name, width=width, height=width)
+                thumb.generate()
+                self.thumbs.append(thumb)
+        # Not a thumbnail
+        open(os.path.join(self.thumb_path, 'notes.txt'), 'w').close()
+
+    def tearDown(self):
+        for path in [self.path, app_settings.THUMBNAIL_ROOT]:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+        app_settings.THUMBNAIL_ROOT, app_settings.THUMBNAIL_ACCESS_INTERVAL = self.settings_bkp
+
+    def test_orphans(self):
+        from webmedia.eviction import Collector
+        os.remove(os.path.join(self.path, 'second.jpg'))
+        results = Collector().collect()
+        self.assertEquals(results['orphans'], 3)
+        for thumb in self.thumbs:
+            self.assertEquals(os.path.isfile(thumb.path), thumb.original_src.endswith('first.jpg'))
+        self.assertTrue(os.path.isfile(os.path.join(self.thumb_path, 'notes.txt')))
+
+    def test_lru(self):
+        from webmedia.eviction import AccessTracker, Collector
+        mtimes = [os.path.getmtime(thumb.path) for thumb in self.thumbs]
+        for i, thumb in enumerate(self.thumbs):
+            os.utime(thumb.path, (1000 + i, mtimes[i]))
+        # Recently used
+        app_settings.THUMBNAIL_ACCESS_INTERVAL = 0
+        AccessTracker().touch(self.thumbs[0].path)
+
+        size = sum([os.path.getsize(thumb.path) for thumb in self.thumbs[-3:]])
+        results = Collector(max_size=size + os.path.getsize(self.thumbs[0].path)).collect()
+        self.assertEquals(results['evicted'], 2)
+        self.assertEquals([os.path.isfile(thumb.path) for thumb in self.thumbs],
+                          [True, False, False, True, True, True])
+        self.assertEquals(os.path.getmtime(self.thumbs[0].path), mtimes[0])
+
+    def test_siblings(self):
+        from webmedia.eviction import Collector
+        variant = os.path.splitext(self.thumbs[0].path)[0] + '.webp'
+        shutil.copy(self.thumbs[0].path, variant)
+        for i, path in enumerate([thumb.path for thumb in self.thumbs] + [variant]):
+            os.utime(path, (1000 + i, os.path.getmtime(path)))
+        # Used with the thumbnail, even if not touched
+        os.utime(variant, (1, os.path.getmtime(variant)))
+        os.utime(self.thumbs[0].path, (5000, os.path.getmtime(self.thumbs[0].path)))
+
+        size = os.path.getsize(self.thumbs[0].path) + os.path.getsize(variant)
+        results = Collector(max_size=size).collect()
+        self.assertEquals(results['evicted'], 5)
+        self.assertTrue(os.path.isfile(self.thumbs[0].path) and os.path.isfile(variant))
+
+    def test_fragment_cache(self):
+        from webmedia.fragments import fragment_cache
+        app_settings.THUMBNAIL_ACCESS_INTERVAL = 0
+        settings_bkp = app_settings.EMBED_CACHE
+        app_settings.EMBED_CACHE = True
+        fragment_cache.clear()
+        t = template.Template('{% load webmedia_tags %}{% embed "test_eviction/first.jpg" width=10 height=10 %}')
+        try:
+            t.render(template.Context())
+            path = self.thumbs[0].path
+            os.utime(path, (1000, os.path.getmtime(path)))
+            # Cached fragments still record their thumbnails' use
+            t.render(template.Context())
+            self.assertEquals(fragment_cache.stats()['local']['hits'], 1)
+            self.assertTrue(os.stat(path).st_atime > 1000)
+        finally:
+            app_settings.EMBED_CACHE = settings_bkp
+
+    def test_sweep(self):
+        from webmedia.eviction import Collector, HISTOGRAM_BUCKET
+        os.remove(os.path.join(self.path, 'first.jpg'))
+        for i, thumb in enumerate(self.thumbs):
+            os.utime(thumb.path, (i * HISTOGRAM_BUCKET, os.path.getmtime(thumb.path)))
+        collector = lambda: Collector(max_size=os.path.getsize(self.thumbs[-1].path))
+
+        # Orphans are removed as directories are swept
+        state = {}
+        collector().sweep(state, 1)
+        self.assertEquals(state['cursor'], 'test_eviction')
+        self.assertEquals([os.path.isfile(thumb.path) for thumb in self.thumbs],
+                          [False, False, False, True, True, True])
+
+        # Done with the tree, the next cycle evicts all but the last used
+        collector().sweep(state, 1)
+        self.assertEquals(state['cursor'], None)
+        self.assertEquals(state['cutoff'], 5 * HISTOGRAM_BUCKET)
+        collector().sweep(state, 1)
+        self.assertEquals([os.path.isfile(thumb.path) for thumb in self.thumbs[3:]],
+                          [False, False, True])
+
+
+class NamingTest(TestCase):
+
+    def setUp(self):
+        self.settings_bkp = (app_settings.THUMBNAIL_ROOT, app_settings.THUMBNAIL_NAMING)
+        app_settings.THUMBNAIL_ROOT = os.path.join(settings.MEDIA_ROOT, 'test_naming_thumbs')
+        self.path = os.path.join(settings.MEDIA_ROOT, 'test_naming')
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        create_image(os.path.join(self.path, 'imagetest.jpg'))
+
+    def tearDown(self):
+        for path in [self.path, app_settings.THUMBNAIL_ROOT]:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+        app_settings.THUMBNAIL_ROOT, app_settings.THUMBNAIL_NAMING = self.settings_bkp
+
+    def test_hashed(self):
+        app_settings.THUMBNAIL_NAMING = 'hashed'
+        thumb = Thumbnail('test_naming/imagetest.jpg', width=50, height=40)
+        self.assertTrue(re.match(r'^[0-9a-f]{2}/[0-9a-f]{2}/imagetest_[0-9a-f]{16}\.jpg$', thumb.src), thumb.src)
+        # Every parameter changes the name
+        for attrs in [{'quality': 50}, {'method': 'fit'}, {'profile': 'web'}, {'format': 'png'}]:
+            self.assertNotEquals(Thumbnail('test_naming/imagetest.jpg', width=50, height=40, **attrs).src, thumb.src)
+        self.assertTrue(thumb.generate())
+        self.assertEquals(Image.open(thumb.path).size, (50, 40))
+
+    def test_migrate(self):
+        from django.core.management import call_command
+        thumb = Thumbnail('test_naming/imagetest.jpg', width=50, height=40, profile='web')
+        thumb.generate()
+        call_command('webmedia_migratethumbs', verbosity=0)
+        self.assertFalse(os.path.isfile(thumb.path))
+
+        app_settings.THUMBNAIL_NAMING = 'hashed'
+        thumb = Thumbnail('test_naming/imagetest.jpg', width=50, height=40, profile='web')
+        self.assertTrue(os.path.isfile(thumb.path))
+        self.assertFalse(thumb.generate())
+
+
+class LazyImageTest(BaseEmbedTest):
+
+    def setUp(self):
+        from webmedia.state import state
+        self.settings_bkp = (app_settings.IMAGE_LAZY_AFTER, app_settings.IMAGE_PLACEHOLDER)
+        self.path = os.path.join(settings.MEDIA_ROOT, 'test_lazy')
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        create_image(os.path.join(self.path, 'imagetest.jpg'), width=120, height=80)
+        state.reset()
+
+    def tearDown(self):
+        app_settings.IMAGE_LAZY_AFTER, app_settings.IMAGE_PLACEHOLDER = self.settings_bkp
+        for path in [self.path, os.path.join(app_settings.THUMBNAIL_ROOT, 'test_lazy')]:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+
+    def test_dimensions(self):
+        content = self.render_tag('{% embed "test_lazy/imagetest.jpg" %}')
+        self.assertTrue(' width="120"' in content and ' height="80"' in content, content)
+
+    def test_lazy(self):
+        app_settings.IMAGE_LAZY_AFTER = 1
+        content = self.render_tag('{% embed "test_lazy/imagetest.jpg" %}|'
+                                  '{% embed "test_lazy/imagetest.jpg" %}|'
+                                  '{% embed "test_lazy/imagetest.jpg" loading="eager" %}')
+        first, second, third = content.split('|')
+        self.assertFalse('loading=' in first, first)
+        self.assertTrue('loading="lazy"' in second and 'decoding="async"' in second, second)
+        self.assertTrue('loading="eager"' in third and 'decoding=' not in third, third)
+
+        # Counted again in each request
+        from django.core.signals import request_started
+        request_started.send(sender=self.__class__)
+        self.assertFalse('loading=' in self.render_tag('{% embed "test_lazy/imagetest.jpg" %}'))
+
+    def test_placeholder(self):
+        app_settings.IMAGE_PLACEHOLDER = True
+        content = self.render_tag('{% embed "test_lazy/imagetest.jpg",width=60,height=40 %}')
+        self.assertTrue('style="background-size:cover;background-image:url(data:image/jpeg;base64,' in content, content)
+        thumb = Thumbnail('test_lazy/imagetest.jpg', width=60, height=40)
+        self.assertTrue(os.path.isfile(thumb.placeholder_path))
+
+        # Written from existing thumbnails
+        os.remove(thumb.placeholder_path)
+        content = self.render_tag('{% embed "test_lazy/imagetest.jpg",width=60,height=40,style="border:0" %}')
+        self.assertTrue('style="border:0;background-size:cover;' in content, content)
+
+
+class EmbedNodeTest(BaseEmbedTest):
+
+    def setUp(self):
+        self.settings_bkp = app_settings.PROCESSORS
+        app_settings.PROCESSORS = {}
+
+    def tearDown(self):
+        app_settings.PROCESSORS = self.settings_bkp
+
+    def test_literals(self):
+        from webmedia.templatetags.webmedia_tags import EmbedNode
+        t = template.Template('{% load webmedia_tags %}{% embed "logo.gif",width=10 alt=title %}')
+        node = [n for n in t.nodelist if isinstance(n, EmbedNode)][0]
+        self.assertEquals(node.literal_src, 'logo.gif')
+        self.assertEquals(node.attrs, {'width': 10})
+        self.assertEquals(node.variables.keys(), ['alt'])
+
+        content = t.render(template.Context({'title': 'Logo'}))
+        self.assertTrue('<img src="/media/logo.gif" ' in content, content)
+        self.assertTrue(' width="10"' in content and ' alt="Logo"' in content, content)
+        self.assertEquals(node.prepared, ('/media/logo.gif', 'image', {}))
+
+        # Prepared again when the settings change
+        attributes_bkp = app_settings.FILETYPES_ATTRIBUTES
+        app_settings.FILETYPES_ATTRIBUTES = dict(attributes_bkp, image={'border': '0'})
+        try:
+            self.assertTrue(' border="0"' in t.render(template.Context({'title': 'Logo'})))
+        finally:
+            app_settings.FILETYPES_ATTRIBUTES = attributes_bkp
+
+    def test_translated(self):
+        from webmedia.templatetags.webmedia_tags import EmbedNode
+        t = template.Template('{% load webmedia_tags %}{% embed "logo.gif" alt=_("Logo") %}')
+        node = [n for n in t.nodelist if isinstance(n, EmbedNode)][0]
+        # Translated in the language active when rendering
+        self.assertEquals(node.attrs, {})
+        self.assertEquals(node.variables.keys(), ['alt'])
+        self.assertTrue(' alt="Logo"' in t.render(template.Context()))
+
+    def test_variable_src(self):
+        content = self.render_tag('{% embed src width=size|add:"1" %}', {'src': 'logo.gif', 'size': 9})
+        self.assertTrue('<img src="/media/logo.gif" ' in content and ' width="10"' in content, content)
+        self.assertEquals(self.render_tag('{% embed src %}', {'src': ''}), '')
+
+    def test_syntax(self):
+        for tag in ['{% embed %}', '{% embed "a.gif" "b.gif" %}', '{% embed "a.gif" alt="a" alt="b" %}']:
+            self.assertRaises(template.TemplateSyntaxError, self.render_tag, tag)
+
+    def test_process_filter(self):
+        from webmedia.templatetags.webmedia_tags import _process_args
+        _process_args.clear()
+        tag = '{{ "logo.gif"|process:"width=10,height=20" }}'
+        self.assertEquals(self.render_tag(tag), self.render_tag(tag))
+        self.assertEquals(_process_args.stats()['hits'], 1)
+
+
+class PrefetchTest(BaseEmbedTest):
+
+    def setUp(self):
+        from webmedia.state import state
+        self.path = os.path.join(settings.MEDIA_ROOT, 'test_prefetch')
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        for name in 'abc':
+            create_image(os.path.join(self.path, '%s.jpg' % name))
+        state.reset()
+
+    def tearDown(self):
+        from webmedia.state import state
+        state.reset()
+        for path in [self.path, os.path.join(app_settings.THUMBNAIL_ROOT, 'test_prefetch')]:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+
+    def test_prefetch(self):
+        from django.core.signals import request_started
+        from webmedia.state import state
+        items = [{'image': 'test_prefetch/%s.jpg' % name} for name in 'abca']
+        self.render_tag('{% webmedia_prefetch items "image" width=20 height=20 %}', {'items': items})
+        self.assertEquals(len(state.processed), 3)
+        thumbs = [Thumbnail('test_prefetch/%s.jpg' % name, width=20, height=20) for name in 'abc']
+        for thumb in thumbs:
+            self.assertTrue(os.path.isfile(thumb.path))
+
+        # Embedded from the prefetched results
+        os.remove(thumbs[0].path)
+        content = self.render_tag('{% embed "test_prefetch/a.jpg" width=20 height=20 %}')
+        self.assertTrue(thumbs[0].url in content, content)
+        self.assertFalse(os.path.isfile(thumbs[0].path))
+
+        # Until the next request
+        request_started.send(sender=self.__class__)
+        self.render_tag('{% embed "test_prefetch/a.jpg" width=20 height=20 %}')
+        self.assertTrue(os.path.isfile(thumbs[0].path))
+
+    def test_extra_attributes(self):
+        self.render_tag('{% webmedia_prefetch items "image" width=20 height=20 %}',
+                        {'items': [{'image': 'test_prefetch/a.jpg'}]})
+        thumb = Thumbnail('test_prefetch/a.jpg', width=20, height=20)
+        os.remove(thumb.path)
+
+        # HTML attributes are added to the prefetched result
+        content = self.render_tag('{% embed "test_prefetch/a.jpg" width=20 height=20 alt="A" %}')
+        self.assertTrue(thumb.url in content and 'alt="A"' in content, content)
+        self.assertFalse(os.path.isfile(thumb.path))
+
+        # Other processing attributes are processed again
+        content = self.render_tag('{% embed "test_prefetch/a.jpg" width=20 height=20 method="fit" %}')
+        self.assertTrue(os.path.isfile(Thumbnail('test_prefetch/a.jpg', width=20, height=20,
+                                                 method=Thumbnail.FIT).path))
+
+    def test_scoped(self):
+        from webmedia.state import scoped, state
+        from webmedia.templatetags.webmedia_tags import prefetch
+
+        @scoped
+        def render():
+            prefetch(['test_prefetch/a.jpg'], width=20)
+            return len(state.processed)
+        self.assertEquals(render(), 1)
+        self.assertEquals(state.processed, {})
+
+    def test_api(self):
+        from webmedia.templatetags.webmedia_tags import prefetch
+        self.assertEquals(prefetch(['test_prefetch/a.jpg', 'test_prefetch/a.jpg', '', 'noext'], width=20), 1)
+        self.assertEquals(prefetch(['test_prefetch/a.jpg'], width=20), 0)
+
+
+class ServeTest(BaseEmbedTest):
+
+    def setUp(self):
+        self.settings_bkp = (app_settings.THUMBNAIL_SERVE, app_settings.THUMBNAIL_SENDFILE)
+        app_settings.THUMBNAIL_SERVE = True
+        self.path = os.path.join(settings.MEDIA_ROOT, 'test_serve')
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        create_image(os.path.join(self.path, 'imagetest.jpg'))
+        self.thumb = Thumbnail('test_serve/imagetest.jpg', width=50, height=40)
+
+    def tearDown(self):
+        app_settings.THUMBNAIL_SERVE, app_settings.THUMBNAIL_SENDFILE = self.settings_bkp
+        for path in [self.path, os.path.join(app_settings.THUMBNAIL_ROOT, 'test_serve')]:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+
+    def get_url(self):
+        content = self.render_tag('{% embed "test_serve/imagetest.jpg" width=50 height=40 %}')
+        self.assertTrue(' width="50"' in content and ' height="40"' in content, content)
+        return re.search(r'src="([^"]+)"', content).group(1).replace('&amp;', '&')
+
+    def test_embed(self):
+        url = self.get_url()
+        self.assertTrue(url.startswith('/webmedia/thumbs/test_serve/imagetest.jpg?'), url)
+        self.assertTrue('&s=' in url, url)
+        self.assertFalse(os.path.isfile(self.thumb.path))
+
+    def test_view(self):
+        url = self.get_url()
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Content-Type'], 'image/jpeg')
+        self.assertEquals(response.content, open(self.thumb.path, 'rb').read())
+        self.assertEquals(Image.open(self.thumb.path).size, (50, 40))
+
+        # Conditional requests
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEquals(response.status_code, 304)
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEquals(response.status_code, 304)
+
+        # Tampered parameters
+        self.assertEquals(self.client.get(url.replace('w=50', 'w=500')).status_code, 404)
+
+    def test_removed(self):
+        url = self.get_url()
+        self.assertEquals(self.client.get(url).status_code, 200)
+        # Removed while still in the stat cache
+        os.remove(self.thumb.path)
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.content, open(self.thumb.path, 'rb').read())
+
+    def test_fit(self):
+        content = self.render_tag('{% embed "test_serve/imagetest.jpg" width=50 height=40 method="fit" %}')
+        self.assertFalse(' width=' in content, content)
+        url = re.search(r'src="([^"]+)"', content).group(1).replace('&amp;', '&')
+        self.assertTrue('w=50' in url and 'h=40' in url, url)
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        thumb = Thumbnail('test_serve/imagetest.jpg', width=50, height=40, method=Thumbnail.FIT)
+        self.assertEquals(Image.open(thumb.path).size, (40, 40))
+
+    def test_sendfile(self):
+        app_settings.THUMBNAIL_SENDFILE = 'x-accel-redirect'
+        response = self.client.get(self.get_url())
+        self.assertEquals(response['X-Accel-Redirect'], app_settings.THUMBNAIL_URL + self.thumb.src)
+        self.assertEquals(response.content, '')
+
+class RemoteImageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the image of its server at any path, with an ETag.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(self.headers.get('If-None-Match'))
+        if self.path.endswith('.html'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(self.server.content)))
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+        self.wfile.write(self.server.content)
+
+    def log_message(self, *args):
+        pass
+
+
+class RemoteImageServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, content):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), RemoteImageHandler)
+        self.content = content
+        self.connections = 0
+        self.requests = []
+
+
+class RemoteTest(BaseEmbedTest):
+
+    def setUp(self):
+        self.settings_bkp = (app_settings.REMOTE_IMAGES, app_settings.REMOTE_MAX_AGE,
+                             app_settings.REMOTE_MAX_SIZE, app_settings.THUMBNAIL_ROOT,
+                             app_settings.REMOTE_HOSTS)
+        app_settings.REMOTE_IMAGES = True
+        app_settings.THUMBNAIL_ROOT = os.path.join(settings.MEDIA_ROOT, 'test_remote_thumbs')
+        os.makedirs(app_settings.THUMBNAIL_ROOT)
+        path = os.path.join(app_settings.THUMBNAIL_ROOT, 'test_remote.jpg')
+        create_image(path)
+        content = open(path, 'rb').read()
+        os.remove(path)
+        self.server = RemoteImageServer(content)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.host = '127.0.0.1:%d' % self.server.server_address[1]
+        self.url = 'http://%s/images/photo.jpg' % self.host
+        # Loopback addresses need to be allowed explicitly
+        app_settings.REMOTE_HOSTS = [self.host]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        fetcher.pool.clear()
+        fetcher._checked.clear()
+        shutil.rmtree(app_settings.THUMBNAIL_ROOT)
+        (app_settings.REMOTE_IMAGES, app_settings.REMOTE_MAX_AGE, app_settings.REMOTE_MAX_SIZE,
+         app_settings.THUMBNAIL_ROOT, app_settings.REMOTE_HOSTS) = self.settings_bkp
+
+    def render(self, url=None):
+        return self.render_tag('{%% embed "%s" width=50 height=40 %%}' % (url or self.url))
+
+    def test_thumbnail(self):
+        content = self.render()
+        src = fetcher.cache_src(self.url)
+        self.assertTrue(os.path.isfile(os.path.join(app_settings.THUMBNAIL_ROOT, src)))
+        self.assertTrue(app_settings.THUMBNAIL_URL + os.path.dirname(src) in content, content)
+        self.assertTrue(' width="50"' in content and ' height="40"' in content, content)
+        self.assertEquals(self.server.requests, [None])
+
+        # Cached for REMOTE_MAX_AGE
+        self.render()
+        self.assertEquals(self.server.requests, [None])
+
+    def test_revalidate(self):
+        app_settings.REMOTE_MAX_AGE = 0
+        self.render()
+        self.render()
+        self.assertEquals(self.server.requests, [None, '"v1"'])
+        # Over the same keep-alive connection
+        self.assertEquals(self.server.connections, 1)
+
+    def test_max_size(self):
+        app_settings.REMOTE_MAX_SIZE = 10
+        content = self.render()
+        self.assertTrue('src="%s"' % self.url in content, content)
+        self.assertFalse(os.path.isdir(os.path.join(app_settings.THUMBNAIL_ROOT, 'remote')))
+
+    def test_disabled(self):
+        app_settings.REMOTE_IMAGES = False
+        content = self.render()
+        self.assertTrue('src="%s"' % self.url in content, content)
+        self.assertEquals(self.server.requests, [])
+
+    def test_eviction(self):
+        from webmedia.eviction import Collector
+        from webmedia.processors.image import RemoteThumbnail
+        self.render()
+        src = fetcher.cache_src(self.url)
+        path = os.path.join(app_settings.THUMBNAIL_ROOT, src)
+        thumb = RemoteThumbnail(src, width=50, height=40)
+        os.utime(path, (1000, os.path.getmtime(path)))
+
+        # The download counts towards the budget and is evicted first
+        results = Collector(max_size=os.path.getsize(thumb.path)).collect()
+        self.assertEquals((results['files'], results['evicted']), (2, 1))
+        self.assertFalse(os.path.isfile(path))
+        self.assertFalse(os.path.isfile(fetcher.meta_path(path)))
+
+        # Then its thumbnails
+        results = Collector().collect()
+        self.assertEquals(results['orphans'], 1)
+        self.assertFalse(os.path.isfile(thumb.path))
+
+    def test_extensionless(self):
+        url = 'http://%s/images/123' % self.host
+        content = self.render(url)
+        src = fetcher.cache_src(url)
+        # Named after the format read from the download
+        self.assertTrue(re.search(r'src="%s%s_jpg__w50_h40_mc\.jpg' % (
+            re.escape(app_settings.THUMBNAIL_URL), re.escape(src)), content), content)
+
+        # Not an orphan
+        from webmedia.eviction import Collector
+        self.assertEquals(Collector().collect()['orphans'], 0)
+
+    def test_not_image(self):
+        from webmedia.remote import RemoteError
+        self.assertRaises(RemoteError, fetcher.fetch, 'http://%s/page.html' % self.host)
+        self.assertEquals(len(self.server.requests), 1)
+        self.assertFalse(os.path.isdir(os.path.join(app_settings.THUMBNAIL_ROOT, 'remote')))
+
+    def test_private_hosts(self):
+        from webmedia.remote import is_public_address
+        for address in ['127.0.0.1', '10.1.2.3', '172.16.0.1', '192.168.1.1', '169.254.169.254',
+                        '::1', 'fe80::1', 'fd00::1', '::ffff:127.0.0.1']:
+            self.assertFalse(is_public_address(address), address)
+        for address in ['8.8.8.8', '172.32.0.1', '2001:4860:4860::8888']:
+            self.assertTrue(is_public_address(address), address)
+
+        # Refused without an allowlist
+        app_settings.REMOTE_HOSTS = None
+        content = self.render()
+        self.assertTrue('src="%s"' % self.url in content, content)
+        self.assertEquals(self.server.requests, [])
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+
+from django.conf.urls.defaults import *
+
+urlpatterns = patterns('webmedia.views',
+    url(r'^stats/$', 'stats', name='webmedia-stats'),
+    url(r'^thumbs/(?P<path>.+)$', 'thumbnail', name='webmedia-thumbnail'),
+)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import tempfile
+
+from django.conf import settings
+from django.utils import simplejson
+from django.utils.hashcompat import md5_constructor
+from webmedia import app_settings
+
+HASH_LENGTH = 12
+HASHED_NAME_RE = re.compile(r'^(.+)\.[0-9a-f]{%d}(\.[^.]+)$' % HASH_LENGTH)
+
+def file_hash(path):
+    """
+    Returns the truncated MD5 hex digest of a file's contents.
+    """
+    digest = md5_constructor()
+    f = open(path, 'rb')
+    try:
+        for chunk in iter(lambda: f.read(65536), ''):
+            digest.update(chunk)
+    finally:
+        f.close()
+    return digest.hexdigest()[:HASH_LENGTH]
+
+def hashed_name(name, digest):
+    """
+    Inserts a digest before the extension of a filename or URL.
+    """
+    base, ext = os.path.splitext(name)
+    return '%s.%s%s' % (base, digest, ext)
+
+def is_hashed_name(path):
+    """
+    Checks if a path is a hashed copy of an existing file.
+    """
+    match = HASHED_NAME_RE.match(path)
+    return bool(match) and os.path.isfile(''.join(match.groups()))
+
+
+class AssetManifest(object):
+    """
+    Map of file paths relative to MEDIA_ROOT to content hashes, stored
+    as JSON and loaded once per process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._assets = None
+
+    @property
+    def assets(self):
+        if self._assets is None:
+            self.reload()
+        return self._assets
+
+    def reload(self):
+        try:
+            f = open(self.path)
+        except IOError:
+            self._assets = {}
+            return
+        try:
+            self._assets = simplejson.load(f)
+        finally:
+            f.close()
+
+    def save(self, assets):
+        """
+        Replaces the manifest file atomically.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        f = os.fdopen(fd, 'w')
+        try:
+            simplejson.dump(assets, f, indent=0, sort_keys=True)
+        finally:
+            f.close()
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, self.path)
+        self._assets = assets
+
+    def version(self, src):
+        """
+        Returns the versioned URL for a src under MEDIA_URL, or None if
+        the file isn't in the manifest.
+        """
+        if not src.startswith(settings.MEDIA_URL):
+            return None
+        digest = self.assets.get(src[len(settings.MEDIA_URL):])
+        if digest is None:
+            return None
+        if app_settings.HASHED_FILENAMES:
+            return hashed_name(src, digest)
+        return '%s?v=%s' % (src, digest)
+
+
+_manifests = {}
+
+def get_asset_manifest():
+    path = app_settings.ASSET_MANIFEST
+    if path not in _manifests:
+        _manifests[path] = AssetManifest(path)
+    return _manifests[path]
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import mimetypes
+import os
+
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseNotModified, HttpResponseRedirect
+from django.utils import simplejson
+from django.utils.http import http_date, urlquote
+from django.views.static import was_modified_since
+from webmedia import app_settings
+from webmedia.cache import stat_cache
+from webmedia.eviction import tracker
+from webmedia.fragments import fragment_cache
+from webmedia.manifest import get_manifest
+from webmedia.processors.image import ImageTooLarge, thumbnail_from_query
+from webmedia.stats import stats as webmedia_stats
+
+def stats(request):
+    """
+    Dumps the timings, counters and cache statistics of this process as
+    JSON. Only available with DEBUG or to staff users.
+    """
+    user = getattr(request, 'user', None)
+    if not settings.DEBUG and not getattr(user, 'is_staff', False):
+        raise Http404
+    data = webmedia_stats.snapshot()
+    data['caches'] = {
+        'stat': stat_cache.stats(),
+        'fragment': fragment_cache.stats(),
+    }
+    return HttpResponse(simplejson.dumps(data, indent=2, sort_keys=True),
+                        mimetype='application/json')
+
+def thumbnail(request, path):
+    """
+    Serves the thumbnail described by the signed query string of the
+    URL, generating it if needed. Originals too large to be resized are
+    redirected to.
+    """
+    try:
+        thumb = thumbnail_from_query(path, request.GET)
+    except ValueError:
+        raise Http404
+    for attempt in range(2):
+        try:
+            thumb.generate()
+        except ImageTooLarge:
+            return HttpResponseRedirect(settings.MEDIA_URL + urlquote(path))
+        except IOError:
+            # Missing or broken original
+            raise Http404
+        try:
+            stat = os.stat(thumb.path)
+            break
+        except OSError:
+            # Recorded in the manifest or stat cache, but removed since
+            manifest = get_manifest()
+            if manifest is not None:
+                manifest.delete(thumb.src)
+            stat_cache.invalidate(thumb.path)
+    else:
+        raise Http404
+    tracker.touch(thumb.path)
+
+    etag = '"%x-%x"' % (int(stat.st_mtime), stat.st_size)
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        modified = etag not in [tag.strip() for tag in if_none_match.split(',')]
+    else:
+        modified = was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'),
+                                      stat.st_mtime, stat.st_size)
+
+    mimetype = mimetypes.guess_type(thumb.path)[0] or 'application/octet-stream'
+    if not modified:
+        response = HttpResponseNotModified()
+    elif app_settings.THUMBNAIL_SENDFILE == 'x-accel-redirect':
+        response = HttpResponse(mimetype=mimetype)
+        response['X-Accel-Redirect'] = app_settings.THUMBNAIL_ACCEL_URL + urlquote(thumb.src)
+    elif app_settings.THUMBNAIL_SENDFILE == 'x-sendfile':
+        response = HttpResponse(mimetype=mimetype)
+        response['X-Sendfile'] = thumb.path
+    else:
+        f = open(thumb.path, 'rb')
+        try:
+            response = HttpResponse(f.read(), mimetype=mimetype)
+        finally:
+            f.close()
+        response['Content-Length'] = str(stat.st_size)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Cache-Control'] = 'public, max-age=%d' % app_settings.THUMBNAIL_SERVE_MAX_AGE
+    return response
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import Queue
+import threading
+
+from multiprocessing.dummy import Pool as ThreadPool
+
+from webmedia import app_settings
+
+logger = logging.getLogger('webmedia')
+
+class WorkerPool(object):
+    """
+    Daemon threads consuming jobs from a bounded queue.
+
+    Jobs are deduplicated by key while they're pending. When the queue
+    is full, `submit` waits up to `timeout` seconds and then drops the
+    job, leaving it to be submitted again by a later request.
+    """
+
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.queue = Queue.Queue(queue_size)
+        self.pending = set()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self.work, name='webmedia-worker')
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, func, *args, **kwargs):
+        """
+        Queues `func(*args, **kwargs)`, returns False if the job was
+        dropped because the queue is full.
+        """
+        timeout = app_settings.THUMBNAIL_ASYNC_TIMEOUT
+        self._lock.acquire()
+        try:
+            if key in self.pending:
+                return True
+            self.pending.add(key)
+            self.start()
+        finally:
+            self._lock.release()
+
+        try:
+            self.queue.put((key, func, args, kwargs), bool(timeout), timeout or None)
+        except Queue.Full:
+            self._lock.acquire()
+            self.pending.discard(key)
+            self._lock.release()
+            return False
+        return True
+
+    def work(self):
+        while True:
+            key, func, args, kwargs = self.queue.get()
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception('webmedia: job %r failed', key)
+            self._lock.acquire()
+            self.pending.discard(key)
+            self._lock.release()
+            self.queue.task_done()
+
+    def join(self):
+        """
+        Blocks until every queued job is done.
+        """
+        self.queue.join()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool_lock.acquire()
+        try:
+            if _pool is None:
+                _pool = WorkerPool(app_settings.THUMBNAIL_ASYNC_WORKERS,
+                                   app_settings.THUMBNAIL_ASYNC_QUEUE_SIZE)
+        finally:
+            _pool_lock.release()
+    return _pool
+
+
+_thread_pool = None
+
+def get_thread_pool():
+    """
+    Returns a pool of PREFETCH_WORKERS threads for parallel map()s.
+    """
+    global _thread_pool
+    if _thread_pool is None:
+        _pool_lock.acquire()
+        try:
+            if _thread_pool is None:
+                _thread_pool = ThreadPool(app_settings.PREFETCH_WORKERS)
+        finally:
+            _pool_lock.release()
+    return _thread_pool